@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""
+Testing the stage cache.
+"""
+
+import os
+import time
+import tempfile
+import nose
+from numpy.testing import *
+import numpy as np
+from tomograpy.cache import StageCache, directory_state
+
+def test_save_load():
+    cache = StageCache(tempfile.mkdtemp())
+    key = cache.key("path", {"bin_factor":2})
+    assert cache.load("data", key) is None
+    data = np.random.rand(4, 5, 3)
+    cache.save("data", key, {"data":data}, header=[{"A":1}] * 3)
+    entry = cache.load("data", key)
+    assert_array_equal(entry["data"], data)
+    assert_equal(entry["header"], [{"A":1}] * 3)
+    entry = cache.load("data", key, mmap_mode="r")
+    assert isinstance(entry["data"], np.memmap)
+    # an existing entry is kept
+    cache.save("data", key, {"data":data * 0})
+    assert_array_equal(cache.load("data", key)["data"], data)
+    assert_equal(os.listdir(os.path.join(cache.directory, "data")), [key])
+    cache.clear("data")
+    assert cache.load("data", key) is None
+
+def test_key():
+    cache = StageCache(tempfile.mkdtemp())
+    assert_equal(cache.key({"a":1, "b":(1, 2)}), cache.key({"b":(1, 2), "a":1}))
+    assert cache.key({"a":1}) != cache.key({"a":2})
+
+def test_directory_state():
+    path = tempfile.mkdtemp()
+    open(os.path.join(path, "a.fts"), "w").write("a")
+    state = directory_state(path)
+    assert_equal([s[0] for s in state], ["a.fts"])
+    open(os.path.join(path, "a.fts"), "w").write("ab")
+    assert directory_state(path) != state
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Testing the header catalog.
+"""
+
+import os
+import shutil
+import tempfile
+import nose
+from numpy.testing import *
+import numpy as np
+import pyfits
+from tomograpy import catalog, solar
+from tomograpy.catalog import Catalog
+
+from test_solar import fits_directory
+
+def names(files):
+    return [os.path.basename(f.filename) for f in files]
+
+def test_update():
+    path = fits_directory()
+    try:
+        cat = Catalog(path)
+        assert_equal(cat.filename, os.path.join(path, catalog.catalog_name))
+        # all files are read once
+        assert_equal(cat.update(nthread=2), 5)
+        assert_equal(cat.update(), 0)
+        # modified and removed files
+        os.remove(os.path.join(path, "im3.fts"))
+        open(os.path.join(path, "notes.txt"), "w").write("modified")
+        assert_equal(cat.update(), 1)
+        assert_equal(names(cat.query()), ["im0.fts", "im1.fts", "im2.fts"])
+        cat.close()
+        # persistent
+        cat = Catalog(path)
+        assert_equal(cat.update(), 0)
+        cat.close()
+    finally:
+        shutil.rmtree(path)
+
+def test_query():
+    path = fits_directory()
+    try:
+        cat = Catalog(path)
+        cat.update()
+        # same selections as filter_files
+        files = solar.filter_files(solar.read_headers(path))
+        assert_equal(names(cat.query()), names(files))
+        for kwargs in ({"instrume":"EUVI"}, {"telescop":("STEREO",)},
+                       {"tmin":'2008-01-01T01:00:00',
+                        "tmax":'2008-01-01T02:30:00'},
+                       {"time_step":2 * 3600.}):
+            files = solar.filter_files(solar.read_headers(path), **kwargs)
+            assert_equal(names(cat.query(**kwargs)), names(files))
+        header = cat.query(instrume="EIT")[0].header
+        assert_equal(header['DATE_OBS'], '2008-01-01T01:00:00.500')
+        cat.close()
+        # select_files through the catalog
+        assert_equal(names(solar.select_files(path, catalog=True)),
+                     names(solar.select_files(path)))
+    finally:
+        shutil.rmtree(path)
+
+def test_no_time():
+    path = fits_directory()
+    try:
+        hdu = pyfits.PrimaryHDU(np.zeros((2, 2)))
+        hdu.header.update('INSTRUME', 'EUVI')
+        hdu.writeto(os.path.join(path, "no_time.fts"))
+        cat = Catalog(path)
+        cat.update()
+        assert "no_time.fts" not in names(cat.query())
+        assert "no_time.fts" not in names(cat.query(instrume="EUVI"))
+        cat.close()
+    finally:
+        shutil.rmtree(path)
+
+def test_read_only_directory():
+    path = fits_directory()
+    cache = tempfile.mkdtemp()
+    user_directory = catalog.user_catalog_directory
+    access = os.access
+    # a read-only directory (even for root)
+    catalog.user_catalog_directory = cache
+    os.access = lambda p, mode: (mode != os.W_OK or
+                                 os.path.abspath(p) != os.path.abspath(path))
+    try:
+        cat = Catalog(path)
+        assert_equal(os.path.dirname(cat.filename), cache)
+        cat.update()
+        assert_equal(len(cat.query()), 4)
+        cat.close()
+        assert not os.path.exists(os.path.join(path, catalog.catalog_name))
+    finally:
+        os.access = access
+        catalog.user_catalog_directory = user_directory
+        shutil.rmtree(path)
+        shutil.rmtree(cache)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+Testing checkpoints of solvers.
+"""
+
+import os
+import tempfile
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy import solvers
+from tomograpy.checkpoint import Checkpoint, config_key
+from tomograpy.priors import SmoothnessPrior
+
+def filename():
+    return os.path.join(tempfile.mkdtemp(), "srt.checkpoint.npz")
+
+def test_save_load():
+    ckpt = Checkpoint(filename(), every=2, key="a")
+    assert ckpt.load() is None
+    ckpt.save({"x":np.arange(3.), "rz":2.}, 3)
+    assert ckpt.load() is None
+    ckpt.save({"x":np.arange(3.), "rz":2.}, 4)
+    state = ckpt.load()
+    assert_array_equal(state["x"], np.arange(3.))
+    assert_equal(state["rz"], 2.)
+    assert_equal(state["iteration"], 4)
+    ckpt.remove()
+    assert not os.path.isfile(ckpt.filename)
+
+def test_key():
+    ckpt = Checkpoint(filename(), every=1, key=config_key({"a":1}))
+    ckpt.save({"x":np.zeros(2)}, 1)
+    ckpt.wait()
+    other = Checkpoint(ckpt.filename, key=config_key({"a":2}))
+    assert_raises(ValueError, other.load)
+
+def problem():
+    obj = tomograpy.centered_cubic_map(3, 6, fill=0.)
+    obj[2:4, 1:5, 2:5] = 1.
+    data = tomograpy.centered_stack(.05, 8, n_images=6, radius=200., fill=0.)
+    tomograpy.projector(data, obj)
+    return data, obj
+
+def test_pcg_resume():
+    data, obj = problem()
+    P = tomograpy.siddon_lo(data.header, obj.header)
+    D = SmoothnessPrior(obj.shape)
+    args = (P, data.ravel(), D, (.1, .1, .1))
+    x = solvers.pcg(*args, maxiter=20)
+    ckpt = Checkpoint(filename(), every=1)
+    solvers.pcg(*args, maxiter=8, checkpoint=ckpt)
+    assert_equal(ckpt.load()["iteration"], 8)
+    assert_array_almost_equal(solvers.pcg(*args, maxiter=20, checkpoint=ckpt),
+                              x, decimal=10)
+
+def test_os_sart_resume():
+    data, obj = problem()
+    x = solvers.os_sart(data, obj * 0., n_subsets=3, maxiter=6)
+    ckpt = Checkpoint(filename(), every=1)
+    solvers.os_sart(data, obj * 0., n_subsets=3, maxiter=4, checkpoint=ckpt)
+    assert_array_almost_equal(solvers.os_sart(data, obj * 0., n_subsets=3,
+                                              maxiter=6, checkpoint=ckpt), x)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
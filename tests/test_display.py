@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+Testing sinogram extraction.
+"""
+
+import nose
+from numpy.testing import *
+import numpy as np
+from tomograpy.display import extract_sinogram
+from tomograpy.stack import as_data_stack
+
+def disk_data(n_images=5, rsun=20., shape=(64, 64)):
+    """
+    Images whose value is the distance to the Sun center in solar radii,
+    with a Sun of rsun pixels and a different center in each image.
+    """
+    d = 200.
+    cdelt = np.arctan(1. / d) / rsun
+    data = np.empty(shape + (n_images,))
+    headers = []
+    x, y = np.mgrid[:shape[0], :shape[1]]
+    for t in xrange(n_images):
+        crpix1, crpix2 = 32. + t, 30. - t
+        # pixel indexes are zero-based, CRPIX is one-based
+        data[..., t] = np.sqrt((x - crpix1 + 1) ** 2 +
+                               (y - crpix2 + 1) ** 2) / rsun
+        headers.append({'D':d, 'CDELT1':cdelt, 'CDELT2':cdelt,
+                        'CRPIX1':crpix1, 'CRPIX2':crpix2,
+                        'SC_ROLL':10. * t})
+    return as_data_stack(data, headers)
+
+def test_radius():
+    data = disk_data()
+    for r in (.5, 1., 1.2):
+        sino = extract_sinogram(data, r, n=32)
+        assert_equal(sino.shape, (32, data.shape[-1]))
+        assert_array_almost_equal(sino, r, decimal=2)
+
+def test_limb():
+    data = disk_data()
+    data[:] = data < 1.
+    sino = extract_sinogram(data, [.5, 1.5], n=32)
+    assert_equal(sino.shape, (32, data.shape[-1], 2))
+    assert_array_almost_equal(sino[..., 0], 1., decimal=2)
+    assert_array_almost_equal(sino[..., 1], 0., decimal=2)
+
+def test_chunks():
+    data = disk_data(n_images=7)
+    ref = extract_sinogram(data, [.5, 1.2], chunk=7)
+    for chunk in (None, 1, 3):
+        assert_array_almost_equal(extract_sinogram(data, [.5, 1.2],
+                                                   chunk=chunk), ref)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
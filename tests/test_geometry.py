@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Testing the cache of geometric maps.
+"""
+
+import os
+import shutil
+import tempfile
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy import geometry
+
+def test_radius():
+    cube = tomograpy.centered_cubic_map(3, (4, 6, 8))
+    x, y, z = geometry.map_axes(cube.header)
+    R = geometry.radius(cube.header)
+    assert_equal(R.shape, cube.shape)
+    assert_almost_equal(R[1, 2, 3], np.sqrt(x[1] ** 2 + y[2] ** 2 + z[3] ** 2))
+
+def test_cache():
+    cache = geometry.GeometryCache(max_bytes=2 * 8 * 16 ** 3)
+    compute = lambda header, i: np.zeros((16, 16, 16)) + i
+    cube = tomograpy.centered_cubic_map(3, 16)
+    a = cache.get("a", cube.header, compute, 0)
+    assert cache.get("a", cube.header, compute, 0) is a
+    cache.get("a", cube.header, compute, 1)
+    cache.get("a", cube.header, compute, 2)
+    assert_equal(len(cache.entries), 2)
+    assert_equal(a.flags.writeable, False)
+    assert_equal((cache.misses, cache.hits), (3, 1))
+
+def test_directory():
+    directory = tempfile.mkdtemp()
+    try:
+        cube = tomograpy.centered_cubic_map(3, 8)
+        cache = geometry.GeometryCache(directory=directory)
+        R = cache.get("radius", cube.header, geometry._radius)
+        assert isinstance(R, np.memmap)
+        # a single complete file, no temporary file left
+        assert_equal(len(os.listdir(directory)), 1)
+        # reused by a new cache
+        cache = geometry.GeometryCache(directory=directory)
+        assert_array_equal(cache.get("radius", cube.header, geometry._radius),
+                           R)
+        assert_equal(cache.hits, 1)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
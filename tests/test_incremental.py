@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+Testing sliding window reconstructions.
+"""
+
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy import models, solvers
+from tomograpy.incremental import SlidingWindow
+from tomograpy.stack import as_data_stack
+
+hypers = (1e-2, 1e-2, 1e-2)
+mask_params = dict(obj_rmin=1., obj_rmax=1.5, data_rmax=1.4)
+
+def stack(n=12):
+    obj = tomograpy.centered_cubic_map(3, 8, fill=1.)
+    data = tomograpy.centered_stack(.02, 16, n_images=n, radius=200.,
+                                    max_lon=2 * np.pi, fill=0.)
+    for i, h in enumerate(data.header):
+        h["DATE_OBS"] = "2010-01-01T%02i:00:00.000" % i
+    tomograpy.projector(data, obj, obstacle="sun")
+    return data, obj * 0.
+
+def reference(data, cube):
+    data = as_data_stack(np.array(data), data.header)
+    P, D, obj_mask, data_mask = models.srt(data, cube, decimate=True,
+                                           **mask_params)
+    b = (data * (1 - data_mask)).ravel()
+    return solvers.pcg(P, b, D, hypers, tol=1e-10)
+
+def test_window():
+    data, cube = stack()
+    window = SlidingWindow(cube, hypers, duration=5.5 * 3600, capacity=4,
+                           **mask_params)
+    window.update(data[..., :6])
+    assert_equal(len(window), 6)
+    x = window.solve(tol=1e-10)
+    assert_array_almost_equal(x.ravel()[window.index],
+                              reference(data[..., :6], cube))
+    # images older than 5.5 hours expire
+    window.update(data[..., 6:9])
+    assert_equal(len(window), 6)
+    x = window.solve(tol=1e-10)
+    assert_array_almost_equal(x.ravel()[window.index],
+                              reference(data[..., 3:9], cube))
+    # with free slots, the projector is updated in place
+    P = window.P
+    window.update(data[..., 9:12])
+    assert window.P is P
+    x = window.solve(tol=1e-10)
+    assert_array_almost_equal(x.ravel()[window.index],
+                              reference(data[..., 6:12], cube))
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
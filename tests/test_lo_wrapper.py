@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+Testing the linear operators of the Siddon projector.
+"""
+
+import pickle
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy import siddon_lo
+
+def check_pickle(index):
+    obj = tomograpy.centered_cubic_map(3, 8, fill=1.)
+    data = tomograpy.centered_stack(.05, 16, n_images=4, radius=200.)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[:3] = True
+    P = siddon_lo(data.header, obj.header, mask=mask, index=index)
+    Q = pickle.loads(pickle.dumps(P, 2))
+    assert_equal(type(Q), type(P))
+    x = np.random.rand(P.shape[1])
+    assert_array_equal(Q * x, P * x)
+    y = np.random.rand(P.shape[0])
+    assert_array_equal(Q.T * y, P.T * y)
+
+def test_pickle():
+    yield check_pickle, None
+    yield check_pickle, np.arange(0, 8 ** 3, 3)
+
+def check_outputs(index):
+    obj = tomograpy.centered_cubic_map(3, 8, fill=1.)
+    data = tomograpy.centered_stack(.05, 16, n_images=4, radius=200.)
+    P = siddon_lo(data.header, obj.header, index=index)
+    x = np.random.rand(P.shape[1])
+    y1 = P * x
+    y2 = P * (2 * x)
+    # results are not overwritten by later calls
+    assert_array_almost_equal(y2, 2 * y1)
+    # outputs given by the caller
+    y = np.ones(P.shape[0])
+    P.project(x, out=y.reshape(P.shapeout), accumulate=True)
+    assert_array_almost_equal(y, y1 + 1.)
+    P.project(x, out=y.reshape(P.shapeout))
+    assert_array_almost_equal(y, y1)
+    z = np.ones(P.shape[1])
+    P.backproject(y1, out=z.reshape(P.shapein), accumulate=True)
+    assert_array_almost_equal(z, P.T * y1 + 1.)
+
+def test_outputs():
+    yield check_outputs, None
+    yield check_outputs, np.arange(0, 8 ** 3, 3)
+
+def check_normal_operator(index):
+    obj = tomograpy.centered_cubic_map(3, 8, fill=1.)
+    data = tomograpy.centered_stack(.05, 16, n_images=4, radius=200.)
+    P = siddon_lo(data.header, obj.header, index=index)
+    A = tomograpy.solvers.normal_operator(P)
+    x = np.random.rand(P.shape[1])
+    y = np.empty(P.shape[1])
+    A(x, out=y)
+    assert_array_almost_equal(y, P.T * (P * x))
+    # the temporary projection is allocated once
+    nbytes = P.buffers.nbytes
+    A(2 * x, out=y)
+    assert_equal(P.buffers.nbytes, nbytes)
+    assert_array_almost_equal(y, 2 * (P.T * (P * x)))
+
+def test_normal_operator():
+    yield check_normal_operator, None
+    yield check_normal_operator, np.arange(0, 8 ** 3, 3)
+
+def check_masked(decimate):
+    obj = tomograpy.centered_cubic_map(3, 8, fill=1.)
+    data = tomograpy.centered_stack(.05, 16, n_images=4, radius=200.)
+    P = siddon_lo(data.header, obj.header)
+    obj_mask = np.zeros(obj.shape, dtype=bool)
+    obj_mask[2:5, 3:, 1:4] = True
+    M = tomograpy.lo_wrapper.masked_lo(P, obj_mask, decimate=decimate)
+    assert_equal(type(M), tomograpy.lo_wrapper.MaskedSiddon)
+    # reference: the masked map expanded with zeros
+    index = np.flatnonzero(~obj_mask)
+    def expand(x):
+        full = np.zeros(obj.size)
+        if decimate:
+            full[index] = x
+        else:
+            full[index] = x[index]
+        return full
+    x = np.random.rand(M.shape[1])
+    assert_array_almost_equal(M * x, P * expand(x))
+    y = np.random.rand(M.shape[0])
+    bpj = np.asarray(P.T * y)
+    if decimate:
+        assert_array_almost_equal(M.T * y, bpj[index])
+    else:
+        assert_array_almost_equal(M.T * y, expand(bpj))
+    z = np.ones(M.shape[1])
+    M.backproject(y, out=z.reshape(M.shapein), accumulate=True)
+    assert_array_almost_equal(z, M.T * y + 1.)
+    Q = pickle.loads(pickle.dumps(M, 2))
+    assert_array_equal(Q * x, M * x)
+    # the normal operator uses the buffers of the masked operator
+    A = tomograpy.solvers.normal_operator(M)
+    A(x, out=z)
+    nbytes = M.buffers.nbytes + P.buffers.nbytes
+    A(2 * x, out=z)
+    assert_equal(M.buffers.nbytes + P.buffers.nbytes, nbytes)
+    assert_array_almost_equal(z, 2 * (M.T * (M * x)))
+
+def test_masked():
+    yield check_masked, False
+    yield check_masked, True
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
@@ -36,5 +36,24 @@ def test_models():
     for model in models:
         yield check_model, model, image_headers64[1], object_headers64[1]
 
+def check_group_sum(ind):
+    cube = np.zeros((3, 4, 5))
+    data = np.zeros((2, 2, 12))
+    G = tomograpy.models.group_sum(ind, cube, data)
+    x = np.random.rand(*(cube.shape + (12,)))
+    bounds = list(ind) + [12]
+    expected = np.zeros(cube.shape + (len(ind),))
+    for k in xrange(len(ind)):
+        expected[..., k] = x[..., bounds[k]:bounds[k + 1]].sum(axis=-1)
+    assert_array_almost_equal((G * x.ravel()).reshape(expected.shape),
+                              expected)
+    # the transpose broadcasts group maps
+    y = np.random.rand(G.shape[0])
+    assert_almost_equal(np.dot(G * x.ravel(), y), np.dot(x.ravel(), G.T * y))
+
+def test_group_sum():
+    for ind in ([0, 3, 4, 10], [2, 5, 5, 11], range(12)):
+        yield check_group_sum, ind
+
 if __name__ == "__main__":
     nose.run(argv=['', __file__])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+Testing coarse-to-fine inversions.
+"""
+
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy import multigrid, solar, solvers
+from tomograpy.stack import as_data_stack
+
+hypers = (1., 1., 1.)
+
+def problem():
+    obj = tomograpy.centered_cubic_map(3, 16, fill=0.)
+    x, y, z = np.ogrid[-7.5:8., -7.5:8., -7.5:8.]
+    obj[:] = np.exp(- np.sqrt(x ** 2 + y ** 2 + z ** 2) / 4.)
+    data = tomograpy.centered_stack(.05, 32, n_images=16, radius=200.,
+                                    fill=0.)
+    tomograpy.projector(data, obj)
+    return as_data_stack(data), obj * 0.
+
+def test_coarse_map_header():
+    cube = tomograpy.centered_cubic_map(3, 16)
+    h = multigrid.coarse_map_header(cube.header, 4)
+    h0 = tomograpy.centered_cubic_map_header(3, 4)
+    for k in ("NAXIS1", "CDELT2", "CRPIX3", "MMIN1", "MMAX2"):
+        assert_almost_equal(h[k], h0[k])
+
+def test_bin_data():
+    data, cube = problem()
+    binned = solar.bin_data(data, 4)
+    assert_equal(binned.shape, (8, 8, 16))
+    block = data[..., 3].reshape(8, 4, 8, 4).mean(axis=3).mean(axis=1)
+    assert_almost_equal(binned[..., 3], block)
+    assert_equal(binned.header[0]["CDELT1"], 4 * data.header[0]["CDELT1"])
+    assert_equal(binned.header[0]["CRPIX2"], data.header[0]["CRPIX2"] / 4.)
+
+def check_prolongate(shape, coarse_shape):
+    x = multigrid.prolongate(2. * np.ones(coarse_shape), shape)
+    assert_equal(x.shape, shape)
+    assert_array_almost_equal(x, 2.)
+    y = multigrid.restrict(2. * np.ones(shape), coarse_shape)
+    assert_array_almost_equal(y, 2.)
+
+def test_prolongate():
+    yield check_prolongate, (8, 8, 8), (4, 4, 4)
+    yield check_prolongate, (9, 6, 4), (4, 3, 2)
+
+def test_multigrid():
+    data, cube = problem()
+    ref = multigrid.multigrid(data, cube, hypers, levels=1, maxiter=200,
+                              tol=1e-12)
+    x1 = multigrid.multigrid(data, cube, hypers, levels=1, maxiter=10)
+    x2 = multigrid.multigrid(data, cube, hypers, levels=2, maxiter=10)
+    assert_equal(x2.header, cube.header)
+    assert np.std(x2 - ref) < np.std(x1 - ref)
+
+def test_vcycles():
+    data, cube = problem()
+    ref = multigrid.multigrid(data, cube, hypers, levels=1, maxiter=200,
+                              tol=1e-12)
+    x, info = multigrid.multigrid(data, cube, hypers, levels=2, maxiter=10,
+                                  vcycles=3, full_output=True)
+    assert_array_almost_equal(x, ref, decimal=3)
+
+def test_lo_iterations():
+    import lo
+    data, cube = problem()
+    x, info = multigrid.multigrid(data, cube, hypers, levels=2, maxiter=5,
+                                  solver=lo.acg, full_output=True)
+    # counted by a callback, the residual and convergence are unknown
+    assert 0 < info["iterations"] <= 5
+    assert np.isnan(info["residual"])
+    assert info["converged"] is None
+    solvers.report("acg", info)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
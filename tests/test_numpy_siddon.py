@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Testing the numpy engine against the C extension.
+"""
+
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+import fitsarray as fa
+
+from test_cases import *
+
+def decimal(dtype):
+    return 3 if dtype == np.float32 else 8
+
+def check_projector(im_h, obj_h, obstacle):
+    obj = siddon.simu.object_from_header(obj_h)
+    data = siddon.simu.circular_trajectory_data(n_images=5, **im_h)
+    if data.dtype == obj.dtype:
+        obj[:] = np.random.rand(*obj.shape)
+        data[:] = 0.
+        ref = siddon.projector(data.copy(), obj, obstacle=obstacle,
+                               engine="c")
+        out = siddon.projector(data.copy(), obj, obstacle=obstacle,
+                               engine="numpy")
+        scale = max(np.abs(ref).max(), 1.)
+        assert_array_almost_equal(out / scale, ref / scale,
+                                  decimal=decimal(data.dtype))
+
+def test_projector():
+    for im_h in image_headers:
+        for obj_h in object_headers:
+            for obstacle in (None, "sun"):
+                yield check_projector, im_h, obj_h, obstacle
+
+def check_backprojector(im_h, obj_h, obstacle):
+    obj = siddon.simu.object_from_header(obj_h)
+    data = siddon.simu.circular_trajectory_data(n_images=5, **im_h)
+    if data.dtype == obj.dtype:
+        data[:] = np.random.rand(*data.shape)
+        obj[:] = 0.
+        ref = siddon.backprojector(data, obj.copy(), obstacle=obstacle,
+                                   engine="c")
+        out = siddon.backprojector(data, obj.copy(), obstacle=obstacle,
+                                   engine="numpy")
+        scale = max(np.abs(ref).max(), 1.)
+        assert_array_almost_equal(out / scale, ref / scale,
+                                  decimal=decimal(data.dtype))
+
+def test_backprojector():
+    for im_h in image_headers:
+        for obj_h in object_headers:
+            for obstacle in (None, "sun"):
+                yield check_backprojector, im_h, obj_h, obstacle
+
+def test_4d():
+    obj = siddon.centered_cubic_map(3, 16)
+    data = siddon.simu.circular_trajectory_data(n_images=5, **image_headers64[1])
+    obj4 = np.random.rand(*(obj.shape + (data.shape[-1],)))
+    obj4 = fa.InfoArray(data=obj4, header=dict(obj.header))
+    data[:] = 0.
+    ref = siddon.projector4d(data.copy(), obj4, engine="c")
+    out = siddon.projector4d(data.copy(), obj4, engine="numpy")
+    assert_array_almost_equal(out, ref)
+    data[:] = np.random.rand(*data.shape)
+    ref = siddon.backprojector4d(data, obj4.copy() * 0., engine="c")
+    out = siddon.backprojector4d(data, obj4.copy() * 0., engine="numpy")
+    assert_array_almost_equal(out, ref)
+
+def test_mask_and_chunks():
+    obj = siddon.centered_cubic_map(3, 16)
+    obj[:] = np.random.rand(*obj.shape)
+    data = siddon.simu.circular_trajectory_data(n_images=5, **image_headers64[1])
+    mask = np.random.rand(*data.shape) > .5
+    data[:] = 1.
+    ref = siddon.projector(data.copy(), obj, mask=mask, accumulate=False,
+                           engine="c")
+    out = data.copy()
+    siddon.check_projector_inputs(out, obj)
+    tomograpy.numpy_siddon.conic_projector(
+        out, obj, siddon.data_mask_array(out, mask), accumulate=False,
+        chunk_size=100)
+    assert_array_almost_equal(out, ref)
+
+def test_image_projector():
+    obj = siddon.centered_cubic_map(3, 16)
+    obj[:] = np.random.rand(*obj.shape)
+    data = siddon.simu.circular_trajectory_data(n_images=5, **image_headers64[1])
+    data[:] = 0.
+    ref = siddon.conic_image_projector(data.copy(), obj, 3, engine="c")
+    out = siddon.conic_image_projector(data.copy(), obj, 3, engine="numpy")
+    assert_array_almost_equal(out, ref)
+    assert_array_equal(out[..., :3], 0.)
+
+def test_select_engine():
+    assert_equal(siddon.select_engine("numpy"), "numpy")
+    assert_raises(ValueError, siddon.select_engine, "fortran")
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
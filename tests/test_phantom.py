@@ -9,6 +9,9 @@ from numpy.testing import *
 import numpy as np
 from tomograpy import phantom
 from tomograpy.phantom import *
+from tomograpy.phantom import ellipsoid, define_coordinates
+from tomograpy.phantom import (shepp_logan_parameters, yu_ye_wang_parameters,
+                               modified_shepp_logan_parameters)
 
 # test cases
 phantoms = [yu_ye_wang, shepp_logan, modified_shepp_logan]
@@ -46,6 +49,56 @@ def test_central_value():
         for p in spheres:
             yield assert_equal, phantom(shape, [p,])[i, j, k], p['A']
 
+# bounding box rasterisation equals full grid rasterisation
+def check_bounding_box(shape, parameters_list):
+    cube = np.zeros(shape)
+    coordinates = define_coordinates(shape)
+    for p in parameters_list:
+        ellipsoid(p, out=cube, coordinates=coordinates)
+    assert_array_equal(phantom(shape, parameters_list, chunk_size=64), cube)
+
+def test_bounding_box():
+    for shape in shapes:
+        for parameters_list in (shepp_logan_parameters,
+                                modified_shepp_logan_parameters,
+                                yu_ye_wang_parameters):
+            yield check_bounding_box, shape, parameters_list
+
+# analytic projection of an ellipsoid filling the map equals the
+# siddon projection of a map of ones
+def test_phantom_projector():
+    import tomograpy
+    obj = tomograpy.centered_cubic_map(3, 16, fill=1.)
+    data = tomograpy.centered_stack(tomograpy.fov(obj, 200.), 16,
+                                    n_images=4, radius=200.)
+    data2 = data.copy()
+    tomograpy.projector(data, obj)
+    sphere = dict(spheres[0], a=2., b=2., c=2.)
+    phantom_projector(data2, obj, [sphere])
+    assert_array_almost_equal(data, data2)
+
+# analytic projection equals the siddon projection of the rasterised
+# phantom up to the discretisation of the map
+def check_phantom_rasterised(parameters_list, obstacle):
+    import tomograpy
+    obj = tomograpy.centered_cubic_map(8, 64, fill=0.)
+    obj[:] = phantom(obj.shape, parameters_list)
+    # lines of sight are not aligned with the voxels
+    data = tomograpy.centered_stack(tomograpy.fov(obj, 200.), 33,
+                                    n_images=4, radius=200., min_lon=.3,
+                                    max_lon=np.pi + .3)
+    data2 = data.copy()
+    tomograpy.projector(data, obj, obstacle=obstacle)
+    phantom_projector(data2, obj, parameters_list, obstacle=obstacle)
+    assert np.linalg.norm(data2 - data) < .05 * np.linalg.norm(data)
+
+def test_phantom_rasterised():
+    rotated = {'A':1., 'a':.8, 'b':.6, 'c':.5, 'x0':.1, 'y0':-.1, 'z0':.05,
+               'phi':30., 'theta':20., 'psi':40.}
+    for obstacle in (None, "sun"):
+        yield check_phantom_rasterised, [rotated], obstacle
+        yield check_phantom_rasterised, shepp_logan_parameters, obstacle
+
 # test conversion from array to dict
 def test_array_to_parameters():
     from siddon.phantom import _array_to_parameters
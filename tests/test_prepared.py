@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Testing prepared stacks.
+"""
+
+import os
+import tempfile
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy.prepared import save_stack, load_stack
+from tomograpy.cache import directory_state
+from tomograpy.stack import HeaderTable
+
+from test_cases import *
+
+def stack(dtype=np.float32):
+    data = siddon.simu.circular_trajectory_data(n_images=5,
+                                                **image_headers64[1])
+    data = data.astype(dtype)
+    data[:] = np.random.rand(*data.shape)
+    return data
+
+def mapped(a):
+    "True if the array is a view of a memory-mapped file."
+    while a is not None:
+        if isinstance(a, np.memmap):
+            return True
+        a = getattr(a, "base", None)
+    return False
+
+def test_round_trip():
+    for dtype in (np.float32, np.float64):
+        data = stack(dtype)
+        directory = os.path.join(tempfile.mkdtemp(), "stack")
+        save_stack(directory, data)
+        out = load_stack(directory)
+        assert mapped(out)
+        assert isinstance(out.header, HeaderTable)
+        assert not out.flags.writeable
+        assert_equal(out.dtype, data.dtype)
+        assert_array_equal(out, data)
+        for h, ref in zip(out.header, data.header):
+            for k, v in ref.iteritems():
+                assert_equal(h[k], v)
+        # columns are available without reading the headers
+        assert 'LON' in out.header._store.columns
+        assert_array_equal(out.header['LON'], data.header['LON'])
+        # rotation matrices are saved
+        assert out.header.has_column('R1_1')
+        # in memory
+        out = load_stack(directory, mmap_mode=None)
+        assert not mapped(out)
+        assert_array_equal(out, data)
+
+def test_missing_keys():
+    data = stack()
+    headers = [dict(h) for h in data.header]
+    del headers[1]['M1']
+    headers[2]['EXTRA'] = 'a'
+    headers[3]['MIXED'] = 1.
+    headers[4]['MIXED'] = 'b'
+    for i, h in enumerate(headers):
+        h['EXPTIME'] = 10 if i % 2 else 10.5
+    data = tomograpy.stack.as_data_stack(data, headers)
+    directory = os.path.join(tempfile.mkdtemp(), "stack")
+    save_stack(directory, data)
+    out = load_stack(directory)
+    for h, ref in zip(out.header, headers):
+        assert_equal(set(h.keys()) - set(ref.keys()),
+                     set(['R%i_%i' % (i, j) for i in (1, 2, 3)
+                          for j in (1, 2, 3)]) - set(ref.keys()))
+        assert set(ref.keys()) <= set(h.keys())
+    assert_equal(out.header[2]['EXTRA'], 'a')
+    assert_equal(out.header[3]['MIXED'], 1.)
+    assert_equal(out.header[4]['MIXED'], 'b')
+    # integers are not converted to floats
+    assert_equal(type(out.header[1]['EXPTIME']), int)
+    assert_equal(type(out.header[2]['EXPTIME']), float)
+
+def test_invalidation():
+    path = tempfile.mkdtemp()
+    open(os.path.join(path, "a.fts"), "w").write("a")
+    data = stack()
+    directory = os.path.join(tempfile.mkdtemp(), "stack")
+    save_stack(directory, data, sources=directory_state(path))
+    assert load_stack(directory, sources=directory_state(path)) is not None
+    open(os.path.join(path, "a.fts"), "w").write("ab")
+    assert load_stack(directory, sources=directory_state(path)) is None
+    open(os.path.join(path, "b.fts"), "w").write("b")
+    assert load_stack(directory, sources=directory_state(path)) is None
+    # no such stack
+    assert load_stack(os.path.join(path, "none")) is None
+
+def test_project():
+    data = stack(np.float64)
+    obj = siddon.centered_cubic_map(3, 16)
+    obj[:] = np.random.rand(*obj.shape)
+    directory = os.path.join(tempfile.mkdtemp(), "stack")
+    save_stack(directory, data)
+    out = load_stack(directory)
+    ref = siddon.projector(data.copy() * 0, obj)
+    # copy-on-write: the stack is projected without modifying the file
+    proj = load_stack(directory, mmap_mode="c")
+    proj[:] = 0.
+    siddon.projector(proj, obj)
+    assert_array_almost_equal(proj, ref)
+    bpj = siddon.backprojector(out, obj.copy() * 0.)
+    assert_array_almost_equal(bpj, siddon.backprojector(data, obj.copy() * 0.))
+    assert_array_equal(load_stack(directory), data)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
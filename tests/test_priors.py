@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Testing smoothness priors.
+"""
+
+import nose
+from numpy.testing import *
+import numpy as np
+from tomograpy.priors import SmoothnessPrior, difference_normal
+
+shape = (6, 5, 4)
+hypers = (.5, 1., 2.)
+
+def reference(D, x):
+    return np.sum([h * (Di.T * (Di * x)) for h, Di in zip(hypers, D)],
+                  axis=0)
+
+def check_normal(prior):
+    D = prior()
+    x = np.random.rand(D[0].shape[1])
+    assert_array_almost_equal(D.normal(hypers) * x, reference(D, x))
+
+def test_normal():
+    weights = np.random.rand(*shape)
+    mask = np.random.rand(*shape) > .7
+    W = lambda: SmoothnessPrior(shape, weights=weights)
+    index = np.arange(0, np.prod(shape), 3)
+    for prior in (lambda: SmoothnessPrior(shape), W,
+                  lambda: W().masked(mask),
+                  lambda: W().masked(mask, decimate=True),
+                  lambda: W().compressed(index)):
+        yield check_normal, prior
+
+def difference_normal_reference(x, hypers):
+    out = np.zeros(x.shape)
+    for axis, h in enumerate(hypers):
+        if x.shape[axis] < 2:
+            continue
+        d = h * np.diff(x, axis=axis)
+        lo_s = [slice(None)] * x.ndim
+        hi_s = [slice(None)] * x.ndim
+        lo_s[axis] = slice(None, -1)
+        hi_s[axis] = slice(1, None)
+        out[tuple(lo_s)] -= d
+        out[tuple(hi_s)] += d
+    return out
+
+def test_difference_normal():
+    for s in (shape, (1, 5, 4), (7, 1, 3), (2, 3, 4, 5)):
+        x = np.random.rand(*s)
+        h = np.arange(1., len(s) + 1)
+        ref = difference_normal_reference(x, h)
+        for nthread in (1, 3, 8):
+            out = np.random.rand(*s)
+            difference_normal(x, h, out=out, nthread=nthread)
+            assert_array_almost_equal(out, ref)
+
+def test_compressed():
+    weights = np.random.rand(*shape)
+    index = np.flatnonzero(np.random.rand(*shape) > .4)
+    full = SmoothnessPrior(shape, weights=weights)
+    D = full.compressed(index)
+    # only the differences involving active voxels are kept
+    assert D[0].shape[0] < full[0].shape[0]
+    x = np.random.rand(index.size)
+    y = np.zeros(np.prod(shape))
+    y[index] = x
+    assert_almost_equal(np.sum([h * np.sum((Di * x) ** 2)
+                                for h, Di in zip(hypers, D)]),
+                        np.sum([h * np.sum((Di * y) ** 2)
+                                for h, Di in zip(hypers, full)]))
+    assert_array_almost_equal(D.normal(hypers) * x,
+                              (full.normal(hypers) * y)[index])
+    assert_array_almost_equal(D.diagonal(hypers),
+                              full.diagonal(hypers)[index])
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
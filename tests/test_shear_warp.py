@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Testing the shear-warp approximation of the Siddon projector.
+"""
+
+import pickle
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy import shear_warp
+
+def problem(n_images=6, radius=215., fov=.02):
+    obj = tomograpy.centered_cubic_map(3, 32)
+    x, y, z = np.ogrid[-15.5:16., -15.5:16., -15.5:16.]
+    obj[:] = np.exp(- np.sqrt(x ** 2 + y ** 2 + z ** 2) / 6.)
+    data = tomograpy.centered_stack(fov, 64, n_images=n_images,
+                                    radius=radius, max_lon=2 * np.pi, fill=0.)
+    return data, obj
+
+def check_projector(obstacle):
+    data, obj = problem()
+    P = shear_warp.ShearWarpProjector(data, obj, obstacle=obstacle)
+    assert P.parallel.all()
+    assert np.all(P.errors <= shear_warp.TOLERANCE)
+    ref = tomograpy.projector(data.copy(), obj, obstacle=obstacle)
+    y = P.project(obj)
+    assert np.linalg.norm(y - ref) < .1 * np.linalg.norm(ref)
+    assert_almost_equal(y.sum() / ref.sum(), 1., decimal=1)
+
+def check_transpose(obstacle):
+    data, obj = problem()
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[:10] = True
+    P = shear_warp.ShearWarpProjector(data, obj, mask=mask, obstacle=obstacle)
+    x = np.random.rand(*obj.shape)
+    y = np.random.rand(*data.shape)
+    assert_almost_equal(np.vdot(P.project(x), y), np.vdot(x, P.backproject(y)))
+    assert_array_equal(P.project(x)[mask], 0.)
+
+def test_projector():
+    for obstacle in (None, "sun"):
+        yield check_projector, obstacle
+        yield check_transpose, obstacle
+
+def test_conic_views():
+    # views too close to the map are projected with Siddon
+    data, obj = problem(radius=10., fov=.4)
+    P = shear_warp.ShearWarpProjector(data, obj, obstacle="sun")
+    assert not P.parallel.any()
+    ref = tomograpy.projector(data.copy(), obj, obstacle="sun")
+    assert_array_almost_equal(P.project(obj), ref)
+
+def test_accumulate():
+    data, obj = problem()
+    P = shear_warp.ShearWarpProjector(data, obj)
+    y = P.project(obj)
+    out = np.ones(data.shape)
+    P.project(obj, out=out, accumulate=True)
+    assert_array_almost_equal(out, y + 1.)
+    P.project(obj, out=out)
+    assert_array_almost_equal(out, y)
+
+def test_lo():
+    data, obj = problem()
+    P = tomograpy.siddon_lo(data.header, obj.header, obstacle="sun",
+                            tolerance=2.)
+    assert isinstance(P, tomograpy.ShearWarpSiddon)
+    Q = pickle.loads(pickle.dumps(P, 2))
+    x = np.random.rand(P.shape[1])
+    assert_array_equal(Q * x, P * x)
+    assert_raises(ValueError, tomograpy.siddon_lo, data.header, obj.header,
+                  index=np.arange(10), tolerance=2.)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
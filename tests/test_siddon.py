@@ -154,5 +154,51 @@ def test_special_cases():
         for obj_h in object_headers:
             yield check_special_cases, im_h, obj_h
 
+# test that projecting a cube equals projecting its active voxels only
+
+def check_active_voxels(im_h, obj_h):
+    obj = siddon.simu.object_from_header(obj_h)
+    data1 = siddon.simu.circular_trajectory_data(n_images=5, **im_h)
+    data2 = siddon.simu.circular_trajectory_data(n_images=5, **im_h)
+    if data1.dtype == obj.dtype:
+        data1[:] = 0.
+        data2[:] = 0.
+        obj[:] = np.random.rand(*obj.shape)
+        index = siddon.siddon.active_voxels(data1, obj, obstacle="sun")
+        x = siddon.siddon.compress_voxels(obj, index)
+        siddon.projector(data1, obj, obstacle="sun")
+        obj[:] = siddon.siddon.expand_voxels(x, index, obj.shape)
+        siddon.projector(data2, obj, obstacle="sun")
+        assert_array_almost_equal(data1, data2)
+
+def test_active_voxels():
+    for im_h in image_headers:
+        for obj_h in object_headers:
+            yield check_active_voxels, im_h, obj_h
+
+def check_accumulate(im_h, obj_h):
+    obj = siddon.simu.object_from_header(obj_h)
+    data = siddon.simu.circular_trajectory_data(n_images=5, **im_h)
+    if data.dtype == obj.dtype:
+        obj[:] = np.random.rand(*obj.shape)
+        data[:] = 0.
+        ref = siddon.projector(data.copy(), obj, obstacle="sun")
+        data[:] = 1.
+        siddon.projector(data, obj, obstacle="sun", accumulate=False)
+        assert_array_almost_equal(data, ref)
+        out = np.ones(data.shape, dtype=data.dtype)
+        siddon.projector(data, obj, obstacle="sun", out=out)
+        assert_array_almost_equal(out, ref + 1.)
+        bpj = siddon.backprojector(data, obj.copy(), obstacle="sun",
+                                   accumulate=False)
+        out = np.ones(obj.shape, dtype=obj.dtype)
+        siddon.backprojector(data, obj, obstacle="sun", out=out)
+        assert_array_almost_equal(out, bpj + 1.)
+
+def test_accumulate():
+    for im_h in image_headers:
+        for obj_h in object_headers:
+            yield check_accumulate, im_h, obj_h
+
 if __name__ == "__main__":
     nose.run(argv=['', __file__])
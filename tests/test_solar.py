@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Testing solar data utilities.
+"""
+
+import os
+import shutil
+import tempfile
+import nose
+from numpy.testing import *
+import numpy as np
+import pyfits
+import fitsarray as fa
+from tomograpy import solar, geometry
+from tomograpy.stack import as_data_stack
+
+def stack(shape=(20, 30, 3)):
+    header = dict(CRPIX1=10., CRPIX2=14., CDELT1=.01, CDELT2=.01, D=200.)
+    return as_data_stack(np.ones(shape), [dict(header)
+                                          for i in xrange(shape[-1])])
+
+def test_distance_to_sun_center_shape():
+    data = stack()
+    R = solar.distance_to_sun_center(data)
+    assert_equal(R.shape, data.shape)
+    assert_equal(np.unravel_index(np.argmin(R[..., 0]), R.shape[:2]),
+                 (10, 14))
+
+def test_data_mask():
+    data = stack()
+    data[0, 0, 0] = np.nan
+    R = solar.distance_to_sun_center(data)
+    default = geometry.cache
+    cache = geometry.set_cache()
+    try:
+        for i in xrange(2):
+            mask = solar.define_data_mask(data, data_rmin=.5, data_rmax=1.5)
+            assert_array_equal(mask, (R < .5) | (R > 1.5) | np.isnan(data))
+            assert mask.flags.writeable
+        # the second call uses the cache
+        assert_equal((cache.misses, cache.hits), (1, 1))
+        solar.define_data_mask(data, data_rmin=.6)
+        assert_equal((cache.misses, cache.hits), (2, 1))
+    finally:
+        geometry.cache = default
+
+def timed_stack(times):
+    "A stack whose images are observed at times (in seconds)."
+    return as_data_stack(np.zeros((2, 2, len(times))),
+                         [{'TIME':float(t)} for t in times])
+
+def test_convert_times():
+    strs = ['2008-01-01T00:00:00', '2008-01-01T12:30:15.250Z',
+            ' 2010-06-30T23:59:59.5 ']
+    assert_array_almost_equal(solar.convert_times(strs),
+                              [solar.convert_time(t) for t in strs])
+    assert_equal(solar.convert_time(strs[0]), 1199145600.)
+    assert_equal(solar.convert_times([]).shape, (0,))
+
+def test_filter_files():
+    files = []
+    for i, (t, instrume) in enumerate([(3, 'EUVI'), (0, 'EIT'), (1, 'EUVI'),
+                                       (2, 'EUVI'), (5, 'EIT')]):
+        header = {'DATE_OBS':'2008-01-01T%02i:00:00' % t,
+                  'INSTRUME':instrume, 'TELESCOP':'STEREO'}
+        files.append(solar.FileHeader("f%i" % t, header))
+    names = lambda files: [f.filename for f in files]
+    assert_equal(names(solar.filter_files(files)),
+                 ["f0", "f1", "f2", "f3", "f5"])
+    assert_equal(names(solar.filter_files(files, instrume=("EUVI",))),
+                 ["f1", "f2", "f3"])
+    assert_equal(names(solar.filter_files(files, telescop="SOHO")), [])
+    assert_equal(names(solar.filter_files(
+        files, time_window=('2008-01-01T03:00:00', '2008-01-01T01:00:00'))),
+                 ["f1", "f2", "f3"])
+    assert_equal(names(solar.filter_files(files, tmin='2008-01-01T02:00:00')),
+                 ["f2", "f3", "f5"])
+    assert_equal(names(solar.filter_files(files, time_step=7200.)),
+                 ["f0", "f2", "f5"])
+    assert_equal(names(solar.filter_files(files, instrume="EUVI",
+                                          time_step=7200.)), ["f1", "f3"])
+
+def decimate_times_loop(times, time_step):
+    selected = []
+    for i, t in enumerate(times):
+        if len(selected) == 0 or t >= times[selected[-1]] + time_step:
+            selected.append(i)
+    return selected
+
+def test_decimate_times():
+    for n in (0, 1, 2, 7, 100):
+        times = np.sort(np.random.rand(n) * 10.)
+        for time_step in (0., .3, 1., 20.):
+            assert_array_equal(solar.decimate_times(times, time_step),
+                               decimate_times_loop(times, time_step))
+    # with repeated times and indexes
+    times = np.array([0., 0., 1., 1., 2., 3.5])
+    assert_array_equal(solar.decimate_times(times, 1.), [0, 2, 4, 5])
+    assert_array_equal(solar.decimate_times(times, 1., ind=np.arange(6) + 10),
+                       [10, 12, 14, 15])
+
+def test_temporal_groups():
+    data = timed_stack([0., 1., 5., 5.5, 20.])
+    assert_array_equal(solar.temporal_groups_indexes(data, 2.), [0, 2, 4])
+    assert_equal(solar.temporal_groups_index_list(data, 2.),
+                 [[0, 1], [2, 3], [4]])
+    groups = solar.temporal_groups(data, 2.)
+    assert_equal([g.shape[-1] for g in groups], [2, 2, 1])
+    assert_equal(groups[1].header[0]['TIME'], 5.)
+    # a single group
+    assert_array_equal(solar.temporal_groups_indexes(data, 100.), [0])
+    assert_equal(len(solar.temporal_groups(data, 100.)), 1)
+    # every image in its own group
+    assert_array_equal(solar.temporal_groups_indexes(data, 0.), range(5))
+    # single image and no image
+    assert_array_equal(solar.temporal_groups_indexes(timed_stack([3.]), 1.),
+                       [0])
+    assert_equal(len(solar.temporal_groups_indexes(timed_stack([]), 1.)), 0)
+    assert_equal(solar.temporal_groups(timed_stack([]), 1.), [])
+
+def fits_directory(n=4, shape=(8, 6)):
+    """
+    A temporary directory of small FITS files (image i is filled with
+    the value i and observed i hours after the first one), in random
+    order, along with a file which is not a FITS file.
+    """
+    path = tempfile.mkdtemp()
+    for i in np.random.permutation(n):
+        hdu = pyfits.PrimaryHDU(i * np.ones(shape[::-1]))
+        h = hdu.header
+        for k, v in (('INSTRUME', 'EUVI' if i % 2 == 0 else 'EIT'),
+                     ('TELESCOP', 'STEREO'),
+                     ('DATE_OBS', '2008-01-01T%02i:00:00.500' % i),
+                     ('CRLN_OBS', 10. * i), ('CRLT_OBS', 5.),
+                     ('CROTA2', 0.), ('DSUN_OBS', 200. * solar.solar_radius),
+                     ('CRPIX1', 3.), ('CRPIX2', 4.),
+                     ('CDELT1', 2.), ('CDELT2', 2.),
+                     ('CRVAL1', 0.), ('CRVAL2', 0.),
+                     ('CUNIT1', 'arcsec'), ('CUNIT2', 'arcsec')):
+            h.update(k, v)
+        hdu.writeto(os.path.join(path, "im%i.fts" % i))
+    open(os.path.join(path, "notes.txt"), "w").write("not a FITS file")
+    return path
+
+def test_read_headers():
+    path = fits_directory()
+    try:
+        files = solar.read_headers(path, nthread=2)
+        assert_equal(sorted([os.path.basename(f.filename) for f in files]),
+                     ["im%i.fts" % i for i in xrange(4)])
+    finally:
+        shutil.rmtree(path)
+
+def test_read_image():
+    path = fits_directory()
+    try:
+        im = solar.read_image(os.path.join(path, "im1.fts"))
+        # images are transposed
+        assert_equal(im.shape, (8, 6))
+        assert_array_equal(im, 1.)
+        assert_almost_equal(im.header['D'], 200.)
+        assert_almost_equal(im.header['LON'], np.radians(10.))
+        assert_almost_equal(im.header['CDELT1'], 2 * solar.arcsecond_to_radian)
+        assert_equal(im.header['TIME'], solar.convert_time(
+            '2008-01-01T01:00:00.500'))
+        im = solar.read_image(os.path.join(path, "im1.fts"), bin_factor=2)
+        assert_equal(im.shape, (4, 3))
+        assert_almost_equal(im.header['CDELT1'], 4 * solar.arcsecond_to_radian)
+        assert_equal(im.header['CRPIX1'], 1.5)
+    finally:
+        shutil.rmtree(path)
+
+def test_read_data():
+    path = fits_directory()
+    try:
+        for nthread in (1, 3):
+            data = solar.read_data(path, dtype=np.float32, bin_factor=2,
+                                   nthread=nthread)
+            assert_equal(data.shape, (4, 3, 4))
+            assert_equal(data.dtype, np.float32)
+            # sorted by time
+            assert_array_equal(data[0, 0], np.arange(4.))
+            assert_array_equal(data.header['LON'],
+                               np.radians(10. * np.arange(4)))
+            assert_equal(set(data.header['BITPIX']),
+                         set([fa.bitpix_inv['float32']]))
+            assert_array_equal(data.header['NAXIS1'], 4)
+        # filtering
+        data = solar.read_data(path, instrume="EUVI")
+        assert_array_equal(data[0, 0], [0., 2.])
+        data = solar.read_data(path, tmin='2008-01-01T01:00:00',
+                               tmax='2008-01-01T02:30:00')
+        assert_array_equal(data[0, 0], [1., 2.])
+        data = solar.read_data(path, time_step=2 * 3600.)
+        assert_array_equal(data[0, 0], [0., 2.])
+        assert solar.read_data(path, instrume="LASCO") is None
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
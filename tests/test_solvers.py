@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Testing preconditioned solvers.
+"""
+
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy import solvers
+from tomograpy.priors import SmoothnessPrior
+
+hypers = (.1, .1, .1)
+
+def problem():
+    obj = tomograpy.centered_cubic_map(3, 6, fill=0.)
+    obj[2:4, 1:5, 2:5] = 1.
+    data = tomograpy.centered_stack(.05, 8, n_images=6, radius=200., fill=0.)
+    tomograpy.projector(data, obj)
+    P = tomograpy.siddon_lo(data.header, obj.header)
+    D = SmoothnessPrior(obj.shape, weights=.5 + np.random.rand(*obj.shape))
+    return P, data.ravel(), D
+
+def dense_solution(P, b, D):
+    h = solvers.normalize_hypers(hypers, b, P.shape[1])
+    A = solvers.normal_operator(P, D, h)
+    I = np.eye(P.shape[1])
+    A = np.asarray([A(I[i]) for i in xrange(I.shape[0])]).T
+    return np.linalg.solve(A, np.array(P.T * b).ravel()), A
+
+def test_prior_diagonal():
+    P, b, D = problem()
+    DtD = D.normal(hypers)
+    I = np.eye(P.shape[1])
+    diag = [(DtD * I[i])[i] for i in xrange(I.shape[0])]
+    assert_array_almost_equal(D.diagonal(hypers), diag)
+
+def check_solver(solver, precond):
+    P, b, D = problem()
+    x, info = solver(P, b, D, hypers, tol=1e-10, precond=precond,
+                     full_output=True)
+    assert info["converged"]
+    assert_array_almost_equal(x, dense_solution(P, b, D)[0], decimal=6)
+
+def test_solvers():
+    for solver in (solvers.pcg, solvers.plsqr):
+        for precond in (False, True):
+            yield check_solver, solver, precond
+
+def test_masked_model():
+    obj = tomograpy.centered_cubic_map(3, 6, fill=0.)
+    obj[2:4, 1:5, 2:5] = 1.
+    data = tomograpy.centered_stack(.05, 8, n_images=6, radius=200., fill=0.)
+    tomograpy.projector(data, obj)
+    P, D, obj_mask, data_mask = tomograpy.models.srt(data, obj, obj_rmin=1.,
+                                                     decimate=True)
+    # the solver projects in the buffers of the masked projector
+    assert hasattr(P, "buffers")
+    assert P.shape[1] < obj.size
+    b = data.ravel()
+    x, info = solvers.pcg(P, b, D, hypers, tol=1e-10, full_output=True)
+    assert info["converged"]
+    assert_array_almost_equal(x, dense_solution(P, b, D)[0], decimal=6)
+
+def test_angular_subsets():
+    data = tomograpy.centered_stack(.05, 8, n_images=10, radius=200.)
+    subsets = solvers.angular_subsets(data.header, 3)
+    assert_array_equal(np.sort(np.concatenate(subsets)), np.arange(10))
+    assert_array_equal(subsets[0], [0, 3, 6, 9])
+
+def check_subset_projector(nthread):
+    obj = tomograpy.centered_cubic_map(3, 6, fill=1.)
+    data = tomograpy.centered_stack(.05, 8, n_images=6, radius=200., fill=0.)
+    tomograpy.projector(data, obj)
+    S = solvers.OrderedSubsets(data, obj, n_subsets=2, nthread=nthread)
+    for s, index in enumerate(S.subsets):
+        assert_array_almost_equal(S.project(obj, s), data[..., index])
+    assert_array_almost_equal(S.row_sums, data)
+    assert_array_almost_equal(np.sum(S.col_sums, axis=0),
+                              tomograpy.backprojector(data * 0. + 1., obj * 0.))
+
+def test_subset_projector():
+    for nthread in (0, 1):
+        yield check_subset_projector, nthread
+
+def test_os_sart():
+    obj = tomograpy.centered_cubic_map(3, 6, fill=0.)
+    obj[2:4, 1:5, 2:5] = 1.
+    data = tomograpy.centered_stack(.05, 8, n_images=12, radius=200., fill=0.)
+    tomograpy.projector(data, obj)
+    x = solvers.os_sart(data, obj * 0., n_subsets=4, maxiter=20, obstacle=None)
+    assert (x >= 0).all()
+    y = tomograpy.projector(data * 0., x)
+    assert np.linalg.norm(y - data) < .1 * np.linalg.norm(data)
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
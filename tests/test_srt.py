@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""
+Testing batch inversions of the srt command.
+"""
+
+import os
+import shutil
+import tempfile
+import nose
+from numpy.testing import *
+import numpy as np
+import pyfits
+import tomograpy
+from tomograpy import srt_cli
+
+config = """
+[data]
+telescop = STEREOA
+instrument = EUVI
+bin = 1
+time_step = 0
+tmin = 2010-01-01T00:00:00.000
+tmax = 2010-01-15T00:00:00.000
+
+[object]
+naxis = 8, 8, 8
+crpix = 4., 4., 4.
+cdelt = 0.375, 0.375, 0.375
+crval = 0., 0., 0.
+
+[masking]
+obj_rmin = 1
+obj_rmax = 1.5
+data_rmax = 1.3
+data_rmin = 0.
+negative = true
+
+[optimization]
+model = srt
+optimizer = pcg
+hyperparameters = 0.1, 0.1, 0.1
+maxiter = 10
+tol = 1e-10
+"""
+
+jobs_config = """
+[a]
+hyperparameters = 1, 1, 1
+
+[b]
+obj_rmax = 1.4
+compress = true
+output = %s
+"""
+
+# temporary directories removed after the tests
+tmpdirs = []
+
+def teardown():
+    while tmpdirs:
+        shutil.rmtree(tmpdirs.pop(), ignore_errors=True)
+
+def write_files():
+    tmpdir = tempfile.mkdtemp(prefix="test_srt")
+    tmpdirs.append(tmpdir)
+    config_file = os.path.join(tmpdir, "srt.cfg")
+    jobs_file = os.path.join(tmpdir, "jobs.cfg")
+    open(config_file, "w").write(config)
+    open(jobs_file, "w").write(jobs_config % os.path.join(tmpdir, "b.fts"))
+    return tmpdir, config_file, jobs_file
+
+def test_read_jobs():
+    tmpdir, config_file, jobs_file = write_files()
+    jobs = srt_cli.read_jobs(jobs_file, config_file, path="data")
+    assert_equal([j["name"] for j in jobs], ["a", "b"])
+    assert_equal(jobs[0]["output"], "a.fts")
+    assert_equal(jobs[0]["path"], "data")
+    assert_equal(jobs[0]["opt_params"]["hypers"], [1., 1., 1.])
+    assert_equal(jobs[0]["mask_params"]["obj_rmax"], 1.5)
+    assert_equal(jobs[1]["opt_params"]["hypers"], [.1, .1, .1])
+    assert_equal(jobs[1]["mask_params"]["obj_rmax"], 1.4)
+    assert jobs[1]["mask_params"]["compress"]
+
+def test_unknown_option():
+    tmpdir, config_file, jobs_file = write_files()
+    open(jobs_file, "a").write("unknown = 1\n")
+    assert_raises(ValueError, srt_cli.read_jobs, jobs_file, config_file,
+                  path="data")
+
+def simulated_data():
+    obj = tomograpy.centered_cubic_map(3, 8, fill=1.)
+    data = tomograpy.centered_stack(.02, 16, n_images=6, radius=200.,
+                                    max_lon=2 * np.pi, fill=0.)
+    tomograpy.projector(data, obj, obstacle="sun")
+    return data
+
+def test_run_job():
+    tmpdir, config_file, jobs_file = write_files()
+    job = srt_cli.read_jobs(jobs_file, config_file, path="data")[1]
+    data = simulated_data()
+    # the data are mapped read-only as in batch
+    job["data_file"] = os.path.join(tmpdir, "data.npy")
+    job["headers"] = [dict(h) for h in data.header]
+    np.save(job["data_file"], np.asarray(data))
+    output = srt_cli.run_job(job)
+    assert os.path.isfile(output)
+    sol = pyfits.getdata(output)
+    assert_equal(sol.shape, (8, 8, 8))
+    assert np.any(sol != 0)
+
+def test_batch():
+    tmpdir, config_file, jobs_file = write_files()
+    outputs = [os.path.join(tmpdir, name + ".fts") for name in "ab"]
+    open(jobs_file, "w").write("[a]\ncompress = true\noutput = %s\n\n%s"
+                               % (outputs[0], jobs_config % outputs[1]))
+    data = simulated_data()
+    data[0, 0, 0] = np.nan
+    load_data = srt_cli.load_data
+    loaded = []
+    def load(path, data_params):
+        loaded.append(path)
+        return data
+    # the data are read once and shared by the processes of the pool
+    srt_cli.load_data = load
+    try:
+        assert_equal(srt_cli.batch(jobs_file, config_file, path=tmpdir,
+                                   processes=2), outputs)
+    finally:
+        srt_cli.load_data = load_data
+    assert_equal(loaded, [tmpdir])
+    for output in outputs:
+        sol = pyfits.getdata(output)
+        assert_equal(sol.shape, (8, 8, 8))
+        assert np.any(sol != 0)
+
+def test_cache():
+    tmpdir, config_file, jobs_file = write_files()
+    cache_dir = os.path.join(tmpdir, "cache")
+    data = simulated_data()
+    def invert(data=None):
+        params = srt_cli.read_config(config_file, {"compress":"true",
+                                                   "cache":cache_dir})
+        obj_params, data_params, mask_params, opt_params = params
+        return srt_cli.inversion(tmpdir, obj_params, data_params, opt_params,
+                                 mask_params, data=data)
+    sol = invert(data)
+    for stage in ("masks", "coverage", "result"):
+        assert_equal(len(os.listdir(os.path.join(cache_dir, stage))), 1)
+    # the result is read from the cache without data
+    cached = invert()
+    assert_array_equal(cached, sol)
+    assert_equal(cached.header["HYPERS1"], sol.header["HYPERS1"])
+    # masks and coverage are reused for other hyperparameters
+    params = srt_cli.read_config(config_file, {"compress":"true",
+                                               "cache":cache_dir,
+                                               "hyperparameters":"1, 1, 1"})
+    obj_params, data_params, mask_params, opt_params = params
+    srt_cli.inversion(tmpdir, obj_params, data_params, opt_params,
+                      mask_params, data=data)
+    assert_equal(len(os.listdir(os.path.join(cache_dir, "masks"))), 1)
+    assert_equal(len(os.listdir(os.path.join(cache_dir, "result"))), 2)
+
+def test_shared_data():
+    tmpdir, config_file, jobs_file = write_files()
+    data = simulated_data()
+    def invert(data):
+        params = srt_cli.read_config(config_file, {"compress":"true"})
+        obj_params, data_params, mask_params, opt_params = params
+        return srt_cli.inversion(tmpdir, obj_params, data_params, opt_params,
+                                 mask_params, data=data)
+    # read-only data are not masked but masked pixels are not projected
+    shared = tomograpy.stack.as_data_stack(np.array(data), data.header)
+    shared.flags.writeable = False
+    sol = invert(shared)
+    assert_array_equal(shared, data)
+    assert_array_almost_equal(sol, invert(data))
+
+def test_result_sources():
+    tmpdir, config_file, jobs_file = write_files()
+    # the input file is not in the data directory
+    input_file = os.path.join(tmpdir, "input", "x0.fts")
+    os.makedirs(os.path.dirname(input_file))
+    pyfits.writeto(input_file, np.zeros((8, 8, 8)))
+    opt_params = {"input":input_file}
+    sources = srt_cli.result_sources(tmpdir, opt_params)
+    assert_equal(sources[-1][0], input_file)
+    # a modified input file changes the key of the cached result
+    pyfits.writeto(input_file, np.ones((8, 8, 8)), clobber=True)
+    t = os.path.getmtime(input_file) + 10
+    os.utime(input_file, (t, t))
+    assert srt_cli.result_sources(tmpdir, opt_params) != sources
+
+def check_initial_guess(init):
+    tmpdir, config_file, jobs_file = write_files()
+    data = simulated_data()
+    params = srt_cli.read_config(config_file, {"compress":"true"})
+    obj_params, data_params, mask_params, opt_params = params
+    obj = srt_cli.make_object(obj_params)
+    P, D, obj_mask, data_mask = tomograpy.models.srt(data, obj, **mask_params)
+    b = (np.asarray(data) * (1 - data_mask)).ravel()
+    x0 = srt_cli.initial_guess(init, data, obj, P, b, obj_mask, data_mask)
+    assert_equal(x0.size, P.shape[1])
+    r = np.asarray(P * x0).ravel() - b
+    assert np.sum(r ** 2) < .5 * np.sum(b ** 2)
+
+def test_initial_guess():
+    for init in ("fast-bpj", "fast-fbp"):
+        yield check_initial_guess, init
+
+def test_init_option():
+    tmpdir, config_file, jobs_file = write_files()
+    data = simulated_data()
+    def invert(init):
+        params = srt_cli.read_config(config_file, {"init":init,
+                                                   "compress":"true"})
+        obj_params, data_params, mask_params, opt_params = params
+        return srt_cli.inversion(tmpdir, obj_params, data_params, opt_params,
+                                 mask_params, data=data)
+    sol = invert("fast-bpj")
+    assert_equal(sol.header["INIT"], "fast-bpj")
+    assert np.any(sol != 0)
+    assert_raises(ValueError, invert, "ones")
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Testing columnar headers of data stacks.
+"""
+
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+import fitsarray as fa
+from tomograpy.stack import HeaderTable, DataStack, as_data_stack
+
+def headers(n=5):
+    return [{'CRPIX1':float(i), 'D':10. + i, 'NAME':'im%i' % i}
+            for i in xrange(n)]
+
+def test_column():
+    h = HeaderTable(headers())
+    assert_array_equal(h['CRPIX1'], np.arange(5.))
+    assert_equal(h[2]['NAME'], 'im2')
+
+def test_row_update():
+    h = HeaderTable(headers())
+    h['D']
+    h[3]['D'] = -1.
+    assert_equal(h['D'][3], -1.)
+
+def test_column_update():
+    h = HeaderTable(headers())
+    h['D'] = np.zeros(5)
+    assert_equal(h[4]['D'], 0.)
+    h[1:3]['D'] = 1.
+    assert_array_equal(h['D'], [0., 1., 1., 0., 0.])
+
+def test_views_share_headers():
+    h = HeaderTable(headers())
+    s = h[::-1]
+    assert_array_equal(s['CRPIX1'], np.arange(5.)[::-1])
+    s[0]['CRPIX1'] = 42.
+    assert_equal(h['CRPIX1'][-1], 42.)
+
+def test_list_mutation():
+    h = HeaderTable(headers())
+    h.append({'CRPIX1':5., 'D':15., 'NAME':'im5'})
+    assert_array_equal(h['CRPIX1'], np.arange(6.))
+    assert_array_equal(h.column('X', default=0.), np.zeros(6))
+
+def test_data_stack_slicing():
+    data = as_data_stack(np.zeros((2, 3, 5)), headers())
+    assert_array_equal(data[..., 1:3].header['CRPIX1'], [1., 2.])
+    assert_array_equal(data[:, :, [4, 0]].header['CRPIX1'], [4., 0.])
+    assert_equal(data[..., 2].header['NAME'], 'im2')
+
+def test_projector():
+    obj = tomograpy.centered_cubic_map(3, 8, fill=1.)
+    data1 = tomograpy.centered_stack(.5, 8, n_images=4, radius=200., fill=0.)
+    data0 = fa.InfoArray(data=data1.copy(),
+                         header=[dict(h) for h in data1.header])
+    tomograpy.projector(data0, obj)
+    tomograpy.projector(data1, obj)
+    assert_array_almost_equal(data0, data1)
+
+def test_header_columns():
+    h = headers()
+    del h[2]['D']
+    h[3]['X'] = None
+    columns, missing = tomograpy.stack.header_columns(h)
+    assert_array_equal(columns['CRPIX1'], np.arange(5.))
+    assert_equal(columns['NAME'][1], 'im1')
+    assert_equal(columns['X'].dtype, object)
+    assert_array_equal(missing['D'], [False, False, True, False, False])
+    table = tomograpy.stack.header_table_from_columns(columns, missing)
+    assert_equal(list(table), h)
+    assert_array_equal(table['CRPIX1'], np.arange(5.))
+
+def test_mixed_numbers():
+    h = headers()
+    for i in xrange(5):
+        h[i]['NAXIS'] = 2
+        h[i]['EXPTIME'] = 10 if i % 2 else 10.5
+    columns, missing = tomograpy.stack.header_columns(h)
+    assert_equal(columns['NAXIS'].dtype.kind, 'i')
+    assert_equal(columns['EXPTIME'].dtype, object)
+    table = tomograpy.stack.header_table_from_columns(columns, missing)
+    assert_array_equal(table['EXPTIME'], [10.5, 10, 10.5, 10, 10.5])
+    assert_equal(type(table[0]['NAXIS']), int)
+    assert_equal(type(table[1]['EXPTIME']), int)
+    assert_equal(type(table[2]['EXPTIME']), float)
+
+def test_lazy_headers():
+    columns, missing = tomograpy.stack.header_columns(headers())
+    table = tomograpy.stack.header_table_from_columns(columns, missing)
+    # columns, lengths and views do not build the headers
+    assert_equal(len(table), 5)
+    assert_array_equal(table['CRPIX1'], np.arange(5.))
+    assert_array_equal(table['NAME'], ['im%i' % i for i in xrange(5)])
+    assert table.has_column('D')
+    s = table[::2]
+    assert_equal(len(s), 3)
+    assert_array_equal(s['D'], [10., 12., 14.])
+    assert not table._store.built
+    # the headers are built on access and shared by the views
+    assert_equal(s[1]['NAME'], 'im2')
+    assert table._store.built
+    assert_equal(list(table), headers())
+    table[2]['D'] = -1.
+    assert_equal(s['D'][1], -1.)
+    table.append({'CRPIX1':5., 'D':15., 'NAME':'im5'})
+    assert_array_equal(table['CRPIX1'], np.arange(6.))
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+Testing streaming projections.
+"""
+
+import os
+import tempfile
+import threading
+import time
+import nose
+from numpy.testing import *
+import numpy as np
+import pyfits
+import fitsarray as fa
+import tomograpy
+from tomograpy import streaming
+
+def problem(n_images=10):
+    obj = tomograpy.centered_cubic_map(3, 8)
+    obj[:] = np.random.rand(*obj.shape)
+    data = tomograpy.centered_stack(.05, 16, n_images=n_images, radius=200.,
+                                    max_lon=2 * np.pi, fill=0.)
+    data[:] = np.random.rand(*data.shape) - .2
+    return data, obj
+
+def images(data):
+    for i in xrange(data.shape[-1]):
+        yield fa.InfoArray(data=np.array(data[..., i]),
+                           header=dict(data.header[i]))
+
+def test_prefetch():
+    state = {"running":0, "max":0}
+    lock = threading.Lock()
+    def func(i):
+        with lock:
+            state["running"] += 1
+            state["max"] = max(state["max"], state["running"])
+        time.sleep(.001)
+        with lock:
+            state["running"] -= 1
+        return 2 * i
+    out = list(streaming.prefetch(func, iter(xrange(50)), nthread=4, depth=3))
+    assert_equal(out, range(0, 100, 2))
+    assert state["max"] <= 3
+
+def test_batches():
+    data, obj = problem(10)
+    sizes = [b.shape[-1] for b in streaming.batches(images(data), 4)]
+    assert_equal(sizes, [4, 4, 2])
+    last = list(streaming.batches(images(data), 4))[-1]
+    assert_array_equal(last, data[..., 8:])
+    assert_equal(last.header[1]["LON"], data.header[9]["LON"])
+
+def check_backprojector(batch_size, mask_params):
+    data, obj = problem()
+    mask = None
+    if mask_params is not None:
+        mask = tomograpy.solar.define_data_mask(data, **mask_params)
+    ref = tomograpy.backprojector(data, obj * 0., mask=mask, obstacle="sun")
+    cube = streaming.stream_backprojector(images(data), obj * 0.,
+                                          batch_size=batch_size,
+                                          mask_params=mask_params,
+                                          obstacle="sun")
+    assert_array_almost_equal(cube, ref)
+
+def test_backprojector():
+    for batch_size in (1, 3, 16):
+        yield check_backprojector, batch_size, None
+    yield check_backprojector, 4, {"mask_negative":True}
+
+def test_projector():
+    data, obj = problem()
+    ref = tomograpy.projector(data.copy(), obj, obstacle="sun",
+                              accumulate=False)
+    filename = os.path.join(tempfile.mkdtemp(), "pj.npy")
+    out = streaming.stream_projector(obj, data.header, filename,
+                                     batch_size=3, obstacle="sun")
+    assert_array_almost_equal(out, ref)
+    stored = np.load(filename, mmap_mode="r")
+    assert stored.flags.f_contiguous
+    assert_array_almost_equal(stored, ref)
+    assert_equal(out.header[4]["LON"], data.header[4]["LON"])
+
+def test_read_images():
+    tmpdir = tempfile.mkdtemp()
+    header = {"CRLN_OBS":10., "CRLT_OBS":2., "CROTA2":0., "DSUN_OBS":1.5e11,
+              "CDELT1":2., "CDELT2":2., "CRVAL1":0., "CRVAL2":0.,
+              "CUNIT1":"arcsec", "CUNIT2":"arcsec", "CRPIX1":4., "CRPIX2":4.,
+              "DATE_OBS":"2010-01-01T00:00:00.000"}
+    files = []
+    for i in xrange(3):
+        h = pyfits.Header()
+        for k, v in header.iteritems():
+            h.update(k, v)
+        files.append(os.path.join(tmpdir, "%i.fits" % i))
+        pyfits.writeto(files[-1], i * np.ones((8, 6)), h)
+    out = list(streaming.read_images(files, bin_factor=2, nthread=2))
+    assert_equal(len(out), 3)
+    assert_equal(out[2].shape, (3, 4))
+    assert_array_equal(out[2], 2.)
+    assert_almost_equal(out[0].header["LON"], np.radians(10.))
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
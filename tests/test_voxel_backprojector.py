@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Testing the voxel-driven backprojector.
+"""
+
+import nose
+from numpy.testing import *
+import numpy as np
+import tomograpy
+from tomograpy import voxel_backprojector as vb
+
+def problem(n_pixels=128):
+    obj = tomograpy.centered_cubic_map(3, 16)
+    x, y, z = np.ogrid[-7.5:8., -7.5:8., -7.5:8.]
+    obj[:] = np.exp(- np.sqrt(x ** 2 + y ** 2 + z ** 2) / 3.)
+    data = tomograpy.centered_stack(.05, n_pixels, n_images=32, radius=200.,
+                                    max_lon=2 * np.pi, fill=0.)
+    tomograpy.projector(data, obj)
+    return data, obj
+
+def check_backprojector(obstacle):
+    data, obj = problem()
+    ref = tomograpy.backprojector(data, obj * 0., obstacle=obstacle)
+    x = vb.fast_backprojector(data, obj, obstacle=obstacle, nthread=2)
+    assert_equal(x.header, obj.header)
+    assert_almost_equal(x.sum() / ref.sum(), 1., decimal=1)
+    assert np.corrcoef(x.ravel(), ref.ravel())[0, 1] > .8
+
+def test_backprojector():
+    yield check_backprojector, None
+    yield check_backprojector, "sun"
+
+def test_chunks():
+    data, obj = problem(32)
+    x1 = vb.fast_backprojector(data, obj, nthread=1)
+    x2 = vb.fast_backprojector(data, obj, nthread=3, chunk_size=100)
+    assert_array_almost_equal(x1, x2)
+
+def test_mask():
+    data, obj = problem(32)
+    mask = np.ones(data.shape, dtype=bool)
+    x = vb.fast_backprojector(data, obj, mask=mask)
+    assert_array_equal(x, 0.)
+
+def test_filtered():
+    data, obj = problem()
+    x = vb.fast_backprojector(data, obj, filtered=True)
+    assert np.corrcoef(x.ravel(), obj.ravel())[0, 1] > .99
+    assert_almost_equal(x.sum() / obj.sum(), 1., decimal=1)
+
+def test_hidden():
+    M = np.asarray([10., 0., 0.])
+    X = np.asarray([[2., 0., 0.], [-2., 0., 0.], [-2., 2., 0.], [.5, 0., 0.]])
+    W = X - M
+    r = np.sqrt(np.sum(W ** 2, axis=-1))
+    assert_array_equal(vb._hidden(M, W, r), [False, True, False, True])
+
+def test_scale_to_data():
+    data, obj = problem(32)
+    P = tomograpy.siddon_lo(data.header, obj.header)
+    x = vb.scale_to_data(.1 * np.asarray(obj).ravel(), P, data)
+    assert_array_almost_equal(x, np.asarray(obj).ravel())
+
+if __name__ == "__main__":
+    nose.run(argv=['', __file__])
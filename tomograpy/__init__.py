@@ -11,6 +11,27 @@ python. It is made of several modules, as follows:
 - solar: A module to load Solar physics data with appropriate
   metadata.
 
+- catalog: A persistent catalog of the headers of a data directory.
+
+- stack: Data stacks whose headers can be accessed as columns.
+
+- geometry: Cached geometric maps (radius, cylinder) of map headers.
+
+- priors: Smoothness priors and their fused normal operator.
+
+- solvers: Preconditioned (pcg, plsqr) and ordered subsets (os_sart)
+  solvers.
+
+- checkpoint: Asynchronous checkpoints of solvers to resume inversions.
+
+- cache: A content-addressed disk cache of the stages of inversions.
+
+- prepared: Prepared data stacks stored in a memory-mappable format.
+
+- incremental: Sliding window reconstructions with warm starts.
+
+- multigrid: Coarse-to-fine inversions on map and data pyramids.
+
 - models: Defines linear model linking the data with the parameters
   to estimate (emission maps, density maps).
 
@@ -32,8 +53,18 @@ type "srt -h".
 """
 
 from siddon import *
+import numpy_siddon
+import voxel_backprojector
+import shear_warp
+import streaming
 import simu
 import solar
+import catalog
+import stack
+import geometry
+import checkpoint
+import cache
+import prepared
 import phantom
 import models
 import display
@@ -46,6 +77,10 @@ except ImportError:
 
 if 'lo' in locals():
     from lo_wrapper import *
+    import priors
+    import solvers
+    import incremental
+    import multigrid
 
 
 version = "0.3.0"
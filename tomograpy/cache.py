@@ -0,0 +1,142 @@
+"""
+A content-addressed cache of the stages of an inversion.
+
+Each stage (data loading, masks, coverage, solution, ...) stores its
+outputs on disk under a key computed from its inputs (see
+checkpoint.config_key). The key of the data stage includes the names,
+sizes and modification times of the files of the data directory so
+that modified data are read again. Later stages include the key of the
+stages they depend on.
+
+An entry is a directory holding one .npy file per array and a pickle
+of other metadata (headers, ...). Entries are written in a temporary
+directory which is then renamed, so that an interrupted write never
+leaves a partial entry.
+
+Exemple
+-------
+>>> cache = StageCache("/tmp/srt_cache")
+>>> key = cache.key(directory_state(path), data_params)
+>>> entry = cache.load("data", key)
+>>> if entry is None:
+...     data = solar.read_data(path, **data_params)
+...     cache.save("data", key, {"data":data}, header=list(data.header))
+"""
+import os
+import shutil
+import tempfile
+import cPickle as pickle
+import numpy as np
+from checkpoint import config_key
+
+class StageCache(object):
+    """
+    Outputs of the stages of inversions stored in a directory.
+
+    Arguments
+    ---------
+    directory: str
+      The cache directory (created if needed).
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, *args):
+        "A key identifying the inputs of a stage (see config_key)."
+        return config_key(*args)
+
+    def entry(self, stage, key):
+        "The directory of an entry."
+        return os.path.join(self.directory, stage, key)
+
+    def has(self, stage, key):
+        return os.path.isdir(self.entry(stage, key))
+
+    def load(self, stage, key, mmap_mode=None):
+        """
+        Returns the arrays and metadata of an entry as a dict or None
+        if there is no such entry. Arrays can be memory-mapped (see
+        numpy.load).
+        """
+        entry = self.entry(stage, key)
+        if not os.path.isdir(entry):
+            return None
+        f = open(os.path.join(entry, "meta.pkl"), "rb")
+        try:
+            out = pickle.load(f)
+        finally:
+            f.close()
+        for fname in os.listdir(entry):
+            if fname.endswith(".npy"):
+                out[fname[:-4]] = np.load(os.path.join(entry, fname),
+                                          mmap_mode=mmap_mode)
+        return out
+
+    def save(self, stage, key, arrays=None, **meta):
+        """
+        Store the arrays (a dict of ndarrays) and metadata (picklable
+        keyword arguments) of an entry.
+        """
+        stage_dir = os.path.join(self.directory, stage)
+        if not os.path.isdir(stage_dir):
+            os.makedirs(stage_dir)
+        tmp = tempfile.mkdtemp(prefix=key, dir=stage_dir)
+        try:
+            for name, a in (arrays or {}).iteritems():
+                np.save(os.path.join(tmp, name + ".npy"), np.asarray(a))
+            f = open(os.path.join(tmp, "meta.pkl"), "wb")
+            try:
+                pickle.dump(meta, f, 2)
+            finally:
+                f.close()
+            entry = self.entry(stage, key)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # written by another process in the meantime
+                if not os.path.isdir(entry):
+                    raise
+                shutil.rmtree(tmp)
+        except:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            raise
+
+    def clear(self, stage=None):
+        """
+        Remove the entries of a stage (or all entries).
+        """
+        if stage is None:
+            target = self.directory
+        else:
+            target = os.path.join(self.directory, stage)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+def directory_state(path):
+    """
+    The names, sizes and modification times of the files of a
+    directory (ignoring the header catalog), as a sorted list.
+    """
+    from catalog import catalog_name
+    state = []
+    for fname in sorted(os.listdir(path)):
+        if fname.startswith(catalog_name):
+            continue
+        full_name = os.path.join(path, fname)
+        if not os.path.isfile(full_name):
+            continue
+        st = os.stat(full_name)
+        state.append((fname, st.st_size, st.st_mtime))
+    return state
+
+def file_state(filename):
+    """
+    The name, size and modification time of a file.
+    """
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_size, st.st_mtime)
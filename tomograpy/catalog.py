@@ -0,0 +1,175 @@
+"""
+A persistent catalog of the FITS headers of a data directory.
+
+The keywords required to select files (observation time, instrument,
+telescope, ...) are stored along with file sizes and modification
+times in a SQLite file in the data directory (or in the user cache
+directory if the data directory is read-only). The catalog is updated
+incrementally: only new or modified files are opened. Files can then
+be selected by time window, instrument, telescope and cadence without
+opening any FITS file.
+
+Exemple
+-------
+>>> cat = Catalog(path)
+>>> cat.update()
+>>> files = cat.query(instrume=("EUVI",), tmin="2010-01-01T00:00:00")
+"""
+import os
+import hashlib
+import sqlite3
+import pyfits
+import solar
+
+# default name of the catalog file in the data directory
+catalog_name = ".tomograpy_catalog.sqlite"
+
+# directory of the catalogs of read-only data directories
+user_catalog_directory = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join("~", ".cache")),
+    "tomograpy", "catalogs")
+
+# header keywords stored in the catalog
+keywords = ['DATE_OBS', 'INSTRUME', 'TELESCOP', 'DETECTOR', 'WAVELNTH',
+            'EXPTIME', 'NAXIS1', 'NAXIS2']
+
+class Catalog(object):
+    """
+    A catalog of the headers of the FITS files of a directory.
+
+    Arguments
+    ---------
+    path: str
+      The data directory.
+    filename: str (optional)
+      The catalog file name. Defaults to catalog_filename(path).
+    """
+    def __init__(self, path, filename=None):
+        if not os.path.isdir(path):
+            raise ValueError('Directory does not exist')
+        self.path = path
+        if filename is None:
+            filename = catalog_filename(path)
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        columns = ", ".join(['"%s"' % k for k in keywords])
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, "
+                "size INTEGER, mtime REAL, is_fits INTEGER, time REAL, "
+                + columns + ")")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS files_time ON files (time)")
+
+    def update(self, nthread=None):
+        """
+        Update the catalog with the current content of the directory.
+        Only new or modified files are read, removed files are dropped.
+
+        Returns
+        -------
+        The number of files which have been read.
+        """
+        # current state of the directory
+        ignored = os.path.basename(self.filename)
+        current = dict()
+        for fname in os.listdir(self.path):
+            if fname.startswith(ignored):
+                continue
+            full_name = os.path.join(self.path, fname)
+            if not os.path.isfile(full_name):
+                continue
+            st = os.stat(full_name)
+            current[fname] = (st.st_size, st.st_mtime)
+        # state stored in the catalog
+        stored = dict()
+        for fname, size, mtime in self.connection.execute(
+            "SELECT filename, size, mtime FROM files"):
+            stored[fname] = (size, mtime)
+        removed = [(f,) for f in stored if f not in current]
+        changed = [f for f in current if stored.get(f) != current[f]]
+        # read headers of new or modified files only
+        def read_one(fname):
+            size, mtime = current[fname]
+            try:
+                header = pyfits.getheader(os.path.join(self.path, fname), 0)
+            except(IOError):
+                return (fname, size, mtime, 0, None) + len(keywords) * (None,)
+            values = [_sql_value(header.get(k, None)) for k in keywords]
+            try:
+                time_val = solar.convert_time(header['DATE_OBS'])
+            except(KeyError, ValueError):
+                time_val = None
+            return (fname, size, mtime, 1, time_val) + tuple(values)
+        rows = solar._thread_map(read_one, changed, nthread=nthread)
+        marks = ", ".join((5 + len(keywords)) * ["?"])
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM files WHERE filename = ?", removed)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (" + marks + ")", rows)
+        return len(rows)
+
+    def query(self, instrume=None, telescop=None, time_window=None,
+              time_step=None, tmin=None, tmax=None):
+        """
+        Select files with the same arguments as solar.filter_files.
+
+        Returns
+        -------
+        A list of solar.FileHeader sorted by observation time. The
+        headers only contain the keywords of the catalog.
+        """
+        # files without a valid DATE_OBS cannot be sorted nor selected
+        conditions = ["is_fits = 1", "time IS NOT NULL"]
+        values = list()
+        for key, accepted in (("INSTRUME", instrume), ("TELESCOP", telescop)):
+            if accepted is not None:
+                if isinstance(accepted, basestring):
+                    accepted = (accepted,)
+                conditions.append('"%s" IN (%s)' % (key, ", ".join(len(accepted) * ["?"])))
+                values += list(accepted)
+        time_min, time_max = solar.time_limits(time_window, tmin, tmax)
+        if time_min is not None:
+            conditions.append("time >= ?")
+            values.append(time_min)
+        if time_max is not None:
+            conditions.append("time <= ?")
+            values.append(time_max)
+        columns = ", ".join(['"%s"' % k for k in keywords])
+        rows = self.connection.execute(
+            "SELECT filename, " + columns + " FROM files WHERE "
+            + " AND ".join(conditions) + " ORDER BY time", values)
+        files = list()
+        for row in rows:
+            header = dict([(k, v) for k, v in zip(keywords, row[1:])
+                           if v is not None])
+            files.append(solar.FileHeader(os.path.join(self.path, row[0]),
+                                          header))
+        # cadence decimation
+        if time_step is not None:
+            files = solar.filter_files(files, time_step=time_step)
+        return files
+
+    def close(self):
+        self.connection.close()
+
+def catalog_filename(path):
+    """
+    The default catalog file of a data directory: catalog_name in the
+    directory if it is writable, otherwise a file of the user cache
+    directory (user_catalog_directory) named after the directory path.
+    """
+    if os.access(path, os.W_OK):
+        return os.path.join(path, catalog_name)
+    directory = os.path.expanduser(user_catalog_directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    key = hashlib.sha1(os.path.abspath(path)).hexdigest()
+    return os.path.join(directory, key + ".sqlite")
+
+def _sql_value(value):
+    "Convert a header value into a value which can be stored by sqlite."
+    if value is None or isinstance(value, (int, long, float, basestring)):
+        return value
+    return str(value)
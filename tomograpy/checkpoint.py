@@ -0,0 +1,158 @@
+"""
+Checkpoints of iterative solvers.
+
+A Checkpoint periodically saves the state of a solver (current
+iterate, search direction, iteration number, ...) in a .npz file along
+with a key identifying the configuration of the inversion. Writes are
+done in a background thread so that they do not stall the solver. If
+a write is still running when a new state is saved, only the most
+recent pending state is written afterwards.
+
+Solvers of the solvers module accept a checkpoint argument and resume
+from the saved state if there is one. lo optimizers can save their
+iterate with lo_callback.
+
+Exemple
+-------
+>>> ckpt = Checkpoint("srt.checkpoint.npz", every=10, key=config_key(params))
+>>> x = solvers.pcg(P, b, D, hypers, checkpoint=ckpt)
+>>> # after an interruption, the same call resumes the inversion
+"""
+import os
+import hashlib
+import threading
+import numpy as np
+
+class Checkpoint(object):
+    """
+    Periodic and asynchronous saving of the state of a solver.
+
+    Arguments
+    ---------
+    filename: str
+      The checkpoint file (.npz).
+    every: int
+      Save the state every "every" iterations.
+    key: str (optional)
+      Identifies the configuration of the inversion. A saved state with
+      another key is not loaded.
+    """
+    def __init__(self, filename, every=10, key=None):
+        if every < 1:
+            raise ValueError("every should be a positive integer.")
+        self.filename = filename
+        self.every = every
+        self.key = key
+        self._lock = threading.Lock()
+        self._pending = None
+        self._thread = None
+
+    def load(self):
+        """
+        Returns the saved state as a dict (with an "iteration" item) or
+        None if there is no checkpoint file.
+        """
+        self.wait()
+        if not os.path.isfile(self.filename):
+            return None
+        f = np.load(self.filename)
+        try:
+            state = dict([(k, f[k]) for k in f.files])
+        finally:
+            f.close()
+        key = str(state.pop("key", ""))
+        if self.key is not None and key != self.key:
+            raise ValueError("Checkpoint " + self.filename +
+                             " was saved with another configuration.")
+        for k in state:
+            if state[k].ndim == 0:
+                state[k] = state[k].item()
+        return state
+
+    def save(self, state, iteration):
+        """
+        Save a state (a dict of arrays and scalars) if iteration is a
+        multiple of every. Arrays are copied, the file is written in a
+        background thread.
+        """
+        if iteration % self.every != 0:
+            return
+        state = dict([(k, np.array(v)) for k, v in state.iteritems()])
+        state["iteration"] = np.array(iteration)
+        state["key"] = np.array(self.key or "")
+        with self._lock:
+            self._pending = state
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def wait(self):
+        """
+        Wait for pending writes.
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def remove(self):
+        """
+        Remove the checkpoint file.
+        """
+        self.wait()
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                state, self._pending = self._pending, None
+                if state is None:
+                    self._thread = None
+                    return
+            self._write(state)
+
+    def _write(self, state):
+        # write to a temporary file first so that an interruption never
+        # leaves a corrupted checkpoint
+        tmp = self.filename + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            np.savez(f, **state)
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+
+def config_key(*args):
+    """
+    A hash of the parameters of an inversion (dicts, tuples, scalars
+    or functions, which are identified by their name).
+    """
+    return hashlib.sha1(repr([_canonical(a) for a in args])).hexdigest()
+
+def _canonical(a):
+    if isinstance(a, dict):
+        return sorted([(k, _canonical(v)) for k, v in a.iteritems()])
+    if isinstance(a, (list, tuple)):
+        return [_canonical(v) for v in a]
+    if isinstance(a, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(a).tostring()).hexdigest()
+    if callable(a):
+        return getattr(a, "__name__", repr(a))
+    return a
+
+def lo_callback(checkpoint, start=0):
+    """
+    A callback for lo optimizers saving the current iterate. start is
+    the number of iterations done before a resumed run.
+
+    lo optimizers restart their search direction at each call, so a
+    resumed run continues from the saved iterate.
+    """
+    import inspect
+    def callback(x):
+        # the iteration number is a local of the calling optimizer (as
+        # with lo.CallbackFactory)
+        iteration = inspect.currentframe().f_back.f_locals["iter_"]
+        checkpoint.save({"x":x}, start + iteration)
+    return callback
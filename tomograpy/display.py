@@ -3,6 +3,9 @@ import numpy as np
 from matplotlib import pyplot as plt
 from scipy.ndimage import map_coordinates
 
+# default number of images interpolated at once by extract_sinogram
+SINOGRAM_CHUNK = 16
+
 def data_movie(data, fig=None, pause=None, **kwargs):
     """
     Display all images of a data cube as a movie.
@@ -35,7 +38,8 @@ def data_movie(data, fig=None, pause=None, **kwargs):
         if pause is not None:
             time.sleep(pause)
 
-def sinogram(data, r, amin=-np.pi, amax=np.pi, n=None, fig=None, **kwargs):
+def sinogram(data, r, amin=-np.pi, amax=np.pi, n=None, fig=None,
+             chunk=None, **kwargs):
     """
     Display a sinogram of the data set.
 
@@ -43,44 +47,100 @@ def sinogram(data, r, amin=-np.pi, amax=np.pi, n=None, fig=None, **kwargs):
     ---------
     data: ndarray
       A data cube. Third dimension should be the image index.
-    r: float
-      The radius of the circle along which the sinogram is interpolated.
-    rsun: boolean
-      If true, r is the radius relative to the solar radius in the image.
+    r: float or sequence of floats
+      The radius of the circle along which the sinogram is interpolated,
+      in solar radii (r=1 is the limb). If a sequence is given, one
+      sinogram is computed per radius in a single pass.
     amin, amax: float (optional)
       Minimal and maximal angle. If not given amin=-pi and amax = pi.
     n: int (optional)
       Number of angular pixels. If not given, equals max of data.shape[0:2]
     fig: Figure instance (optional).
        A figure instance where the images will be displayed.
+    chunk: int (optional)
+       Number of images interpolated at once (SINOGRAM_CHUNK by default).
     kwargs: Keywor arguments.
        Other keyword arguments are passed to imshow.
     
     Return
     ------
-    Returns the sinogram as a ndarray.
+    Returns the sinogram as a ndarray (see extract_sinogram).
+    """
+    sino = extract_sinogram(data, r, amin=amin, amax=amax, n=n, chunk=chunk)
+    # display sinogram(s), several radii are stacked along the angle axis
+    if sino.ndim == 3:
+        sino_im = np.concatenate([sino[..., k] for k in xrange(sino.shape[-1])])
+    else:
+        sino_im = sino
+    if fig is None:
+        fig = plt.figure()
+    ax = fig.gca()
+    im0 = ax.imshow(sino_im, origin="lower", **kwargs)
+    plt.draw()
+    return sino
+
+def extract_sinogram(data, r, amin=-np.pi, amax=np.pi, n=None, chunk=None):
+    """
+    Interpolate the data set along circles centered on the Sun.
+
+    The interpolation coordinates of all radii and of a chunk of images
+    are built at once and interpolated in a single call to
+    map_coordinates.
+
+    Arguments
+    ---------
+    data: InfoArray
+      A data cube. Third dimension should be the image index.
+    r: float or sequence of floats
+      Radii of the circles in solar radii: r=1 is the limb (the
+      solar radius in pixels is given by solar.compute_rsun).
+    amin, amax: float (optional)
+      Minimal and maximal angle. If not given amin=-pi and amax = pi.
+    n: int (optional)
+      Number of angular pixels. If not given, equals max of data.shape[0:2]
+    chunk: int (optional)
+       Number of images interpolated at once (SINOGRAM_CHUNK by
+       default). Bounds the size of the spline prefilter of
+       map_coordinates.
+
+    Returns
+    -------
+    sino: ndarray
+      The sinogram of shape (n, data.shape[-1]) if r is a scalar or a
+      stack of sinograms of shape (n, data.shape[-1], len(r)).
     """
     from solar import compute_rsun
+    from stack import get_column
     # handle kwargs
     if n is None:
         n = np.max(data.shape[0:2])
-    # interpolat each frame
+    n_images = data.shape[-1]
+    if chunk is None:
+        chunk = SINOGRAM_CHUNK
+    is_scalar = np.isscalar(r)
+    r = np.atleast_1d(r).astype(np.float64)
+    # gather image metadata once
+    roll = np.radians(get_column(data.header, 'SC_ROLL', 0.))
+    # CRPIX is one-based (see siddon.pixel2physical)
+    crpix1 = get_column(data.header, 'CRPIX1', 1.) - 1.
+    crpix2 = get_column(data.header, 'CRPIX2', 1.) - 1.
+    rsun = compute_rsun(data)[0]
     a = np.linspace(amin, amax, n)
-    sino = np.zeros((n, data.shape[-1]))
-    rsun = compute_rsun(data)
-    for i in xrange(data.shape[-1]):
-        # generate interpolation grid
-        a0 = a - np.radians(data[i].header.get('SC_ROLL', 0.)[i])
-        r0 = r * rsun[i] / 2
-        x = r0 * np.cos(a0) + data[i].header.get('CRPIX1', 0.)[i]
-        y = r0 * np.sin(a0) + data[i].header.get('CRPIX2', 0.)[i]
-        sino[..., i] = map_coordinates(data[..., i], (x, y))
-    # display sinogram
-    if fig is None:
-        fig = plt.figure()
-    ax = fig.gca()
-    im0 = ax.imshow(sino, origin="lower", **kwargs)
-    plt.draw()
+    # interpolate chunks of images. The image index is always an integer
+    # so the interpolation along the last axis selects the exact frame.
+    sino = np.empty((n, n_images, r.size))
+    for i in xrange(0, n_images, chunk):
+        s = slice(i, i + chunk)
+        # interpolation grid of all images of the chunk and radii at once
+        a0 = a[:, np.newaxis] - roll[np.newaxis, s]
+        r0 = r[np.newaxis] * rsun[s, np.newaxis]
+        ci = np.empty((3,) + a0.shape + r.shape)
+        ci[0] = np.cos(a0)[..., np.newaxis] * r0 + crpix1[s, np.newaxis]
+        ci[1] = np.sin(a0)[..., np.newaxis] * r0 + crpix2[s, np.newaxis]
+        ci[2] = np.arange(a0.shape[1])[:, np.newaxis]
+        sino[:, s] = map_coordinates(np.asarray(data[..., s]), ci)
+    if is_scalar:
+        sino = sino[..., 0]
     return sino
 
 def display_object(obj):
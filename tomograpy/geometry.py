@@ -0,0 +1,197 @@
+"""
+Geometric quantities derived from map headers, computed once.
+
+Maps of the distance to the Sun center, cylinder masks or Thomson
+scattering coefficients only depend on the map header. They are
+computed lazily and kept in a cache keyed by a hash of the keywords
+defining the map grid (NAXIS, CRPIX, CDELT and CRVAL). The cache is
+a LRU cache with a memory limit. The geometric data masks of
+solar.geometric_data_mask are kept in the same cache. Entries can
+optionally be persisted in a directory as .npy files and
+memory-mapped.
+
+Arrays returned by the cache are shared and thus read-only.
+
+Exemple
+-------
+>>> R = radius(cube.header) # computed
+>>> R = radius(cube.header) # from the cache
+>>> set_cache(max_bytes=2 ** 28, directory="/tmp/geometry")
+"""
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+# default memory limit of the cache in bytes
+default_max_bytes = 2 ** 30
+
+class GeometryCache(object):
+    """
+    A LRU cache of arrays computed from map headers.
+
+    Arguments
+    ---------
+    max_bytes: int (optional)
+      Total size of the arrays kept in the cache. The least recently
+      used arrays are dropped above this limit.
+    directory: str (optional)
+      If given, arrays are saved in this directory and memory-mapped.
+      Saved arrays are reused by later sessions.
+    """
+    def __init__(self, max_bytes=None, directory=None):
+        if max_bytes is None:
+            max_bytes = default_max_bytes
+        self.max_bytes = max_bytes
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.entries = OrderedDict()
+        # number of lookups found in the cache or computed
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        return sum([a.nbytes for a in self.entries.itervalues()])
+
+    def get(self, name, header, compute, *args):
+        """
+        Returns compute(header, *args), computed only if it is not
+        already in the cache.
+        """
+        key = name + "_" + header_key(header, *args)
+        return self.get_key(key, compute, header, *args)
+
+    def get_key(self, key, compute, *args):
+        """
+        Returns compute(*args), computed only if there is no entry
+        under key (a string usable as a file name).
+        """
+        out = self.entries.pop(key, None)
+        if out is None:
+            out = self._load(key)
+        if out is None:
+            self.misses += 1
+            out = np.asarray(compute(*args))
+            out = self._save(key, out)
+            out.flags.writeable = False
+        else:
+            self.hits += 1
+        self.entries[key] = out
+        self._evict()
+        return out
+
+    def clear(self):
+        self.entries.clear()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def _load(self, key):
+        if self.directory is None or not os.path.isfile(self._filename(key)):
+            return None
+        return np.load(self._filename(key), mmap_mode="r")
+
+    def _save(self, key, arr):
+        if self.directory is None:
+            return arr
+        # written in a temporary file which is then renamed, so that
+        # concurrent processes never map a partial file
+        fd, tmp = tempfile.mkstemp(prefix=key, suffix=".npy",
+                                   dir=self.directory)
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                np.save(f, arr)
+            finally:
+                f.close()
+            os.rename(tmp, self._filename(key))
+        except:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+        return np.load(self._filename(key), mmap_mode="r")
+
+    def _evict(self):
+        nbytes = self.nbytes
+        while nbytes > self.max_bytes and len(self.entries) > 1:
+            key, arr = self.entries.popitem(last=False)
+            nbytes -= arr.nbytes
+
+# the cache used by default
+cache = GeometryCache()
+
+def set_cache(max_bytes=None, directory=None):
+    """
+    Replace the default cache by a new one with given memory limit and
+    directory (see GeometryCache).
+    """
+    global cache
+    cache = GeometryCache(max_bytes=max_bytes, directory=directory)
+    return cache
+
+def header_key(header, *args):
+    """
+    A hash of the keywords defining a map grid and of additional
+    arguments.
+    """
+    header = getattr(header, "header", header)
+    naxis = int(header['NAXIS'])
+    values = []
+    for i in xrange(naxis):
+        for k in ('NAXIS', 'CRPIX', 'CDELT', 'CRVAL'):
+            values.append(float(header.get(k + str(i + 1), 0.)))
+    values += [repr(a) for a in args]
+    return hashlib.sha1(repr(values)).hexdigest()
+
+def map_axes(header, naxis=None):
+    """
+    Coordinates of the voxel centers along each axis of a map (or
+    along the naxis first axes).
+    """
+    header = getattr(header, "header", header)
+    if naxis is None:
+        naxis = int(header['NAXIS'])
+    axes = []
+    for i in xrange(naxis):
+        strn = str(i + 1)
+        n = int(header['NAXIS' + strn])
+        crpix = header['CRPIX' + strn]
+        cdelt = header['CDELT' + strn]
+        crval = header.get('CRVAL' + strn, 0.)
+        axes.append((np.arange(n) - crpix) * cdelt + crval)
+    return axes
+
+def _squared_radius(header):
+    x, y, z = map_axes(header, 3)
+    r2 = x[:, np.newaxis] ** 2 + y[np.newaxis] ** 2
+    return r2[..., np.newaxis] + z[np.newaxis, np.newaxis] ** 2
+
+def _radius(header):
+    return np.sqrt(squared_radius(header))
+
+def _cylinder(header, r):
+    x, y, z = map_axes(header, 3)
+    A = x[:, np.newaxis] ** 2 + y[np.newaxis] ** 2 > r ** 2
+    return A[..., np.newaxis].repeat(z.size, axis=-1).astype(np.float64)
+
+def squared_radius(header):
+    """
+    Squared distance to the Sun center of the voxels of a map.
+    """
+    return cache.get("squared_radius", header, _squared_radius)
+
+def radius(header):
+    """
+    Distance to the Sun center of the voxels of a map.
+    """
+    return cache.get("radius", header, _radius)
+
+def cylinder(header, r):
+    """
+    Map of ones outside a cylinder of radius r along the third axis
+    and zeros inside.
+    """
+    return cache.get("cylinder", header, _cylinder, r)
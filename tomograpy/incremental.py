@@ -0,0 +1,254 @@
+"""
+Sliding window reconstructions.
+
+A SlidingWindow keeps a data stack, its masks, the projector and the
+last solution in memory. New images are added and old ones removed
+without rebuilding the whole model, and each reconstruction starts
+from the previous solution.
+
+Images are stored in the slots of a preallocated stack. Removed
+images only free their slot (it is masked, so the projector skips
+it) and added images fill free slots. The projector is kept from
+update to update: the headers and mask of the changed slots are
+updated in place. The diagonal of P^T P used to precondition the
+solver is updated with the contributions of the added and removed
+images only. The stack (and the projector) is reallocated (to twice
+its size) only when there is no free slot left.
+
+Exemple
+-------
+>>> window = SlidingWindow(cube, hypers=(.1, .1, .1), duration=14 * 86400,
+...                        obj_rmin=1., obj_rmax=1.5, data_rmax=1.3)
+>>> window.update(solar.read_data(path, tmin=t0, tmax=t1))
+>>> x = window.solve(maxiter=100)
+>>> window.update(solar.read_data(path, tmin=t1, tmax=t2)) # a few hours later
+>>> x = window.solve(maxiter=20) # warm start
+"""
+import numpy as np
+import lo
+import fitsarray as fa
+import siddon
+import solar
+import solvers
+import models
+from stack import as_data_stack
+from lo_wrapper import siddon_lo
+
+class SlidingWindow(object):
+    """
+    Data and solution of a sliding window reconstruction (srt model).
+
+    Arguments
+    ---------
+    cube: InfoArray
+      A map defining the reconstruction grid.
+    hypers: tuple of floats
+      Hyperparameters of the smoothness prior.
+    duration: float (optional)
+      Duration of the window in seconds. When images are added, images
+      older than the most recent image minus duration are removed.
+    capacity: int
+      Initial number of slots of the stack.
+    solver: function
+      A solver of the solvers module (pcg by default).
+
+    Other keyword arguments define the data and object masks as for
+    models.srt (obj_rmin, obj_rmax, data_rmin, data_rmax,
+    mask_negative, height_prior).
+    """
+    def __init__(self, cube, hypers, duration=None, capacity=16,
+                 solver=None, **kwargs):
+        self.cube_header = dict(cube.header)
+        self.shape = cube.shape
+        self.dtype = cube.dtype
+        self.hypers = hypers
+        self.duration = duration
+        self.capacity = capacity
+        self.solver = solver or solvers.pcg
+        self.mask_params = kwargs
+        self.obj_mask = solar.define_map_mask(cube, **kwargs)
+        self.index = np.flatnonzero(~self.obj_mask)
+        D = models.smoothness_prior(cube, kwargs.get("height_prior", False))
+        self.D = D.compressed(self.index)
+        self.solution = None
+        self.data = None
+        self.mask = None
+        self.header = None
+        self.times = None
+        self._siddon = None
+        self._P = None
+        self._decimate = lo.decimate(self.obj_mask, dtype=self.dtype)
+        # diagonal of P^T P (full cube)
+        self.coverage = np.zeros(self.shape, dtype=self.dtype)
+        # a map of ones on active voxels to compute the row sums of images
+        self._ones = self._map((~self.obj_mask).astype(self.dtype))
+        self._bpj = self._map(np.zeros(self.shape, dtype=self.dtype))
+
+    def __len__(self):
+        if self.times is None:
+            return 0
+        return int(np.sum(~np.isnan(self.times)))
+
+    @property
+    def slots(self):
+        "Indexes of the slots holding an image."
+        if self.times is None:
+            return np.zeros(0, dtype=int)
+        return np.flatnonzero(~np.isnan(self.times))
+
+    def update(self, data):
+        """
+        Add images and remove the images older than the window
+        duration.
+        """
+        self.add(data)
+        if self.duration is not None and len(self) > 0:
+            self.expire(np.nanmax(self.times) - self.duration)
+
+    def add(self, data):
+        """
+        Add the images of a data stack.
+        """
+        data = as_data_stack(data)
+        n = data.shape[-1]
+        if n == 0:
+            return
+        if self.data is None:
+            self._allocate(data.shape[:-1], data.header[0], max(self.capacity, n))
+        free = np.flatnonzero(np.isnan(self.times))
+        if free.size < n:
+            self._allocate(self.data.shape[:-1], self.header[0],
+                           max(2 * self.data.shape[-1], len(self) + n))
+            free = np.flatnonzero(np.isnan(self.times))
+        slots = free[:n]
+        mask = solar.define_data_mask(data, **self.mask_params)
+        times = solar.get_times(data)
+        for k, t in enumerate(slots):
+            h = dict(data.header[k])
+            siddon.header_rotation_matrix(h)
+            self.header[t] = h
+            if self._siddon is not None:
+                # the projector keeps its own copy of the headers
+                self._siddon.xout.header[t].update(h)
+            self.data[..., t] = np.where(mask[..., k], 0., data[..., k])
+            self.mask[..., t] = mask[..., k]
+            self.times[t] = times[k]
+        self._update_coverage(slots, 1.)
+
+    def remove(self, slots):
+        """
+        Remove the images of some slots.
+        """
+        slots = np.asarray(slots, dtype=int).ravel()
+        slots = slots[~np.isnan(self.times[slots])]
+        if slots.size == 0:
+            return
+        self._update_coverage(slots, -1.)
+        self.data[..., slots] = 0.
+        self.mask[..., slots] = 1.
+        self.times[slots] = np.nan
+
+    def expire(self, tmin):
+        """
+        Remove the images observed before tmin (in seconds since the
+        epoch, as solar.get_times).
+        """
+        slots = self.slots
+        self.remove(slots[self.times[slots] < tmin])
+
+    def solve(self, **kwargs):
+        """
+        Reconstruct a map from the images of the window, starting from
+        the previous solution. Keyword arguments are passed to the
+        solver.
+
+        Returns
+        -------
+        x: InfoArray
+          The solution with the header of the cube.
+        """
+        if len(self) == 0:
+            raise ValueError("There is no image in the window.")
+        if self.solution is not None and "x0" not in kwargs:
+            kwargs["x0"] = self.solution.ravel()[self.index]
+        # hyperparameters are normalized by the data size which includes
+        # empty slots
+        scale = float(len(self)) / self.data.shape[-1]
+        hypers = tuple(np.asarray(self.hypers) * scale)
+        d = self.coverage.ravel()[self.index] + self.D.diagonal(
+            solvers.normalize_hypers(hypers, self.data, self.index.size))
+        d[d <= np.finfo(d.dtype).eps * np.abs(d).max()] = 1.
+        kwargs.setdefault("precond", 1. / d)
+        out = self.solver(self.P, self.data.ravel(), self.D, hypers, **kwargs)
+        # solvers return (x, info) if full_output is True
+        x = out[0] if isinstance(out, tuple) else out
+        self.solution = self._map(siddon.expand_voxels(x, self.index,
+                                                       self.shape))
+        if isinstance(out, tuple):
+            return (self.solution,) + out[1:]
+        return self.solution
+
+    @property
+    def P(self):
+        """
+        The projector of the current images on the active voxels.
+        """
+        # built once per allocation of the stack: the headers of the
+        # changed slots are updated by add, and the projector shares the
+        # mask of the window
+        if self._P is None:
+            P = siddon_lo(self.header, self.cube_header, mask=self.mask,
+                          obstacle="sun")
+            self.mask = P.kwargs['mask']
+            self._siddon = P
+            self._P = P * self._decimate.T
+        return self._P
+
+    def _map(self, x):
+        return fa.InfoArray(data=x, header=dict(self.cube_header))
+
+    def _allocate(self, shape, header, capacity):
+        """
+        Allocate a stack of capacity slots and copy the current images.
+        """
+        data = np.zeros(shape + (capacity,), dtype=self.dtype)
+        mask = np.ones(shape + (capacity,), dtype=self.dtype)
+        times = np.nan * np.ones(capacity)
+        # empty slots need a valid header, they are masked anyway
+        header = dict(header)
+        siddon.header_rotation_matrix(header)
+        headers = [header] * capacity
+        if self.data is not None:
+            n = self.data.shape[-1]
+            data[..., :n] = self.data
+            mask[..., :n] = self.mask
+            times[:n] = self.times
+            headers[:n] = self.header
+        self.data = fa.InfoArray(data=data, header=headers)
+        self._work = fa.InfoArray(data=np.zeros(data.shape, dtype=self.dtype),
+                                  header=headers)
+        self.header = headers
+        self.mask = mask
+        self.times = times
+        self._siddon = None
+        self._P = None
+
+    def _update_coverage(self, slots, sign):
+        """
+        Add (sign=1) or remove (sign=-1) the contribution P_t^T P_t 1 of
+        the images of some slots to the coverage.
+        """
+        work = self._work
+        bpj = self._bpj
+        bpj[:] = 0.
+        for t in slots:
+            siddon.conic_image_projector(work, self._ones, t, mask=self.mask,
+                                         obstacle="sun", accumulate=False)
+        for t in slots:
+            siddon.conic_image_backprojector(work, bpj, t, mask=self.mask,
+                                             obstacle="sun")
+        if sign > 0:
+            self.coverage += bpj
+        else:
+            self.coverage -= bpj
+        np.maximum(self.coverage, 0., self.coverage)
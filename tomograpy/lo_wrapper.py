@@ -1,14 +1,87 @@
 """
 If lo package is present, define siddon lo wrapper
+
+The matvec and rmatvec of the operators are bound methods, which cannot be
+pickled. The operators are pickled as their constructor arguments
+(headers, masks and keyword arguments) and rebuilt when unpickled, so
+that they can be sent to other processes.
+
+Applied as linear operators, the Siddon operators return new arrays
+(written without a separate zeroing pass) which the caller may keep.
+Their project and backproject methods write in (or add to) arrays
+given by the caller instead, so that solvers can apply them without
+allocating arrays (see solvers.normal_operator). Temporaries are kept
+in the BufferPool of each operator.
 """
 import numpy as np
 import lo
 import fitsarray as fa
 from siddon import dataarray_from_header, backprojector, projector
+from siddon import data_mask_array
 from siddon import backprojector4d, projector4d
 
-class Siddon(lo.NDSOperator):
+def _rebuild(cls, args, kwargs):
+    return cls(*args, **kwargs)
+
+class _Rebuildable(object):
+    """
+    Pickles an operator as its constructor arguments.
+    """
+    def _store_arguments(self, *args, **kwargs):
+        self._arguments = (args, dict(kwargs))
+    def __reduce__(self):
+        args, kwargs = self._arguments
+        return (_rebuild, (self.__class__, args, kwargs))
+
+class BufferPool(object):
+    """
+    Arrays reused from call to call instead of being allocated each
+    time. A buffer is identified by a name, a shape and a dtype and is
+    allocated on first use. Its content is undefined.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[key] = buf
+        return buf
+
+    def clear(self):
+        self._buffers.clear()
+
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for b in self._buffers.itervalues())
+
+def _with_header(x, header, shape, dtype):
+    """
+    A view of x with a given shape and header (copied only if x has
+    another dtype or is not contiguous).
+    """
+    x = np.asarray(x, dtype=dtype).reshape(shape).view(fa.InfoArray)
+    x.header = header
+    return x
+
+class Siddon(_Rebuildable, lo.NDOperator):
+    """
+    Siddon projector of a map on a data stack.
+
+    Arguments
+    ---------
+    data_header: list of dicts
+      The headers of the images.
+    cube_header: dict
+      The header of the map.
+
+    Other keyword arguments are passed to siddon.projector and
+    siddon.backprojector (mask, obstacle, nthread).
+    """
     def __init__(self, data_header, cube_header, **kwargs):
+        self._store_arguments(data_header, cube_header, **kwargs)
         self.data_header = data_header
         self.map_header = dict(cube_header)
         xin = fa.fitsarray_from_header(cube_header)
@@ -16,27 +89,187 @@ class Siddon(lo.NDSOperator):
         xin[:] = 0
         xout = dataarray_from_header(data_header)
         xout[:] = 0
+        # converted once instead of at each call
+        kwargs['mask'] = data_mask_array(xout, kwargs.get('mask'))
         self.xin = xin
         self.xout = xout
-        shapein = xin.shape
-        shapeout = xout.shape
-        def matvec(x):
-            x = fa.InfoArray(data=x, header=dict(cube_header))
-            y = xout
-            y[:] = 0.
-            projector(y, x, **kwargs)
-            return y
-        def rmatvec(x):
-            x = fa.InfoArray(data=x, header=data_header)
-            y = xin
-            y[:] = 0.
-            backprojector(x, y, **kwargs)
-            return y
-        lo.NDSOperator.__init__(self, shapein, shapeout, xin=xin, xout=xout,
-                               matvec=matvec, rmatvec=rmatvec, dtype=xout.dtype)
-
-class Siddon4d(lo.NDSOperator):
+        self.kwargs = kwargs
+        self.buffers = BufferPool()
+        lo.NDOperator.__init__(self, xin.shape, xout.shape, self.project,
+                               rmatvec=self.backproject, dtype=xout.dtype)
+
+    def project(self, x, out=None, accumulate=False):
+        """
+        Projection of the map x. It is written in out (or added to it if
+        accumulate is True) or in a new array.
+        """
+        x = _with_header(x, self.map_header, self.xin.shape, self.dtype)
+        if out is None:
+            out = np.empty(self.xout.shape, dtype=self.dtype)
+        return projector(self.xout, x, out=out, accumulate=accumulate,
+                         **self.kwargs)
+
+    def backproject(self, y, out=None, accumulate=False):
+        """
+        Backprojection of the images y. It is written in out (or added
+        to it if accumulate is True) or in a new array.
+        """
+        y = _with_header(y, self.xout.header, self.xout.shape, self.dtype)
+        if out is None:
+            out = np.empty(self.xin.shape, dtype=self.dtype)
+        return backprojector(y, self.xin, out=out, accumulate=accumulate,
+                             **self.kwargs)
+
+class ShearWarpSiddon(Siddon):
+    """
+    Approximate Siddon projector using the parallel-beam approximation
+    of the views of distant observers (see shear_warp). It can replace
+    Siddon in the first iterations of a solver.
+
+    Arguments
+    ---------
+    data_header: list of dicts
+      The headers of the images.
+    cube_header: dict
+      The header of the map.
+    tolerance: float
+      Maximal error bound of a parallel view in voxels (other views are
+      projected with Siddon).
+
+    Other keyword arguments are passed to shear_warp.ShearWarpProjector
+    (mask, obstacle, nthread).
+    """
+    def __init__(self, data_header, cube_header, tolerance=None, **kwargs):
+        from shear_warp import ShearWarpProjector, TOLERANCE
+        if tolerance is None:
+            tolerance = TOLERANCE
+        Siddon.__init__(self, data_header, cube_header, **kwargs)
+        self._store_arguments(data_header, cube_header, tolerance=tolerance,
+                              **kwargs)
+        self.shear_warp = ShearWarpProjector(self.xout, self.xin,
+                                             tolerance=tolerance,
+                                             **self.kwargs)
+
+    def project(self, x, out=None, accumulate=False):
+        """
+        Approximate projection of the map x (see Siddon.project).
+        """
+        return self.shear_warp.project(x, out=out, accumulate=accumulate)
+
+    def backproject(self, y, out=None, accumulate=False):
+        """
+        Approximate backprojection of the images y (see
+        Siddon.backproject).
+        """
+        return self.shear_warp.backproject(y, out=out, accumulate=accumulate)
+
+class MaskedSiddon(_Rebuildable, lo.NDOperator):
+    """
+    A Siddon operator of this module applied to a masked map (P * M.T
+    where M masks the voxels where obj_mask is True). If decimate is
+    True, masked voxels are removed from the input as with lo.decimate,
+    otherwise they are set to zero as with lo.ndmask.
+
+    The masked map and the backprojections are written in buffers, so
+    that the operator keeps the project and backproject methods of P.
+    The C kernels trace rays through full maps: when decimating, the
+    savings are in the size of the solver vectors and of the priors
+    (see priors.compressed_differences), not in the projections.
+    """
+    def __init__(self, P, obj_mask, decimate=False):
+        self._store_arguments(P, obj_mask, decimate=decimate)
+        obj_mask = np.asarray(obj_mask, dtype=bool).reshape(P.shapein)
+        self.P = P
+        self.decimate = decimate
+        self.index = np.flatnonzero(~obj_mask)
+        self.masked_index = np.flatnonzero(obj_mask)
+        self.buffers = BufferPool()
+        # masked voxels of the map stay at zero when decimating
+        self.xin = np.zeros(P.shapein, dtype=P.dtype)
+        if decimate:
+            shapein = (self.index.size,)
+        else:
+            shapein = P.shapein
+        lo.NDOperator.__init__(self, shapein, P.shapeout, self.project,
+                               rmatvec=self.backproject, dtype=P.dtype)
+
+    def project(self, x, out=None, accumulate=False):
+        """
+        Projection of the masked map x (see Siddon.project).
+        """
+        if self.decimate:
+            self.xin.flat[self.index] = x
+        else:
+            self.xin.flat[:] = np.asarray(x).ravel()
+            self.xin.flat[self.masked_index] = 0.
+        return self.P.project(self.xin, out=out, accumulate=accumulate)
+
+    def backproject(self, y, out=None, accumulate=False):
+        """
+        Backprojection of the images y on the masked map (see
+        Siddon.backproject).
+        """
+        if out is None:
+            out = np.empty(self.shapein, dtype=self.dtype)
+            accumulate = False
+        if not self.decimate and not accumulate:
+            self.P.backproject(y, out=out)
+            out.flat[self.masked_index] = 0.
+            return out
+        bpj = self.buffers.get("map", self.P.shapein, self.dtype)
+        self.P.backproject(y, out=bpj)
+        if not self.decimate:
+            bpj.flat[self.masked_index] = 0.
+            out += bpj
+        elif accumulate:
+            active = self.buffers.get("active", self.shapein, self.dtype)
+            out += np.take(bpj.ravel(), self.index, out=active)
+        else:
+            np.take(bpj.ravel(), self.index, out=out)
+        return out
+
+def masked_lo(P, obj_mask, decimate=False):
+    """
+    The operator P applied to a masked map: P * M.T where M is
+    lo.decimate(obj_mask) if decimate is True, lo.ndmask(obj_mask)
+    otherwise. Siddon operators of this module are wrapped in a
+    MaskedSiddon (see solvers.normal_operator).
+    """
+    if hasattr(P, "buffers"):
+        return MaskedSiddon(P, obj_mask, decimate=decimate)
+    if decimate:
+        Mo = lo.decimate(obj_mask, dtype=P.dtype)
+    else:
+        Mo = lo.ndmask(obj_mask, dtype=P.dtype)
+    return P * Mo.T
+
+def expansion_lo(index, shape, dtype=np.float64):
+    """
+    Linear operator expanding a vector of active voxels (see
+    siddon.active_voxels) into a map of given shape. Its transpose
+    compresses a map.
+
+    The expanded map is written in a buffer allocated once (inactive
+    voxels stay at zero), so its content is overwritten by the next
+    call.
+    """
+    size = np.prod(shape)
+    y = np.zeros(size, dtype=dtype)
+    def matvec(x):
+        y[index] = x
+        return y
+    def rmatvec(x):
+        return x[index]
+    return lo.ndoperator((index.size,), (size,), matvec, rmatvec, dtype=dtype)
+
+class Siddon4d(_Rebuildable, lo.NDOperator):
+    """
+    Siddon projector of a time-dependent map (the last axis of the map)
+    on a data stack. The images are divided into ng groups (one image
+    every ng) and each group is projected with projector4d.
+    """
     def __init__(self, data_header, cube_header, ng=1, **kwargs):
+        self._store_arguments(data_header, cube_header, ng=ng, **kwargs)
         self.data_header = data_header
         self.map_header = cube_header
         xout = dataarray_from_header(data_header)
@@ -46,28 +279,70 @@ class Siddon4d(lo.NDSOperator):
         xin[:] = 0
         self.xin = xin
         self.xout = xout
-        def matvec(x):
-            y = dataarray_from_header(data_header)
-            y[:] = 0
-            for i in xrange(ng):
-                yi = y[..., i::ng]
-                yi.header = y.header[i::ng]
-                projector4d(yi, x, **kwargs)
-            del yi
-            return y
-        def rmatvec(x):
-            y = fa.fitsarray_from_header(cube_header)
-            y[:] = 0
-            for i in xrange(ng):
-                xi = x[..., i::ng]
-                xi.header = xi.header[i::ng]
-                backprojector4d(xi, y, **kwargs)
-            del xi
-            return y
-        lo.NDSOperator.__init__(self, xin=xin, xout=xout, matvec=matvec, rmatvec=rmatvec, dtype=xout.dtype)
-
-def siddon_lo(data_header, cube_header, **kwargs):
-    return Siddon(data_header, cube_header, **kwargs)
+        self.ng = ng
+        # views of the data stack (for their headers) and masks of
+        # each group
+        mask = data_mask_array(xout, kwargs.pop('mask', None))
+        self.groups = []
+        self.masks = []
+        for i in xrange(ng):
+            xi = xout[..., i::ng]
+            xi.header = xout.header[i::ng]
+            self.groups.append(xi)
+            self.masks.append(np.ascontiguousarray(mask[..., i::ng]))
+        self.kwargs = kwargs
+        self.buffers = BufferPool()
+        lo.NDOperator.__init__(self, xin.shape, xout.shape, self.project,
+                               rmatvec=self.backproject, dtype=xout.dtype)
+
+    def project(self, x, out=None, accumulate=False):
+        """
+        Projection of the map x (see Siddon.project).
+        """
+        x = _with_header(x, self.xin.header, self.xin.shape, self.dtype)
+        if out is None:
+            out = np.empty(self.xout.shape, dtype=self.dtype)
+        for i in xrange(self.ng):
+            projector4d(self.groups[i], x, out=out[..., i::self.ng],
+                        mask=self.masks[i], accumulate=accumulate,
+                        **self.kwargs)
+        return out
+
+    def backproject(self, y, out=None, accumulate=False):
+        """
+        Backprojection of the images y (see Siddon.backproject).
+        """
+        y = np.asarray(y, dtype=self.dtype).reshape(self.xout.shape)
+        if out is None:
+            out = np.empty(self.xin.shape, dtype=self.dtype)
+        for i in xrange(self.ng):
+            yi = y[..., i::self.ng].view(fa.InfoArray)
+            yi.header = self.groups[i].header
+            # groups after the first add to the output
+            backprojector4d(yi, self.xin, out=out, mask=self.masks[i],
+                            accumulate=accumulate or i > 0, **self.kwargs)
+        return out
+
+def siddon_lo(data_header, cube_header, index=None, tolerance=None,
+              **kwargs):
+    """
+    Siddon projector as a linear operator. If index is given, the
+    operator input is the vector of the active voxels index only (a
+    MaskedSiddon decimating the other voxels). If tolerance is given,
+    the projector is the approximate shear-warp projector (see
+    ShearWarpSiddon).
+    """
+    if tolerance is not None:
+        if index is not None:
+            raise ValueError("Shear-warp projectors cannot be compressed.")
+        return ShearWarpSiddon(data_header, cube_header, tolerance=tolerance,
+                               **kwargs)
+    P = Siddon(data_header, cube_header, **kwargs)
+    if index is not None:
+        obj_mask = np.ones(P.shapein, dtype=bool)
+        obj_mask.flat[index] = False
+        return masked_lo(P, obj_mask, decimate=True)
+    return P
 
 def siddon4d_lo(data_header, cube_header, **kwargs):
     return Siddon4d(data_header, cube_header, **kwargs)
@@ -9,8 +9,9 @@ import numpy as np
 import copy
 import lo
 import siddon
-from lo_wrapper import siddon_lo, siddon4d_lo
+from lo_wrapper import siddon_lo, siddon4d_lo, masked_lo
 import solar
+from priors import SmoothnessPrior
 
 # constants
 #sigma = 7.940787e-30 # impossible to double floating point precision
@@ -37,6 +38,14 @@ def srt(data, cube, **kwargs):
         Data maximal radius. Areas above data_rmax are masked out.
     mask_negative: boolean
         If true, negative values in the data are masked out.
+    compress: boolean
+        If true, the unknowns are only the voxels which are crossed by
+        rays and not masked (see siddon.active_voxels). The solution
+        is expanded to a cube with expand_solution.
+    data_mask: boolean ndarray (optional)
+        A data mask computed beforehand (with the same parameters).
+    index: int ndarray (optional)
+        The active voxels of a compressed model computed beforehand.
 
     Returns
     -------
@@ -47,24 +56,74 @@ def srt(data, cube, **kwargs):
 
     """
     # Model : it is Solar rotational tomography, so obstacle="sun".
-    data_mask = solar.define_data_mask(data, **kwargs)
-    P = siddon_lo(data.header, cube.header, mask=data_mask, obstacle="sun")
+    data_mask = _data_mask(data, kwargs)
     D = smoothness_prior(cube, kwargs.get("height_prior", False))
+    if kwargs.get("compress", False):
+        index, obj_mask = _active_voxels(data, cube, data_mask, **kwargs)
+        P = siddon_lo(data.header, cube.header, mask=data_mask,
+                      obstacle="sun", index=index)
+        D = D.compressed(index)
+        return P, D, obj_mask, data_mask
+    P = siddon_lo(data.header, cube.header, mask=data_mask, obstacle="sun")
     P, D, obj_mask = _apply_object_mask(P, D, cube, **kwargs)
     return P, D, obj_mask, data_mask
 
+def _data_mask(data, kwargs):
+    """
+    The data mask given to a model (popped from its keyword arguments)
+    or computed from its arguments.
+    """
+    data_mask = kwargs.pop("data_mask", None)
+    if data_mask is None:
+        data_mask = solar.define_data_mask(data, **kwargs)
+    return data_mask
+
+def _active_voxels(data, cube, data_mask, index=None, **kwargs):
+    """
+    Active voxels of a compressed model and the corresponding object
+    mask (True for inactive voxels). The active voxels are computed
+    only if index is None.
+    """
+    if index is None:
+        obj_rmin = kwargs.get('obj_rmin', None)
+        obj_rmax = kwargs.get('obj_rmax', None)
+        if obj_rmin is not None or obj_rmax is not None:
+            obj_mask = solar.define_map_mask(cube, **kwargs)
+        else:
+            obj_mask = None
+        index = siddon.active_voxels(data, cube, obj_mask=obj_mask,
+                                     mask=data_mask, obstacle="sun")
+    obj_mask = np.ones(cube.shape, dtype=bool)
+    obj_mask.flat[index] = False
+    return index, obj_mask
+
+def expand_solution(x, obj_mask):
+    """
+    Expand the solution of a compressed model (a vector of the active
+    voxels) into a cube. Masked voxels are set to 0.
+    """
+    x = np.asarray(x).ravel()
+    if x.size == obj_mask.size:
+        return x.reshape(obj_mask.shape)
+    index = np.flatnonzero(~obj_mask)
+    return siddon.expand_voxels(x, index, obj_mask.shape)
+
 def _apply_object_mask(P, D, cube, **kwargs):
     obj_rmin = kwargs.get('obj_rmin', None)
     obj_rmax = kwargs.get('obj_rmax', None)
     # Define masking.
     if obj_rmin is not None or obj_rmax is not None:
-        Mo, obj_mask = mask_object(cube, **kwargs)
-        P = P * Mo.T
-        D = [Di * Mo.T for Di in D]
+        obj_mask = solar.define_map_mask(cube, **kwargs)
+        P = masked_lo(P, obj_mask, decimate=_decimate(**kwargs))
+        D = D.masked(obj_mask, decimate=_decimate(**kwargs))
     else:
         obj_mask = None
     return P, D, obj_mask
 
+def _decimate(decimate=False, remove_nan=False, **kwargs):
+    "True if masked voxels are removed from the unknowns (see mask_object)."
+    return decimate or remove_nan
+
 def _apply_data_mask(P, data, **kwargs):
     # Parse kwargs.
     data_rmin = kwargs.get('data_rmin', None)
@@ -84,24 +143,19 @@ def _apply_data_mask(P, data, **kwargs):
 
 def smoothness_prior(my_map, height_prior=False):
     """
-    Defines a smoothness prior.
+    Defines a smoothness prior (see priors.SmoothnessPrior).
     """
-    D = [lo.diff(my_map.shape, axis=i) for i in xrange(my_map.ndim)]
+    weights = None
     if height_prior:
-        r = _radius_map(my_map)
-        R = lo.diag(r.ravel())
-        D = [Di * R for Di in D]
-    return D
+        weights = _radius_map(my_map)
+        # same weights for each time step of 4d maps
+        if weights.ndim < my_map.ndim:
+            weights = weights[..., np.newaxis].repeat(my_map.shape[-1], axis=-1)
+    return SmoothnessPrior(my_map.shape, weights=weights)
 
 def _radius_map(my_map):
-    from fitsarray import asfitsarray
-    x, y, z = asfitsarray(my_map).axes()
-    x2 = x ** 2
-    y2 = y ** 2
-    z2 = z ** 2
-    X2, Y2 = np.meshgrid(x2, y2)
-    R = np.dstack([X2 + Y2 + z2i for z2i in z2])
-    return R
+    import geometry
+    return geometry.squared_radius(my_map.header)
 
 def stsrt(data, cube, **kwargs):
     """
@@ -119,13 +173,14 @@ def stsrt(data, cube, **kwargs):
     obj_rmin = kwargs.get('obj_rmin', None)
     obj_rmax = kwargs.get('obj_rmax', None)
     # mask data
-    data_mask = solar.define_data_mask(data, **kwargs)
+    data_mask = _data_mask(data, kwargs)
     # define temporal groups
-    times = [solar.convert_time(h['DATE_OBS']) for h in data.header]
-    ## if no interval is given separate every image
-    dt_min = kwargs.get('dt_min', np.max(np.diff(times)) + 1)
-    #groups = solar.temporal_groups(data, dt_min)
-    ind = solar.temporal_groups_indexes(data, dt_min)
+    dt_min = kwargs.get('dt_min', None)
+    if dt_min is None:
+        ## if no interval is given separate every image
+        ind = np.arange(data.shape[-1])
+    else:
+        ind = solar.temporal_groups_indexes(data, dt_min)
     n = len(ind)
     # define new 4D cube
     cube4 = cube[..., np.newaxis].repeat(n, axis=-1)
@@ -140,14 +195,10 @@ def stsrt(data, cube, **kwargs):
     D = smoothness_prior(cube4, kwargs.get("height_prior", False))
     # mask object
     if obj_rmin is not None or obj_rmax is not None:
-        Mo, obj_mask = mask_object(cube, **kwargs)
+        obj_mask = solar.define_map_mask(cube, **kwargs)
         obj_mask = obj_mask[..., np.newaxis].repeat(n, axis=-1)
-        if kwargs.get("decimate", False) or kwargs.get("remove_nan", False):
-            Mo = lo.decimate(obj_mask)
-        else:
-            Mo = lo.ndmask(obj_mask)
-        P = P * Mo.T
-        D = [Di * Mo.T for Di in D]
+        P = masked_lo(P, obj_mask, decimate=_decimate(**kwargs))
+        D = D.masked(obj_mask, decimate=_decimate(**kwargs))
     else:
         obj_mask = None
     return P, D, obj_mask, data_mask
@@ -165,25 +216,39 @@ def mask_object(cube, decimate=False, remove_nan=False, **kwargs):
     return Mo, obj_mask
 
 def group_sum(ind, cube, data):
-    from lo import ndsubclass
+    """
+    Sum of the maps of the images of each temporal group.
+
+    Group k is made of the images ind[k] to ind[k + 1] (excluded), the
+    last group ends with the last image. Groups can have different
+    sizes. The sum is a segmented reduction (np.add.reduceat) and its
+    transpose broadcasts each group map to the images of the group
+    (np.take), both in preallocated outputs.
+    """
     # shapes
     shapein = cube.shape + (data.shape[-1],)
     shapeout = cube.shape + (len(ind),)
-    # slicing indexes
-    ind1 = ind
-    ind2 = ind1[1:] + [None,]
-    axis = -1
+    starts = np.asarray(ind, dtype=int)
+    sizes = np.diff(np.concatenate((starts, [data.shape[-1]])))
+    # reduceat returns x[..., i] instead of 0 for empty groups
+    empty = np.flatnonzero(sizes == 0)
+    groups = np.repeat(np.arange(len(ind)), sizes)
+    first = starts[0] if len(ind) > 0 else shapein[-1]
+    starts = starts.clip(max=max(shapein[-1] - 1, 0))
+    out = np.zeros(shapeout)
+    out_t = np.zeros(shapein)
     def matvec(x):
-        out = np.zeros(shapeout)
-        for i, j, k in zip(ind1, ind2, np.arange(len(ind1))):
-            out[..., k] = x[..., i:j].sum(axis=-1)
+        x = np.asarray(x).reshape(shapein)
+        if len(ind) > 0:
+            np.add.reduceat(x, starts, axis=-1, out=out)
+            out[..., empty] = 0.
         return out
     def rmatvec(x):
-        out = np.zeros(shapein)
-        for i, j, k in zip(ind1, ind2, np.arange(len(ind1))):
-            tmp_shape = out[..., i:j].shape
-            out[..., i:j] = x[..., k].repeat(tmp_shape[-1]).reshape(tmp_shape)
-        return out
+        x = np.asarray(x).reshape(shapeout)
+        # images before the first group are not summed
+        out_t[..., :first] = 0.
+        np.take(x, groups, axis=-1, out=out_t[..., first:])
+        return out_t
     return lo.ndoperator(shapein, shapeout, matvec, rmatvec, dtype=np.float64)
 
 # Thomson scattering
@@ -206,30 +271,38 @@ def thomson(data, cube, u=.5, **kwargs):
     data_mask : data mask array
     """
     # data mask
-    data_mask = solar.define_data_mask(data, **kwargs)
+    data_mask = _data_mask(data, kwargs)
     # projector
     pb = kwargs.get('pb', 'pb')
-    if pb == 'pb':
-        P = pb_thomson_lo(data, cube, u, mask=data_mask)
-    else:
+    if pb != 'pb':
         raise ValueError('Only pb implemented for now.')
     # priors
-    D = [lo.diff(cube.shape, axis=i) for i in xrange(cube.ndim)]
+    D = smoothness_prior(cube)
+    if kwargs.get("compress", False):
+        kwargs['remove_nan'] = True
+        index, obj_mask = _active_voxels(data, cube, data_mask, **kwargs)
+        P = pb_thomson_lo(data, cube, u, mask=data_mask, index=index)
+        D = D.compressed(index)
+        return P, D, obj_mask, data_mask
+    P = pb_thomson_lo(data, cube, u, mask=data_mask)
     # masks
     kwargs['remove_nan'] = True
     P, D, obj_mask = _apply_object_mask(P, D, cube, **kwargs)
     return P, D, obj_mask, data_mask
 
-def pb_thomson_lo(data, in_map, u, mask=None):
+def pb_thomson_lo(data, in_map, u, mask=None, index=None):
     """Defines thomson scattering linear operator"""
     # data coefs
     data_coefs = _pb_data_coef(data).flatten()
     O = lo.diag(data_coefs)
     # map coefs
     map_coefs = _pb_map_coef(in_map, u).flatten()
+    if index is not None:
+        map_coefs = map_coefs[index]
     M = lo.diag(map_coefs)
     # projection
-    P = siddon_lo(data.header, in_map.header, obstacle="sun", mask=mask)
+    P = siddon_lo(data.header, in_map.header, obstacle="sun", mask=mask,
+                  index=index)
     # thomson lo
     T = O * P * M
     return T
@@ -276,34 +349,37 @@ def _pb_thomson_coef(omega):
 
 def _pb_data_coef(data):
     """Returns pb coefficients for a data array."""
-    from fitsarray import asfitsarray
-    coefs = np.zeros(data.shape)
-    # loop on images assuming images are on last axis
-    for i in xrange(data.shape[-1]):
-        # get phyiscal coordinates of pixels
-        im = asfitsarray(solar.slice_data(data, i))
-        alpha, beta = im.axes()
-        Alpha, Beta = np.meshgrid(alpha, beta)
-        # define coefficients as square of impact parameter
-        coefs[..., i] = _impact_parameter(Alpha, Beta, im.header['D']) ** 2
+    from stack import get_column
+    h = data.header
+    # phyiscal coordinates of pixels for all images at once
+    # (images are on last axis)
+    alpha = ((np.arange(data.shape[0])[:, np.newaxis] - get_column(h, 'CRPIX1'))
+             * get_column(h, 'CDELT1') + get_column(h, 'CRVAL1'))
+    beta = ((np.arange(data.shape[1])[:, np.newaxis] - get_column(h, 'CRPIX2'))
+            * get_column(h, 'CDELT2') + get_column(h, 'CRVAL2'))
+    Alpha = alpha[:, np.newaxis]
+    Beta = beta[np.newaxis]
+    # define coefficients as square of impact parameter
+    coefs = _impact_parameter(Alpha, Beta, get_column(h, 'D')) ** 2
     return coefs
 
 def _pb_map_coef(my_map, u):
     """Returns pb map coefficients corresponding to a map array."""
-    from fitsarray import asfitsarray
-    coefs = np.zeros(my_map.shape)
-    x, y, z = asfitsarray(my_map).axes()
-    x2 = x ** 2
-    y2 = y ** 2
-    z2 = z ** 2
-    X2, Y2 = np.meshgrid(x2, y2)
+    import geometry
+    return geometry.cache.get("pb_map_coef", my_map.header,
+                              _compute_pb_map_coef, u)
+
+def _compute_pb_map_coef(header, u):
+    import geometry
+    R2 = geometry.squared_radius(header)
+    coefs = np.zeros(R2.shape)
     # loop on z to avoid memory explosion !
-    for i, z2i in enumerate(z2):
-        R2 = X2 + Y2 + z2i
-        R = np.sqrt(R2)
+    for i in xrange(R2.shape[-1]):
+        R2i = R2[..., i]
+        R = np.sqrt(R2i)
         O = _r2omega(R)
         C1, C2 = _pb_thomson_coef(O)
-        coefs[..., i] = ((1 - u) * C1 + u * C2) / (R2 ** 2)
+        coefs[..., i] = ((1 - u) * C1 + u * C2) / (R2i ** 2)
     # set infinite values due to divide by zero to 0.
-    coefs[1 - np.isfinite(coefs)] = 0.
+    coefs[~np.isfinite(coefs)] = 0.
     return coefs * np.pi * sigma / 2.
@@ -0,0 +1,316 @@
+"""
+Coarse-to-fine (multigrid) inversions.
+
+A pyramid of maps is defined by dividing the number of voxels of the
+target map by 2 along each spatial axis at each level (with the same
+physical extent) and a pyramid of data stacks by binning the images
+by 2 at each level. The inversion is first done on the coarsest level
+(a few iterations on a small map and heavily binned images are cheap).
+The solution is prolongated (interpolated) to the next level where it
+is the starting point of the solver, up to the target resolution.
+
+Optionally, V-cycles then refine the solution: at each level, a few
+iterations are done, the residual is restricted and a correction is
+computed on the next coarser level (full approximation scheme), then
+prolongated and followed by a few more iterations. V-cycles use the
+pcg solver whatever the solver of the coarse-to-fine inversion.
+
+Hyperparameters are given for the target level. They are scaled at
+coarser levels so that the relative weight of the prior and the data
+is the same at all levels.
+
+Exemple
+-------
+>>> x = multigrid(data, cube, (.1, .1, .1), levels=3, maxiter=50,
+...               mask_params={"obj_rmin":1., "obj_rmax":1.5})
+"""
+import time
+import numpy as np
+import fitsarray as fa
+import siddon
+import solar
+import models
+import solvers
+
+def coarse_map_header(header, factor):
+    """
+    Header of a map with the same physical extent as the map of header
+    and factor times less voxels along each spatial axis.
+    """
+    header = dict(header)
+    for i in xrange(3):
+        strn = str(i + 1)
+        n = int(header['NAXIS' + strn])
+        nc = n // factor
+        if nc < 2:
+            raise ValueError("Map is too small for this number of levels.")
+        header['NAXIS' + strn] = nc
+        header['CDELT' + strn] = header['CDELT' + strn] * n / float(nc)
+        header['CRPIX' + strn] = header['CRPIX' + strn] * nc / float(n)
+    siddon.map_borders(header)
+    return header
+
+def map_pyramid(cube, levels):
+    """
+    Maps of each level (from the target map to the coarsest one).
+    """
+    header = dict(cube.header)
+    out = []
+    for l in xrange(levels):
+        h = coarse_map_header(header, 2 ** l)
+        shape = tuple(int(h['NAXIS' + str(i + 1)])
+                      for i in xrange(cube.ndim))
+        out.append(fa.InfoArray(data=np.zeros(shape, dtype=cube.dtype),
+                                header=h))
+    return out
+
+def data_pyramid(data, levels):
+    """
+    Data stacks of each level (from the data to the most binned one).
+    """
+    out = [data]
+    for l in xrange(1, levels):
+        out.append(solar.bin_data(out[-1], 2))
+    return out
+
+def _interpolation_matrix(n, nc):
+    """
+    Linear interpolation of nc voxel centers on n voxel centers with
+    the same extent.
+    """
+    u = (np.arange(n) + .5) * nc / float(n) - .5
+    u = np.clip(u, 0., nc - 1.)
+    i0 = np.minimum(np.floor(u).astype(int), max(nc - 2, 0))
+    w = u - i0
+    M = np.zeros((n, nc))
+    M[np.arange(n), i0] = 1. - w
+    if nc > 1:
+        M[np.arange(n), i0 + 1] += w
+    return M
+
+def _apply_axes(x, shape, transpose=False):
+    for axis in xrange(3):
+        if transpose:
+            M = _interpolation_matrix(x.shape[axis], shape[axis]).T
+        else:
+            M = _interpolation_matrix(shape[axis], x.shape[axis])
+        x = np.rollaxis(np.tensordot(M, x, axes=(1, axis)), 0, axis + 1)
+    return x
+
+def prolongate(x, shape):
+    """
+    Trilinear interpolation of a map on a finer map of a given shape
+    (with the same physical extent).
+    """
+    return _apply_axes(np.asarray(x), shape)
+
+def restrict(x, shape):
+    """
+    Restriction of a map on a coarser map of a given shape (weighted
+    mean of the voxels, the transpose of prolongate up to a
+    normalization).
+    """
+    x = np.asarray(x)
+    y = _apply_axes(x, shape, transpose=True)
+    w = _apply_axes(np.ones(x.shape[:3]), shape, transpose=True)
+    if x.ndim > 3:
+        w = w.reshape(w.shape + (1,) * (x.ndim - 3))
+    return y / w
+
+class Level(object):
+    """
+    The model of the inversion at one level of the pyramid.
+    """
+    def __init__(self, data, cube, model, hypers, mask_params):
+        self.data = data
+        self.cube = cube
+        self.hypers = hypers
+        P, D, obj_mask, data_mask = model(data, cube, **mask_params)
+        self.P, self.D = P, D
+        self.obj_mask = obj_mask
+        self.data_mask = data_mask
+        b = np.array(data, dtype=cube.dtype)
+        b *= (1 - data_mask)
+        b[np.isnan(b)] = 0.
+        self.b = b.ravel()
+        self._normal = None
+
+    def normal(self, x):
+        """
+        The normal operator of the level (as in solvers.pcg) applied
+        to x.
+        """
+        if self._normal is None:
+            h = solvers.normalize_hypers(self.hypers, self.b, self.P.shape[1])
+            self._normal = solvers.normal_operator(self.P, self.D, h)
+        return self._normal(x)
+
+    def to_map(self, x):
+        if self.obj_mask is None:
+            return np.asarray(x).reshape(self.cube.shape)
+        return models.expand_solution(x, self.obj_mask)
+
+    def from_map(self, x):
+        x = np.asarray(x)
+        if self.P.shape[1] == x.size:
+            return x.ravel().copy()
+        return x[~self.obj_mask].copy()
+
+def multigrid(data, cube, hypers, levels=3, model=None, solver=None,
+              mask_params={}, maxiter=None, vcycles=0, smooth_iter=5,
+              x0=None, verbose=False, full_output=False, **kwargs):
+    """
+    Coarse-to-fine inversion.
+
+    Arguments
+    ---------
+    data: InfoArray
+      The data stack.
+    cube: InfoArray
+      The map at the target resolution.
+    hypers: tuple of floats
+      Hyperparameters of the prior at the target resolution.
+    levels: int
+      Number of levels (1 is a direct inversion).
+    model: function
+      A model of the models module (srt by default).
+    solver: function
+      A solver of the solvers module or a lo optimizer (pcg by default).
+    mask_params: dict
+      Keyword arguments of the model.
+    maxiter: int
+      Maximal number of iterations at each level.
+    vcycles: int
+      Number of V-cycles after the coarse-to-fine inversion.
+    smooth_iter: int
+      Number of iterations before and after the coarse correction of
+      the V-cycles (which use solvers.pcg).
+    x0: ndarray (optional)
+      A starting map at the target resolution.
+
+    Other keyword arguments are passed to the solver.
+
+    Returns
+    -------
+    x: InfoArray
+      The map with the header of cube.
+    info: dict (if full_output is True)
+      The number of iterations (at the target level) and the time to
+      solution. Values the solver does not report are None or NaN
+      (see solvers.report).
+    """
+    t0 = time.time()
+    if model is None:
+        model = models.srt
+    if solver is None:
+        solver = solvers.pcg
+    if levels < 1:
+        raise ValueError("levels should be a positive integer.")
+    cubes = map_pyramid(cube, levels)
+    stacks = data_pyramid(data, levels)
+    pyramid = []
+    for l in xrange(levels):
+        h = _level_hypers(hypers, 2 ** l)
+        pyramid.append(Level(stacks[l], cubes[l], model, h, mask_params))
+    kwargs["maxiter"] = maxiter
+    # iterations and last info of the solver at the target level
+    count = {"iterations":0, "info":None}
+    # coarse to fine
+    if x0 is not None:
+        x = restrict(x0, cubes[-1].shape)
+    else:
+        x = np.zeros(cubes[-1].shape, dtype=cube.dtype)
+    for l in xrange(levels - 1, -1, -1):
+        level = pyramid[l]
+        if l < levels - 1:
+            x = prolongate(x, level.cube.shape)
+        xl = _solve(solver, level, level.b, level.from_map(x), kwargs,
+                    count if l == 0 else None)
+        x = level.to_map(xl)
+        if verbose:
+            print("Level %i: %s map" % (l, "x".join(map(str, x.shape))))
+    # V-cycles
+    x = pyramid[0].from_map(x)
+    for c in xrange(vcycles):
+        x = _vcycle(pyramid, 0, x, pyramid[0].b, None, smooth_iter, kwargs,
+                    count)
+        if verbose:
+            print("V-cycle %i" % (c + 1))
+    x = fa.InfoArray(data=pyramid[0].to_map(x), header=dict(cube.header))
+    if full_output:
+        info = count["info"]
+        return x, solvers._info(count["iterations"], info["residual"], t0,
+                                info["converged"])
+    return x
+
+def _vcycle(pyramid, l, x, b, offset, smooth_iter, kwargs, count=None):
+    """
+    A V-cycle from level l, solving the normal equations of level l
+    with offset added to their right hand side.
+
+    The coarse problem is the full approximation scheme problem: the
+    coarse map starts from the restriction xc of x and the right hand
+    side is A_c xc plus the restricted residual, so that the correction
+    is zero when x is the solution.
+    """
+    level = pyramid[l]
+    if l == len(pyramid) - 1:
+        return _solve(solvers.pcg, level, b, x, dict(kwargs, offset=offset))
+    smooth = dict(kwargs, maxiter=smooth_iter, offset=offset)
+    x = _solve(solvers.pcg, level, b, x, smooth, count)
+    rho = np.array(level.P.T * b, dtype=x.dtype).ravel() - level.normal(x)
+    if offset is not None:
+        rho += offset
+    coarse = pyramid[l + 1]
+    xc = coarse.from_map(restrict(level.to_map(x), coarse.cube.shape))
+    # the coarse normal operator is about a fourth of the Galerkin
+    # operator Q^T A Q since images are binned by 2
+    rc = .25 * _apply_axes(level.to_map(rho), coarse.cube.shape,
+                           transpose=True)
+    bc = np.zeros(coarse.b.size, dtype=x.dtype)
+    y = _vcycle(pyramid, l + 1, xc, bc, coarse.normal(xc) + coarse.from_map(rc),
+                smooth_iter, kwargs)
+    e = prolongate(coarse.to_map(y - xc), level.cube.shape)
+    x = x + level.from_map(e)
+    return _solve(solvers.pcg, level, b, x, smooth, count)
+
+def _solve(solver, level, b, x0, kwargs, count=None):
+    """
+    Solve the problem of a level. If count is a dict, the number of
+    iterations and the info of the solver are stored in it.
+    """
+    full_output = solver in solvers.optimizers.values()
+    calls = []
+    if not full_output and "callback" not in kwargs:
+        # lo optimizers do not report their number of iterations but
+        # call their callback once per iteration
+        kwargs = dict(kwargs, callback=lambda x: calls.append(None))
+    out = solver(level.P, b, level.D, level.hypers, x0=x0,
+                 full_output=full_output, **kwargs)
+    if full_output:
+        out, info = out
+    else:
+        # unknown if the callback was not called
+        info = {"iterations":len(calls) or None, "residual":np.nan,
+                "converged":None}
+    if count is not None:
+        if count["iterations"] is None or info["iterations"] is None:
+            count["iterations"] = None
+        else:
+            count["iterations"] += info["iterations"]
+        count["info"] = info
+    return np.array(out, dtype=level.cube.dtype).ravel()
+
+def _level_hypers(hypers, factor):
+    """
+    Hyperparameters of a level whose voxels are factor times larger
+    along the spatial axes.
+
+    With the normalization of lo (see solvers.normalize_hypers), the
+    data and prior terms keep the same ratio if the hyperparameters of
+    the spatial axes are divided by factor ** 2 (the binning of the
+    data does not change this ratio).
+    """
+    hypers = np.asarray(hypers, dtype=float).copy()
+    hypers[:3] /= factor ** 2
+    return tuple(hypers)
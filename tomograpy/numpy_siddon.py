@@ -0,0 +1,202 @@
+"""
+A pure NumPy implementation of the Siddon projectors.
+
+It computes the same projections as the C extension (see
+C_siddon.c.template) and is used when the extension is not compiled
+or when engine="numpy" is given to the projectors of the siddon
+module. It is also a reference to check the C code.
+
+Instead of tracing rays one after the other, the rays of a chunk of
+unmasked pixels are traced together: at each step, every ray of the
+chunk crosses one voxel, and rays leaving the map (or reaching the
+obstacle) are removed from the chunk. The intersections of a chunk
+are stored as a sparse matrix (pixel, voxel, length) which is then
+applied with bincount. Memory is bounded by chunk_size times the
+length of the longest ray in voxels.
+
+Exemple
+-------
+>>> mask = siddon.data_mask_array(data)
+>>> conic_projector(data, cube, mask, "pj", obstacle="sun")
+"""
+import numpy as np
+from stack import get_column
+
+# const (as in the C code)
+INF = 100000
+# default number of rays traced together
+chunk_size = 4096
+
+def conic_projector(data, cube, mask, pj="pj", obstacle=None, images=None,
+                    accumulate=True, chunk_size=None):
+    """
+    Project (or backproject) in-place, as the C conic_full_projector.
+
+    Arguments
+    ---------
+    data: 3d InfoArray
+      The data stack.
+    cube: 3d or 4d InfoArray
+      The map.
+    mask: 3d ndarray
+      Pixels equal to 0 are projected (see siddon.data_mask_array).
+    pj: {"pj", "bpj", "pjt", "bpjt"}
+      Projection, backprojection and their 4d versions (the last axis
+      of the map is the image index).
+    obstacle: {None, "sun"}
+      Stop rays at the sphere of radius one.
+    images: sequence of ints (optional)
+      Only trace the rays of these images (all by default).
+    accumulate: boolean
+      If False, projections overwrite the images instead of adding to
+      them (backprojections always add to the map).
+    chunk_size: int
+      Number of rays traced together (module chunk_size by default).
+    """
+    if pj not in ("pj", "bpj", "pjt", "bpjt"):
+        raise ValueError("Unknown projection %s." % pj)
+    if obstacle not in (None, "sun"):
+        raise ValueError("Unknown obstacle %s." % obstacle)
+    if images is None:
+        images = np.arange(data.shape[-1])
+    images = np.asarray(images, dtype=int).ravel()
+    projection = pj in ("pj", "pjt")
+    if projection and not accumulate:
+        data[..., images] = 0
+    chunk_size = chunk_size or globals()["chunk_size"]
+    geometry = ImageGeometry(data, cube)
+    # unmasked pixels of the images
+    i, j, k = np.nonzero(np.asarray(mask)[..., images] == 0)
+    t = images[k]
+    del k
+    for start in xrange(0, i.size, chunk_size):
+        s = slice(start, start + chunk_size)
+        rays, voxels, lengths = trace(geometry, i[s], j[s], t[s], obstacle)
+        # time (image) index of the 4d maps
+        if pj in ("pjt", "bpjt"):
+            voxels = voxels + (t[s][rays],)
+        if projection:
+            values = lengths * cube[voxels]
+            sums = np.bincount(rays, weights=values, minlength=i[s].size)
+            data[i[s], j[s], t[s]] += sums.astype(data.dtype)
+        else:
+            values = lengths * data[i[s], j[s], t[s]][rays]
+            flat = np.ravel_multi_index(voxels, cube.shape)
+            sums = np.bincount(flat, weights=values, minlength=cube.size)
+            cube += sums.reshape(cube.shape).astype(cube.dtype)
+    return data if projection else cube
+
+class ImageGeometry(object):
+    """
+    Parameters of the images and of the map as arrays (one value per
+    image for the images), in the data type of the data.
+    """
+    def __init__(self, data, cube):
+        dtype = data.dtype
+        h = data.header
+        column = lambda key: np.asarray(get_column(h, key), dtype=dtype)
+        self.dtype = dtype
+        self.crpix = np.vstack((column("CRPIX1"), column("CRPIX2"))).T
+        self.cdelt = np.vstack((column("CDELT1"), column("CDELT2"))).T
+        self.crval = np.vstack((column("CRVAL1"), column("CRVAL2"))).T
+        self.M = np.vstack([column("M%i" % (k + 1)) for k in xrange(3)]).T
+        self.R = np.empty((data.shape[-1], 3, 3), dtype=dtype)
+        for k in xrange(3):
+            for l in xrange(3):
+                self.R[:, k, l] = column("R%i_%i" % (k + 1, l + 1))
+        mh = cube.header
+        vector = lambda key: np.asarray([mh[key + str(k + 1)]
+                                         for k in xrange(3)], dtype=dtype)
+        self.voxel = vector("CDELT")
+        self.mmin = vector("MMIN")
+        self.mmax = vector("MMAX")
+        self.pshape = vector("PSHAPE")
+        self.shape = np.asarray(cube.shape[:3])
+
+    def unit_vectors(self, i, j, t):
+        """
+        Direction of the rays of pixels (i, j) of images t.
+        """
+        one = self.dtype.type(1)
+        gamma = (i - self.crpix[t, 0] + one) * self.cdelt[t, 0] + self.crval[t, 0]
+        lamb = (j - self.crpix[t, 1] + one) * self.cdelt[t, 1] + self.crval[t, 1]
+        u2 = np.empty((i.size, 3), dtype=self.dtype)
+        u2[:, 0] = np.cos(lamb) * np.cos(gamma)
+        u2[:, 1] = np.cos(lamb) * np.sin(gamma)
+        u2[:, 2] = np.sin(lamb)
+        R = self.R[t]
+        u = np.empty((i.size, 3), dtype=self.dtype)
+        for k in xrange(3):
+            u[:, k] = (R[:, k, 0] * u2[:, 0] + R[:, k, 1] * u2[:, 1]
+                       + R[:, k, 2] * u2[:, 2])
+        return u
+
+def trace(geometry, i, j, t, obstacle=None):
+    """
+    Intersections of the rays of pixels (i, j) of images t with the
+    voxels of the map.
+
+    Returns
+    -------
+    rays: 1d ndarray
+      Index of the ray (in i, j, t) of each intersection.
+    voxels: tuple of 3 1d ndarrays
+      Voxel subscripts of each intersection.
+    lengths: 1d ndarray
+      Length of each intersection.
+    """
+    g = geometry
+    dtype = g.dtype
+    u = g.unit_vectors(i, j, t)
+    M = g.M[t]
+    # intersections with the planes bounding the map
+    nonzero = u != 0
+    safe_u = np.where(nonzero, u, 1)
+    a1 = np.where(nonzero, (g.mmin - M) / safe_u, -INF).astype(dtype)
+    an = np.where(nonzero, (g.mmax - M) / safe_u, INF).astype(dtype)
+    amin = np.minimum(a1, an).max(axis=1)
+    amax = np.maximum(a1, an).min(axis=1)
+    # rays going through the map
+    rays = np.flatnonzero(amin < amax)
+    u, M, a1, amin = u[rays], M[rays], a1[rays], amin[rays]
+    nonzero = nonzero[rays]
+    # loop initialization
+    p = np.where(nonzero, g.voxel / np.where(nonzero, u, 1), INF).astype(dtype)
+    pabs = np.abs(p)
+    update = np.sign(u).astype(int)
+    ep = M + amin[:, np.newaxis] * u - g.mmin
+    iv = ((ep / g.voxel).astype(np.int64) - (ep / g.pshape).astype(np.int64))
+    next = np.where(update == 1, iv + 1, iv).astype(dtype)
+    next[update == 0] = INF * g.shape[np.nonzero(update == 0)[1]]
+    D = (next * p + a1 - amin[:, np.newaxis]).astype(dtype)
+    ac = amin
+    del ep, next, a1, nonzero
+    out_rays, out_voxels, out_lengths = [], [], []
+    while rays.size:
+        # still into the map and did not reach the obstacle
+        inside = np.all((iv >= 0) & (iv < g.shape), axis=1)
+        if obstacle == "sun":
+            inside &= np.sum((M + ac[:, np.newaxis] * u) ** 2, axis=1) > 1
+        if not inside.all():
+            rays, iv, D, ac = rays[inside], iv[inside], D[inside], ac[inside]
+            pabs, update = pabs[inside], update[inside]
+            M, u = M[inside], u[inside]
+            if rays.size == 0:
+                break
+        # cross the nearest voxel boundary (two or three at once if the
+        # ray goes through an edge or a corner)
+        d = D.min(axis=1)
+        out_rays.append(rays)
+        out_voxels.append(iv.copy())
+        out_lengths.append(d)
+        ac = ac + d
+        hit = D == d[:, np.newaxis]
+        D -= d[:, np.newaxis]
+        D[hit] = pabs[hit]
+        iv += update * hit
+    if len(out_rays) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, (empty, empty, empty), np.zeros(0, dtype=dtype)
+    voxels = np.concatenate(out_voxels)
+    return (np.concatenate(out_rays), tuple(voxels.T),
+            np.concatenate(out_lengths))
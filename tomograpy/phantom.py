@@ -18,6 +18,9 @@ Ellipsoid parameters are as follows:
 Alternatively, you can generate only one ellipsoid by calling
 the ellipsoid function.
 
+Phantoms can also be projected analytically into a data cube, without
+rasterising the cube, by calling the phantom_projector function.
+
 Exemple
 -------
 To generate a phantom cube of size 32 * 32 * 32 :
@@ -43,9 +46,15 @@ Nicolas Barbey
 """
 import numpy as np
 
-__all__ = ['phantom', 'shepp_logan', 'modified_shepp_logan', 'yu_ye_wang']
+__all__ = ['phantom', 'shepp_logan', 'modified_shepp_logan', 'yu_ye_wang',
+           'phantom_projector']
+
+# maximal number of voxels evaluated at once when rasterising an ellipsoid
+CHUNK_SIZE = 2 ** 22
+# to avoid division by zero (as in the siddon module)
+INF = 100000
 
-def phantom(shape, parameters_list, dtype=np.float64):
+def phantom(shape, parameters_list, dtype=np.float64, chunk_size=None):
     """
     Generate a cube of given shape using a list of ellipsoid
     parameters.
@@ -62,6 +71,9 @@ def phantom(shape, parameters_list, dtype=np.float64):
     dtype: data-type
         Data type of the output ndarray.
 
+    chunk_size: int (optional)
+        Maximal number of voxels evaluated at once (see CHUNK_SIZE).
+
     Output
     ------
     cube: 3-dimensional ndarray
@@ -76,22 +88,30 @@ def phantom(shape, parameters_list, dtype=np.float64):
 
     Notes
     -----
+    Only the voxels inside the bounding box of each ellipsoid are
+    evaluated, by chunks along the last axis, so that memory and time
+    scale with the volume of the ellipsoids and not with the volume of
+    the cube.
+
     http://en.wikipedia.org/wiki/Imaging_phantom
     """
     # instantiate ndarray cube
     cube = np.zeros(shape, dtype=dtype)
-    # define coordinates
-    coordinates = define_coordinates(shape)
     # recursively add ellipsoids to cube
     for parameters in parameters_list:
-        ellipsoid(parameters, out=cube, coordinates=coordinates)
+        ellipsoid(parameters, out=cube, chunk_size=chunk_size)
     return cube
 
-def ellipsoid(parameters, shape=None, out=None, coordinates=None):
+def ellipsoid(parameters, shape=None, out=None, coordinates=None,
+              chunk_size=None):
     """
     Generate a cube containing an ellipsoid defined by its parameters.
     If out is given, fills the given cube instead of creating a new
     one.
+
+    If coordinates are given, the ellipsoid is evaluated on those full
+    coordinates, otherwise only the voxels of its bounding box are
+    evaluated (see phantom).
     """
     # handle inputs
     if shape is None and out is None:
@@ -107,7 +127,8 @@ def ellipsoid(parameters, shape=None, out=None, coordinates=None):
     elif len(shape) > 3:
         raise ValueError("input shape must be lower or equal to 3")
     if coordinates is None:
-        coordinates = define_coordinates(shape)
+        _ellipsoid_bounding_box(parameters, out.reshape(shape), chunk_size)
+        return out
     # rotate coordinates
     coords = transform(coordinates, parameters)
     # recast as ndarray
@@ -121,6 +142,61 @@ def ellipsoid(parameters, shape=None, out=None, coordinates=None):
     out[(x ** 2 + y ** 2 + z ** 2) <= 1.] += parameters['A']
     return out
 
+def _ellipsoid_bounding_box(parameters, out, chunk_size=None):
+    """
+    Add an ellipsoid to a 3d cube evaluating only the voxels inside
+    its bounding box, by chunks along the last axis.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    shape = out.shape
+    axes = [define_axis(n) for n in shape]
+    slices = bounding_box(parameters, shape)
+    if any([s.start >= s.stop for s in slices]):
+        return out
+    x = axes[0][slices[0], np.newaxis, np.newaxis]
+    y = axes[1][np.newaxis, slices[1], np.newaxis]
+    z = axes[2][np.newaxis, np.newaxis, slices[2]]
+    # chunks along the last axis
+    nxy = x.size * y.size
+    step = max(1, chunk_size // nxy)
+    for k in xrange(0, z.size, step):
+        zk = z[..., k:k + step]
+        coords = transform((x, y, zk), parameters)
+        xk, yk, zk = coords
+        inside = (xk ** 2 + yk ** 2 + zk ** 2) <= 1.
+        k0 = slices[2].start + k
+        sub = out[slices[0], slices[1], k0:k0 + inside.shape[-1]]
+        sub[inside] += parameters['A']
+    return out
+
+def bounding_box(parameters, shape):
+    """
+    Returns the slices of the voxels of a cube of given shape which
+    can be inside an ellipsoid.
+
+    The axis-aligned bounding box is computed analytically from the
+    rotation matrix, the axis lengths and the position of the center.
+    It is extended by one voxel on each side to be robust to rounding.
+    """
+    alpha = rotation_matrix(parameters)
+    M0 = np.asarray([parameters['x0'], parameters['y0'], parameters['z0']])
+    sc = np.asarray([parameters['a'], parameters['b'], parameters['c']])
+    # ellipsoid points are alpha.T * (M0 + sc * s) with |s| <= 1
+    center = np.dot(alpha.T, M0)
+    extent = np.sqrt(np.sum((alpha * sc[:, np.newaxis]) ** 2, axis=0))
+    slices = list()
+    for c, e, n in zip(center, extent, shape):
+        if n == 1:
+            slices.append(slice(0, 1))
+            continue
+        # coordinates are linearly spaced between -1 and 1
+        step = 2. / (n - 1)
+        imin = int(np.floor((c - e + 1.) / step)) - 1
+        imax = int(np.ceil((c + e + 1.) / step)) + 2
+        slices.append(slice(min(max(imin, 0), n), min(max(imax, 0), n)))
+    return tuple(slices)
+
 def rotation_matrix(p):
     """
     Defines an Euler rotation matrix from angles phi, theta and psi.
@@ -155,6 +231,14 @@ def define_coordinates(shape):
     x, y, z = mgrid[-1:1:cshape[0], -1:1:cshape[1], -1:1:cshape[2]]
     return x, y, z
 
+def define_axis(n):
+    """
+    Generate the 1d coordinates of an axis of length n, as along each
+    axis of define_coordinates.
+    """
+    mgrid = np.lib.index_tricks.nd_grid()
+    return mgrid[-1:1:np.asarray(1j) * n]
+
 def transform(coordinates, p):
     """
     Apply rotation, translation and rescaling to a 3-tuple of
@@ -170,6 +254,136 @@ def transform(coordinates, p):
     out_coords = [(u - u0) / su for u, u0, su in zip(out_coords, M0, sc)]
     return out_coords
 
+# analytic projection of phantoms
+def phantom_projector(data, cube, parameters_list, mask=None, obstacle=None,
+                      chunk_size=None):
+    """
+    Project analytically a phantom defined by a list of ellipsoid
+    parameters into a data cube, without rasterising the cube.
+
+    The geometry is the one of siddon.projector: images are defined by
+    their headers and the phantom fills the map defined by the cube
+    header, its coordinates ranging from -1 to 1 between the centers of
+    the first and last voxels along each axis. The exact chord length
+    of each ray through each ellipsoid is computed, for all rays of a
+    stack at once (by chunks of at most chunk_size rays).
+
+    The data cube is updated in-place, as with siddon.projector.
+
+    Arguments
+    ---------
+    data : 3d InfoArray
+      Contains a concatenation of FitsArray images along a 3rd dimension.
+    cube : 3d FitsArray or dict
+      The map cube or its header.
+    parameters_list: list of dictionaries
+      List of dictionaries with the parameters defining the ellipsoids.
+    mask : ndarray (optional)
+      Rays where mask is not zero are not projected.
+    obstacle : {None, "sun"}
+      If obstacle="sun", the integration is stopped when the ray reaches
+      a sphere of radius one.
+
+    Returns
+    -------
+    data : 3d InfoArray
+       The updated data cube.
+    """
+    import siddon
+    from stack import get_column
+    if obstacle not in (None, "sun"):
+        raise ValueError("obstacle should be None or 'sun'")
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    h = getattr(cube, "header", cube)
+    naxis = np.asarray([h['NAXIS' + str(i + 1)] for i in xrange(3)], dtype=float)
+    crpix = np.asarray([h['CRPIX' + str(i + 1)] for i in xrange(3)], dtype=float)
+    cdelt = np.asarray([h['CDELT' + str(i + 1)] for i in xrange(3)], dtype=float)
+    # physical borders of the map (see siddon.map_borders)
+    mmin = - crpix * cdelt
+    mmax = mmin + naxis * cdelt
+    # phantom coordinates to physical coordinates
+    scale = np.maximum(naxis - 1, 1) / 2. * cdelt
+    origin = ((naxis - 1) / 2. + .5 - crpix) * cdelt
+    # image metadata
+    try:
+        R = np.asarray([[get_column(data.header, 'R%i_%i' % (i + 1, j + 1))
+                         for j in xrange(3)] for i in xrange(3)])
+        R = R.transpose((2, 0, 1))
+    except(KeyError):
+        R = siddon.rotation_matrix(get_column(data.header, 'LON'),
+                                    get_column(data.header, 'LAT'),
+                                    get_column(data.header, 'ROL'))
+    M = np.asarray([get_column(data.header, 'M' + str(i + 1))
+                    for i in xrange(3)]).T
+    get = lambda key, default: get_column(data.header, key, default)
+    crpix1, crpix2 = get('CRPIX1', 0.), get('CRPIX2', 0.)
+    cdelt1, cdelt2 = get('CDELT1', 1.), get('CDELT2', 1.)
+    crval1, crval2 = get('CRVAL1', 0.), get('CRVAL2', 0.)
+    # ellipsoids in the frame where they are unit spheres
+    ellipsoids = list()
+    for p in parameters_list:
+        alpha = rotation_matrix(p) / scale[np.newaxis]
+        sc = np.asarray([p['a'], p['b'], p['c']], dtype=float)
+        M0 = np.asarray([p['x0'], p['y0'], p['z0']], dtype=float)
+        ellipsoids.append((p['A'], alpha / sc[:, np.newaxis],
+                           (np.dot(alpha, origin) + M0) / sc))
+    # loop on chunks of images
+    n1, n2, nt = data.shape
+    step = max(1, chunk_size // (n1 * n2))
+    for t0 in xrange(0, nt, step):
+        s = slice(t0, t0 + step)
+        # unit vectors of all rays (as pixel2physical and
+        # define_rotated_unit_vector in the C code)
+        gamma = ((np.arange(n1)[:, np.newaxis] - crpix1[s] + 1) * cdelt1[s]
+                 + crval1[s])[:, np.newaxis]
+        lamb = ((np.arange(n2)[:, np.newaxis] - crpix2[s] + 1) * cdelt2[s]
+                + crval2[s])[np.newaxis]
+        u2 = np.empty(gamma.shape[:1] + lamb.shape[1:] + (3,))
+        u2[..., 0] = np.cos(lamb) * np.cos(gamma)
+        u2[..., 1] = np.cos(lamb) * np.sin(gamma)
+        u2[..., 2] = np.sin(lamb)
+        u = np.einsum('tij,xytj->xyti', R[s], u2)
+        del u2
+        Ms = M[s]
+        # intersection with the map
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a1 = (mmin - Ms) / u
+            an = (mmax - Ms) / u
+        a1[u == 0] = - INF
+        an[u == 0] = INF
+        amin = np.minimum(a1, an).max(axis=-1)
+        amax = np.maximum(a1, an).min(axis=-1)
+        del a1, an
+        # stop the rays at the sun
+        if obstacle == "sun":
+            b = np.sum(Ms * u, axis=-1)
+            c = np.sum(Ms ** 2, axis=-1) - 1.
+            disc = b ** 2 - c
+            hit = disc > 0
+            sq = np.sqrt(np.where(hit, disc, 0.))
+            entry, leave = - b - sq, - b + sq
+            amax = np.where(hit * (entry >= amin), np.minimum(amax, entry),
+                            amax)
+            amax = np.where(hit * (entry < amin) * (leave > amin), amin, amax)
+        # sum of the chord lengths times the ellipsoid values
+        out = np.zeros(u.shape[:-1])
+        for A, B, C in ellipsoids:
+            v = np.einsum('ij,xytj->xyti', B, u)
+            s0 = np.einsum('ij,tj->ti', B, Ms) - C
+            a = np.sum(v ** 2, axis=-1)
+            b = np.sum(s0 * v, axis=-1)
+            c = np.sum(s0 ** 2, axis=-1) - 1.
+            disc = b ** 2 - a * c
+            sq = np.sqrt(np.maximum(disc, 0.))
+            lo = np.maximum((- b - sq) / a, amin)
+            hi = np.minimum((- b + sq) / a, amax)
+            out += A * np.maximum(hi - lo, 0.)
+        if mask is not None:
+            out[np.asarray(mask[..., s]) != 0] = 0.
+        data[..., s] += out
+    return data
+
 # specific phantom parameters
 
 # mandatory parameters to define an ellipsoid
@@ -0,0 +1,176 @@
+"""
+Prepared data stacks stored in a memory-mappable format.
+
+Reading a data set (decoding the FITS files, updating the headers,
+binning, sorting, ...) is much slower than reading the resulting
+stack. A prepared stack is saved in a directory as:
+
+- data.raw: the raw array in C order (mapped at offset 0, thus
+  aligned on a page),
+
+- headers.npz: the shape and dtype of the array, the state of the
+  source files (see cache.directory_state) and the headers stored as
+  columns (see stack.header_columns).
+
+load_stack maps the array read-only (without copy) and makes a
+HeaderTable of its columns, whose headers are only built when they are
+accessed as dicts. Rotation matrices are computed before
+saving so that loaded stacks are ready to be projected. A stack saved
+with the state of its source files is not loaded anymore once they are
+modified.
+
+Exemple
+-------
+>>> data = prepared_data(path, "/tmp/prepared", bin_factor=4,
+...                      instrume="EUVI", tmin=t0, tmax=t1)
+>>> save_stack("/tmp/stack", data, sources=directory_state(path))
+>>> data = load_stack("/tmp/stack", sources=directory_state(path))
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+from stack import as_data_stack, header_columns, header_table_from_columns
+
+# version of the format, stored in the sidecar
+FORMAT_VERSION = 1
+data_name = "data.raw"
+header_name = "headers.npz"
+
+def save_stack(directory, data, sources=None):
+    """
+    Save a data stack in a directory (replaced if it exists).
+
+    Arguments
+    ---------
+    directory: str
+      The directory of the stack.
+    data: InfoArray
+      A data stack with a list of headers (or a HeaderTable).
+    sources: list (optional)
+      The state of the source files (see cache.directory_state).
+    """
+    import siddon
+    from stack import HeaderTable
+    data = as_data_stack(data)
+    if (len(data.header) and not data.header.has_column('R1_1') and
+        data.header.has_column('LON')):
+        # make a copy of the headers before adding the rotation matrices
+        data = as_data_stack(data, HeaderTable([dict(h) for h in data.header]))
+        siddon.full_rotation_matrix(data)
+    columns, missing = header_columns(data.header)
+    keys = sorted(columns)
+    sidecar = {"version":np.asarray(FORMAT_VERSION),
+               "shape":np.asarray(data.shape, dtype=np.int64),
+               "dtype":np.asarray(data.dtype.str),
+               "keys":np.asarray(keys, dtype=object)}
+    if sources is not None:
+        sidecar["sources"] = _sources_array(sources)
+    for i, key in enumerate(keys):
+        sidecar["c%i" % i] = columns[key]
+        if key in missing:
+            sidecar["m%i" % i] = missing[key]
+    parent = os.path.dirname(os.path.abspath(directory))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    # written in a temporary directory which is then renamed
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(directory), dir=parent)
+    try:
+        np.ascontiguousarray(data).tofile(os.path.join(tmp, data_name))
+        np.savez(os.path.join(tmp, header_name), **sidecar)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp, directory)
+    except:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        raise
+
+def load_stack(directory, sources=None, mmap_mode="r"):
+    """
+    Load a stack saved by save_stack.
+
+    Arguments
+    ---------
+    directory: str
+      The directory of the stack.
+    sources: list (optional)
+      The current state of the source files. If given, the stack is
+      only loaded if it was saved with the same state.
+    mmap_mode: {"r", "r+", "c", None}
+      Memory-map mode of the array (see numpy.memmap). If None, the
+      array is read in memory.
+
+    Returns
+    -------
+    A DataStack, or None if there is no such stack or if it is out of
+    date.
+    """
+    filename = os.path.join(directory, header_name)
+    if not os.path.isfile(filename):
+        return None
+    sidecar = np.load(filename, allow_pickle=True)
+    try:
+        if int(sidecar["version"]) != FORMAT_VERSION:
+            return None
+        if sources is not None:
+            if "sources" not in sidecar.files:
+                return None
+            stored = sidecar["sources"]
+            current = _sources_array(sources)
+            if stored.shape != current.shape or np.any(stored != current):
+                return None
+        shape = tuple(sidecar["shape"])
+        dtype = np.dtype(str(sidecar["dtype"]))
+        keys = sidecar["keys"].tolist()
+        columns = dict()
+        missing = dict()
+        for i, key in enumerate(keys):
+            columns[key] = sidecar["c%i" % i]
+            if "m%i" % i in sidecar.files:
+                missing[key] = sidecar["m%i" % i]
+    finally:
+        sidecar.close()
+    header = header_table_from_columns(columns, missing)
+    if len(header) == 0:
+        header = [dict() for i in xrange(shape[-1])]
+    data_file = os.path.join(directory, data_name)
+    if mmap_mode is None:
+        data = np.fromfile(data_file, dtype=dtype).reshape(shape)
+    elif np.prod(shape) == 0:
+        data = np.empty(shape, dtype=dtype)
+    else:
+        data = np.memmap(data_file, dtype=dtype, mode=mmap_mode, shape=shape)
+    return as_data_stack(data, header)
+
+def _sources_array(sources):
+    "The state of the source files as a comparable array."
+    return np.asarray([repr(tuple(s)) for s in sources], dtype=object)
+
+def prepared_data(path, directory, **kwargs):
+    """
+    Read a data set (as solar.read_data followed by
+    solar.sort_data_array) through a directory of prepared stacks.
+
+    The stack of each set of arguments is saved in a subdirectory of
+    directory and loaded instead of being read again while the files
+    of path do not change.
+
+    Returns
+    -------
+    A memory-mapped DataStack, or None if no file matches.
+    """
+    import solar
+    from cache import directory_state
+    from checkpoint import config_key
+    entry = os.path.join(directory, config_key(os.path.abspath(path), kwargs))
+    sources = directory_state(path)
+    data = load_stack(entry, sources=sources)
+    if data is not None:
+        return data
+    data = solar.read_data(path, **kwargs)
+    if data is None:
+        return None
+    data = solar.sort_data_array(data)
+    save_stack(entry, data, sources=sources)
+    return load_stack(entry)
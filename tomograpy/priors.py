@@ -0,0 +1,267 @@
+"""
+Smoothness priors.
+
+A smoothness prior is a list of finite difference operators D_i (one
+per axis of the map), optionally weighted (height prior) and masked.
+Optimizers from lo use this list directly. Solvers which only need
+the normal operator sum_i h_i D_i^T D_i can use
+SmoothnessPrior.normal instead. It computes the sum in a single sweep
+over slabs of the cube, in several threads, without evaluating each
+D_i and D_i^T as separate operators.
+
+Priors of compressed maps (whose input is the vector of the active
+voxels, see siddon.active_voxels) are sparse matrices holding only the
+differences involving active voxels, and their normal operator is a
+single sparse matrix.
+
+Exemple
+-------
+>>> D = SmoothnessPrior(cube.shape)
+>>> DtD = D.normal((.1, .1, .1))
+>>> y = DtD * x.ravel()
+"""
+import numpy as np
+import lo
+
+# maximal size of the slabs swept by difference_normal
+SLAB_BYTES = 2 ** 22
+
+class SmoothnessPrior(list):
+    """
+    Finite difference operators along each axis of a map.
+
+    Arguments
+    ---------
+    shape: tuple
+      Shape of the map (3d or 4d).
+    weights: ndarray of shape shape (optional)
+      The map is multiplied by weights before differentiation.
+    mask: boolean ndarray of shape shape (optional)
+      Masked voxels (True) are set to zero (as lo.ndmask).
+    index: 1d int ndarray (optional)
+      Flat indexes of the active voxels if the operators input is a
+      compressed vector (as lo.decimate or siddon.active_voxels).
+    """
+    def __init__(self, shape, weights=None, mask=None, index=None,
+                 dtype=np.float64):
+        self.shape = tuple(shape)
+        self.weights = weights
+        self.mask = mask
+        self.index = index
+        self.dtype = dtype
+        D = [lo.diff(self.shape, axis=i, dtype=dtype)
+             for i in xrange(len(self.shape))]
+        if weights is not None:
+            W = lo.diag(np.asarray(weights).ravel())
+            D = [Di * W for Di in D]
+        self.sparse = None
+        if index is not None:
+            # differences between the active voxels only
+            self.sparse = compressed_differences(self.shape, index,
+                                                 weights=weights, dtype=dtype)
+            D = [_sparse_lo(Di) for Di in self.sparse]
+        elif mask is not None:
+            Mo = lo.ndmask(mask, dtype=dtype)
+            D = [Di * Mo.T for Di in D]
+        list.__init__(self, D)
+
+    def masked(self, mask, decimate=False):
+        """
+        The same prior with masked voxels. If decimate is True the
+        input is the vector of unmasked voxels.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if decimate:
+            return self.compressed(np.flatnonzero(~mask))
+        return SmoothnessPrior(self.shape, weights=self.weights, mask=mask,
+                               dtype=self.dtype)
+
+    def compressed(self, index):
+        """
+        The same prior on the compressed vector of active voxels.
+        """
+        return SmoothnessPrior(self.shape, weights=self.weights, index=index,
+                               dtype=self.dtype)
+
+    def normal(self, hypers, nthread=None):
+        """
+        The operator sum_i hypers[i] * D_i^T D_i as a LinearOperator.
+        """
+        if len(hypers) != len(self.shape):
+            raise ValueError("There should be one hyperparameter per axis.")
+        if self.index is not None:
+            DtD = self._sparse_normal(hypers)
+            n = self.index.size
+            return lo.ndoperator((n,), (n,), DtD.dot, DtD.dot,
+                                 dtype=self.dtype)
+        size = np.prod(self.shape)
+        weights = self.weights
+        if weights is not None:
+            weights = np.asarray(weights).reshape(self.shape)
+        def matvec(x):
+            y = np.array(x, dtype=self.dtype).reshape(self.shape)
+            if self.mask is not None:
+                y[self.mask] = 0.
+            if weights is not None:
+                y *= weights
+            out = difference_normal(y, hypers, nthread=nthread)
+            if weights is not None:
+                out *= weights
+            if self.mask is not None:
+                out[self.mask] = 0.
+            return out.ravel()
+        return lo.ndoperator((size,), (size,), matvec, matvec,
+                             dtype=self.dtype)
+
+    def _sparse_normal(self, hypers):
+        "sum_i hypers[i] * D_i^T D_i of a compressed prior as a sparse matrix."
+        import scipy.sparse
+        n = self.index.size
+        DtD = scipy.sparse.csr_matrix((n, n), dtype=self.dtype)
+        for h, Di in zip(hypers, self.sparse):
+            if h != 0:
+                DtD = DtD + h * (Di.T * Di)
+        return DtD.tocsr()
+
+    def diagonal(self, hypers):
+        """
+        The diagonal of sum_i hypers[i] * D_i^T D_i as a vector.
+        """
+        if len(hypers) != len(self.shape):
+            raise ValueError("There should be one hyperparameter per axis.")
+        if self.index is not None:
+            d = np.zeros(self.index.size, dtype=self.dtype)
+            for h, Di in zip(hypers, self.sparse):
+                if h != 0:
+                    d += h * np.asarray(Di.multiply(Di).sum(axis=0)).ravel()
+            return d
+        ndim = len(self.shape)
+        d = np.zeros(self.shape, dtype=self.dtype)
+        for axis, h in enumerate(hypers):
+            n = self.shape[axis]
+            if h == 0 or n < 2:
+                continue
+            # number of differences involving each voxel along axis
+            c = 2. * np.ones(n)
+            c[0] = c[-1] = 1.
+            s = [1] * ndim
+            s[axis] = n
+            d += h * c.reshape(s)
+        if self.weights is not None:
+            d *= np.asarray(self.weights).reshape(self.shape) ** 2
+        if self.mask is not None:
+            d[self.mask] = 0.
+        return d.ravel()
+
+def compressed_differences(shape, index, weights=None, dtype=np.float64):
+    """
+    Finite differences along each axis of a map whose input is the
+    vector of its active voxels index (inactive voxels are zero).
+
+    Only the differences involving at least one active voxel are
+    kept, so the operators scale with the number of active voxels
+    instead of the size of the map.
+
+    Returns
+    -------
+    A list of scipy.sparse CSR matrices (one per axis) with two (or one
+    at the border of the active set) nonzero values per row.
+    """
+    import scipy.sparse
+    shape = tuple(shape)
+    n = index.size
+    # position of each voxel in the compressed vector (-1 if inactive)
+    position = -np.ones(shape, dtype=np.int64)
+    position.flat[index] = np.arange(n)
+    if weights is not None:
+        w = np.asarray(weights, dtype=dtype).ravel()[index]
+    else:
+        w = np.ones(n, dtype=dtype)
+    D = []
+    for axis in xrange(len(shape)):
+        lo_s = [slice(None)] * len(shape)
+        hi_s = [slice(None)] * len(shape)
+        lo_s[axis] = slice(None, -1)
+        hi_s[axis] = slice(1, None)
+        a = position[tuple(lo_s)].ravel()
+        b = position[tuple(hi_s)].ravel()
+        keep = (a >= 0) | (b >= 0)
+        a, b = a[keep], b[keep]
+        rows = np.arange(a.size)
+        # D x = x[b] - x[a] (zero for inactive voxels)
+        ia, ib = a >= 0, b >= 0
+        r = np.concatenate((rows[ib], rows[ia]))
+        c = np.concatenate((b[ib], a[ia]))
+        v = np.concatenate((w[b[ib]], - w[a[ia]]))
+        D.append(scipy.sparse.csr_matrix((v, (r, c)), shape=(a.size, n),
+                                         dtype=dtype))
+    return D
+
+def _sparse_lo(A):
+    "A sparse matrix as a linear operator."
+    AT = A.T.tocsr()
+    return lo.ndoperator((A.shape[1],), (A.shape[0],), A.dot, AT.dot,
+                         dtype=A.dtype)
+
+def difference_normal(x, hypers, out=None, nthread=None):
+    """
+    Computes sum_i hypers[i] * D_i^T D_i x where D_i is the finite
+    difference along axis i of x.
+
+    The map is swept once: it is divided in slabs along its first axis
+    (of at most SLAB_BYTES bytes) which are processed in parallel
+    threads. Each thread adds the differences along all axes to its
+    slab of out, reading x on the neighbouring rows of the slab for the
+    first axis. Differences are computed from shifted slices of x into
+    a scratch array of the size of a slab, so that no full-size
+    temporary is allocated.
+    """
+    from solar import _thread_map
+    if out is None:
+        out = np.empty(x.shape, dtype=x.dtype)
+    n = x.shape[0]
+    if n == 0:
+        return out
+    nslabs = max(_nslabs(nthread), int(np.ceil(x.nbytes / float(SLAB_BYTES))))
+    bounds = np.linspace(0, n, min(n, nslabs) + 1).astype(int)
+    def update(b):
+        r0, r1 = b
+        o = out[r0:r1]
+        o[:] = 0.
+        # one more row for the differences across the slab borders
+        buf = np.empty((r1 - r0 + 1,) + x.shape[1:], dtype=out.dtype)
+        for axis, h in enumerate(hypers):
+            if h == 0 or x.shape[axis] < 2:
+                continue
+            if axis == 0:
+                # differences x[i] - x[i - 1] for i in [p0, p1)
+                p0, p1 = max(r0, 1), min(r1 + 1, n)
+                if p0 >= p1:
+                    continue
+                d = buf[:p1 - p0]
+                np.subtract(x[p0:p1], x[p0 - 1:p1 - 1], out=d)
+                d *= h
+                # added to row i and subtracted from row i - 1
+                o[p0 - r0:] += d[:r1 - p0]
+                k = r0 - p0 + 1
+                o[:p1 - 1 - r0] -= d[k:]
+            else:
+                lo_s = [slice(None)] * x.ndim
+                hi_s = [slice(None)] * x.ndim
+                lo_s[axis] = slice(None, -1)
+                hi_s[axis] = slice(1, None)
+                lo_s, hi_s = tuple(lo_s), tuple(hi_s)
+                xs = x[r0:r1]
+                d = buf[:r1 - r0][hi_s]
+                np.subtract(xs[hi_s], xs[lo_s], out=d)
+                d *= h
+                o[hi_s] += d
+                o[lo_s] -= d
+    _thread_map(update, zip(bounds[:-1], bounds[1:]), nthread=nthread)
+    return out
+
+def _nslabs(nthread):
+    from multiprocessing import cpu_count
+    if nthread is None:
+        nthread = cpu_count()
+    return max(nthread, 1)
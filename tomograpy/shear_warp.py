@@ -0,0 +1,368 @@
+"""
+An approximate parallel-beam projector for distant observers.
+
+Seen from about 215 solar radii, the rays of an image crossing a map of
+a few solar radii are nearly parallel. A view is approximated by
+parallel rays of direction d (from the viewpoint to the map center),
+each passing through the point of its conic ray which is the closest
+to the map center. Such a view is projected by shear-warp:
+
+- the map is cut in slices along the axis closest to d,
+
+- each slice is shifted (sheared) by the displacement of the rays
+  between this slice and the first one, and added to an intermediate
+  image, using bilinear interpolation,
+
+- the intermediate image is interpolated at the position of the ray of
+  each pixel (warp).
+
+All the operations are done on whole slices and images. The
+backprojection is the exact transpose of the projection.
+
+The error of the approximation is bounded by the displacement between
+the parallel and conic rays inside the map: |u - d| times the half
+diagonal of the map for a pixel of direction u. Views whose bound
+(in voxels) is above a tolerance are projected with the exact (conic)
+Siddon projector.
+
+With the "sun" obstacle, the intermediate images are cumulative sums
+of the slices in the direction of the rays, and each pixel reads the
+sum up to the slice where its ray reaches the sphere of radius one.
+
+Exemple
+-------
+>>> P = ShearWarpProjector(data, cube, obstacle="sun", tolerance=2.)
+>>> P.report()
+>>> P.project(cube, out=data, accumulate=False)
+"""
+import numpy as np
+import fitsarray as fa
+
+# default tolerance on the error bound of parallel views, in voxels
+TOLERANCE = 2.
+
+class ShearWarpProjector(object):
+    """
+    Projector of a map on a data stack using the parallel-beam
+    approximation for the views whose error bound is below tolerance.
+
+    Arguments
+    ---------
+    data: 3d InfoArray
+      The data stack (only its shape, dtype and header are used).
+    cube: 3d InfoArray
+      The map (only its shape and header are used).
+    mask: 3d ndarray (optional)
+      Pixels where mask is not zero are not projected.
+    obstacle: {None, "sun"}
+      If "sun", rays stop at the sphere of radius one.
+    tolerance: float
+      Maximal error bound (in voxels) of a parallel view.
+
+    Other keyword arguments are passed to the Siddon projectors of the
+    conic views (nthread, engine).
+
+    Attributes
+    ----------
+    errors: 1d ndarray
+      Error bound of each view in voxels.
+    cone_angles: 1d ndarray
+      Largest angle between a ray and the direction of each view.
+    parallel: 1d boolean ndarray
+      Views projected with the parallel-beam approximation.
+    """
+    def __init__(self, data, cube, mask=None, obstacle=None,
+                 tolerance=TOLERANCE, **kwargs):
+        import siddon
+        from numpy_siddon import ImageGeometry
+        if obstacle not in (None, "sun"):
+            raise ValueError("obstacle should be None or 'sun'")
+        if cube.ndim != 3:
+            raise ValueError("cube should be a 3d map")
+        siddon.check_projector_inputs(data, cube)
+        self.data_header = data.header
+        self.map_header = dict(cube.header)
+        self.data_shape = data.shape
+        self.map_shape = cube.shape
+        self.dtype = data.dtype
+        self.obstacle = obstacle
+        self.tolerance = tolerance
+        self.kwargs = kwargs
+        mask = siddon.data_mask_array(data, mask)
+        g = ImageGeometry(data, cube)
+        nt = data.shape[-1]
+        self.views = [None] * nt
+        self.errors = np.zeros(nt)
+        self.cone_angles = np.zeros(nt)
+        for t in xrange(nt):
+            view = _parallel_view(g, t, mask[..., t], cube.shape, obstacle)
+            self.errors[t] = view["error"]
+            self.cone_angles[t] = view["cone_angle"]
+            if view["error"] <= tolerance:
+                self.views[t] = view
+        self.parallel = np.asarray([v is not None for v in self.views])
+        # conic views are projected by Siddon with parallel views masked
+        self.conic_mask = mask.copy()
+        self.conic_mask[..., self.parallel] = 1
+
+    def report(self):
+        "Print the number of parallel views and the error bounds."
+        print("shear-warp: %i/%i parallel views, cone angle < %.2e rad, "
+              "error bound < %.2f voxels" % (
+                  self.parallel.sum(), self.parallel.size,
+                  self.cone_angles[self.parallel].max() if self.parallel.any()
+                  else 0., self.errors[self.parallel].max()
+                  if self.parallel.any() else 0.))
+
+    def project(self, cube, out=None, accumulate=False):
+        """
+        Projection of the map cube. It is written in out (or added to it
+        if accumulate is True) or in a new data stack.
+        """
+        import siddon
+        cube = _with_header(cube, self.map_header, self.map_shape, self.dtype)
+        if out is None:
+            out = np.zeros(self.data_shape, dtype=self.dtype)
+        elif not accumulate:
+            out[:] = 0
+        data = _with_header(out, self.data_header, self.data_shape,
+                            self.dtype)
+        if not self.parallel.all():
+            siddon.projector(data, cube, mask=self.conic_mask,
+                             obstacle=self.obstacle, out=out, **self.kwargs)
+        slices = {}
+        for t, view in enumerate(self.views):
+            if view is None:
+                continue
+            perm = view["perm"]
+            if perm not in slices:
+                slices[perm] = np.ascontiguousarray(np.transpose(cube, perm))
+            image = _shear(slices[perm], view)
+            values = _warp(image, view)
+            out[view["i"], view["j"], t] += values
+        return out
+
+    def backproject(self, data, out=None, accumulate=False):
+        """
+        Backprojection of the data stack. It is written in out (or added
+        to it if accumulate is True) or in a new map.
+        """
+        import siddon
+        data = _with_header(data, self.data_header, self.data_shape,
+                            self.dtype)
+        if out is None:
+            out = np.zeros(self.map_shape, dtype=self.dtype)
+        elif not accumulate:
+            out[:] = 0
+        if not self.parallel.all():
+            cube = _with_header(out, self.map_header, self.map_shape,
+                                self.dtype)
+            siddon.backprojector(data, cube, mask=self.conic_mask,
+                                 obstacle=self.obstacle, out=out,
+                                 **self.kwargs)
+        slices = {}
+        for t, view in enumerate(self.views):
+            if view is None:
+                continue
+            perm = view["perm"]
+            if perm not in slices:
+                slices[perm] = np.zeros(np.take(self.map_shape, perm),
+                                        dtype=self.dtype)
+            image = _warp_transpose(data[view["i"], view["j"], t], view)
+            _shear_transpose(image, slices[perm], view)
+        for perm, s in slices.iteritems():
+            out += np.transpose(s, np.argsort(perm))
+        return out
+
+def _with_header(x, header, shape, dtype):
+    x = np.asarray(x, dtype=dtype).reshape(shape).view(fa.InfoArray)
+    x.header = header
+    return x
+
+def _parallel_view(g, t, mask, shape, obstacle):
+    """
+    Geometry of the parallel-beam approximation of image t.
+
+    Returns a dict with the permutation of the map axes (dominant
+    axis first), the offsets of the slices in the intermediate image,
+    the positions of the pixels in the intermediate image, the slice
+    where the ray of each pixel stops (with an obstacle), the length of
+    the rays in a slice, the error bound and the cone angle.
+    """
+    dtype = g.dtype
+    i, j = np.nonzero(mask == 0)
+    u = g.unit_vectors(i, j, np.repeat(t, i.size)).astype(float)
+    M = g.M[t].astype(float)
+    voxel = np.abs(g.voxel.astype(float))
+    mmin = g.mmin.astype(float)
+    center = .5 * (mmin + g.mmax.astype(float))
+    # direction of the view
+    d = center - M
+    d /= np.sqrt(np.sum(d ** 2))
+    # error bound and cone angle
+    half_diag = .5 * np.sqrt(np.sum((voxel * np.asarray(shape)) ** 2))
+    if i.size:
+        error = np.sqrt(np.sum((u - d) ** 2, axis=1)).max()
+        cone_angle = np.arccos(np.clip(np.dot(u, d), -1., 1.)).max()
+    else:
+        error = cone_angle = 0.
+    error *= half_diag / voxel.min()
+    # closest point of each conic ray to the map center
+    P = M + np.dot(center - M, u.T)[:, np.newaxis] * u
+    # slices along the dominant axis k of the direction
+    k = int(np.argmax(np.abs(d)))
+    a, b = [l for l in xrange(3) if l != k]
+    perm = (k, a, b)
+    nk = shape[k]
+    z0 = mmin[k] + .5 * voxel[k]
+    # displacement of the rays from a slice to the next, in voxels
+    step = voxel[k] * d[[a, b]] / d[k] / voxel[[a, b]]
+    sigma = np.arange(nk)[:, np.newaxis] * step
+    pad = np.ceil(np.maximum(sigma.max(axis=0), 0)).astype(int) + 1
+    extra = np.ceil(np.maximum(- sigma.min(axis=0), 0)).astype(int) + 2
+    base_shape = (shape[a] + pad[0] + extra[0], shape[b] + pad[1] + extra[1])
+    # slice index = intermediate image index + offset
+    offsets = sigma - pad
+    # position of the rays in the first slice, in intermediate image
+    # indices
+    q = P + ((z0 - P[:, k]) / d[k])[:, np.newaxis] * d
+    coords = np.empty((i.size, 2))
+    for n, l in enumerate((a, b)):
+        coords[:, n] = (q[:, l] - mmin[l]) / voxel[l] - .5 + pad[n]
+    view = dict(i=i, j=j, perm=perm, offsets=offsets, base_shape=base_shape,
+                coords=coords, length=dtype.type(voxel[k] / abs(d[k])),
+                error=error, cone_angle=cone_angle, order=None, stop=None)
+    if obstacle == "sun":
+        # slices in the direction of the rays
+        order = np.arange(nk) if d[k] > 0 else np.arange(nk)[::-1]
+        # abscissa (from P) where each ray enters the slices and the
+        # sphere (as Siddon, the slice where the ray enters the sphere
+        # is included)
+        s = (z0 + order * voxel[k] - P[:, k, np.newaxis]) / d[k]
+        s -= .5 * voxel[k] / abs(d[k])
+        sc = - np.dot(P, d)
+        dist2 = np.sum(P ** 2, axis=1) - sc ** 2
+        hit = dist2 < 1.
+        entry = np.where(hit, sc - np.sqrt(np.maximum(1. - dist2, 0.)), np.inf)
+        # last slice of each ray (-1 if the ray stops before the map)
+        view["stop"] = np.sum(s < entry[:, np.newaxis], axis=1) - 1
+        view["order"] = order
+    return view
+
+def _shifted_ranges(n_base, n_slice, offset):
+    """
+    Integer ranges of intermediate image indices m and slice indices
+    m + offset which are both valid.
+    """
+    m0 = max(0, - offset)
+    m1 = min(n_base, n_slice - offset)
+    return m0, m1, m0 + offset, m1 + offset
+
+def _corners(offset):
+    """
+    Integer offsets and bilinear weights of a fractional offset.
+    """
+    io = np.floor(offset).astype(int)
+    f = offset - io
+    return [(io[0] + da, io[1] + db, wa * wb)
+            for da, wa in ((0, 1. - f[0]), (1, f[0]))
+            for db, wb in ((0, 1. - f[1]), (1, f[1]))]
+
+def _shear(slices, view):
+    """
+    Intermediate image(s) of a view: sum of the sheared slices (or
+    cumulative sums in the direction of the rays with an obstacle).
+    """
+    nk, na, nb = slices.shape
+    Na, Nb = view["base_shape"]
+    image = np.zeros((Na, Nb), dtype=slices.dtype)
+    order = view["order"]
+    if order is not None:
+        cumulative = np.empty((nk, Na, Nb), dtype=slices.dtype)
+    else:
+        order = xrange(nk)
+    for n, k in enumerate(order):
+        for oa, ob, w in _corners(view["offsets"][k]):
+            a0, a1, sa0, sa1 = _shifted_ranges(Na, na, oa)
+            b0, b1, sb0, sb1 = _shifted_ranges(Nb, nb, ob)
+            if a1 > a0 and b1 > b0 and w != 0:
+                image[a0:a1, b0:b1] += w * slices[k, sa0:sa1, sb0:sb1]
+        if view["order"] is not None:
+            cumulative[n] = image
+    if view["order"] is not None:
+        return cumulative
+    return image
+
+def _shear_transpose(image, slices, view):
+    """
+    Adds the transpose of _shear applied to image to slices.
+    """
+    nk, na, nb = slices.shape
+    Na, Nb = view["base_shape"]
+    order = view["order"]
+    if order is not None:
+        # transpose of the cumulative sum
+        image = np.cumsum(image[::-1], axis=0)[::-1]
+    else:
+        order = xrange(nk)
+    for n, k in enumerate(order):
+        im = image[n] if view["order"] is not None else image
+        for oa, ob, w in _corners(view["offsets"][k]):
+            a0, a1, sa0, sa1 = _shifted_ranges(Na, na, oa)
+            b0, b1, sb0, sb1 = _shifted_ranges(Nb, nb, ob)
+            if a1 > a0 and b1 > b0 and w != 0:
+                slices[k, sa0:sa1, sb0:sb1] += w * im[a0:a1, b0:b1]
+
+def _bilinear_indices(view):
+    """
+    Flat indices and weights of the 4 neighbours of the pixel
+    positions in the intermediate image(s) (out of range weights are
+    zero).
+    """
+    Na, Nb = view["base_shape"]
+    coords = view["coords"]
+    c0 = np.floor(coords).astype(int)
+    f = coords - c0
+    out = []
+    for da, wa in ((0, 1. - f[:, 0]), (1, f[:, 0])):
+        for db, wb in ((0, 1. - f[:, 1]), (1, f[:, 1])):
+            ia = c0[:, 0] + da
+            ib = c0[:, 1] + db
+            valid = (ia >= 0) & (ia < Na) & (ib >= 0) & (ib < Nb)
+            w = np.where(valid, wa * wb, 0.)
+            if view["stop"] is not None:
+                valid &= view["stop"] >= 0
+                w[view["stop"] < 0] = 0.
+                flat = np.maximum(view["stop"], 0) * Na * Nb
+            else:
+                flat = 0
+            flat = flat + np.clip(ia, 0, Na - 1) * Nb + np.clip(ib, 0, Nb - 1)
+            out.append((flat, w))
+    return out
+
+def _warp(image, view):
+    """
+    Values of the pixels of a view: intermediate image(s) interpolated
+    at the pixel positions times the length of the rays in a slice.
+    """
+    image = image.ravel()
+    values = np.zeros(view["i"].size)
+    for flat, w in _bilinear_indices(view):
+        values += w * image[flat]
+    return values * view["length"]
+
+def _warp_transpose(values, view):
+    """
+    Transpose of _warp: intermediate image(s) from pixel values.
+    """
+    Na, Nb = view["base_shape"]
+    size = Na * Nb
+    shape = (Na, Nb)
+    if view["stop"] is not None:
+        size *= len(view["order"])
+        shape = (len(view["order"]), Na, Nb)
+    values = np.asarray(values, dtype=float) * view["length"]
+    image = np.zeros(size)
+    for flat, w in _bilinear_indices(view):
+        image += np.bincount(flat, weights=w * values, minlength=size)
+    return image.reshape(shape)
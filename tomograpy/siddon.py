@@ -58,31 +58,43 @@ The reference pixel of an image and the reference voxel of a map cube
 are used to define the orientation of the images : the reference pixel
 of the image points to the reference voxel of the cube.
 
+Projections are computed by a compiled C extension or, when it is not
+available (or with engine="numpy"), by the slower pure NumPy
+implementation of the numpy_siddon module.
+
 """
 import numpy as np
 import time
 import copy
 import os
 import fitsarray as fa
+from stack import DataStack, HeaderTable, get_column, set_column
 # import all siddon flavors generated by the template
 from parse_templates import siddon_dict_list, suffix_str, ctypes_inv, obstacles_inv
 c_methods = ["conic_full_projector", "conic_image_projector", "ray_projector",
              "full_unit_vector", "image_unit_vector",
              "full_intersection_parameters", "image_intersection_parameters"]
-for method in c_methods:
-    for siddon_dict in siddon_dict_list:
-        exec_str = "from _C_siddon"
-        exec_str += suffix_str
-        exec_str += " import " + method + " as " + method
-        exec_str += suffix_str
-        exec(exec_str % siddon_dict)
-        del exec_str
+try:
+    for method in c_methods:
+        for siddon_dict in siddon_dict_list:
+            exec_str = "from _C_siddon"
+            exec_str += suffix_str
+            exec_str += " import " + method + " as " + method
+            exec_str += suffix_str
+            exec(exec_str % siddon_dict)
+            del exec_str
+    has_c_engine = True
+except ImportError:
+    # C extension not compiled: fall back on the numpy engine
+    has_c_engine = False
+engines = ("c", "numpy")
 
 # const
 INF = 100000
 
 # projector
-def projector(data, cube, mask=None, obstacle=None, nthread=0):
+def projector(data, cube, mask=None, obstacle=None, nthread=0, out=None,
+              accumulate=True, engine=None):
     """
     Project a cubic map into a data cube using the Siddon algorithm.
     The data cube is updated in-place, so you should make a copy before
@@ -99,24 +111,38 @@ def projector(data, cube, mask=None, obstacle=None, nthread=0):
       Define an optional obstacle. If obstacle="sun", the ray-tracing is
       stopped when the ray reaches a sphere of radius one (the Sun in solar
       tomography).
+    out : 3d ndarray (optional)
+      The data cube in which the projection is written (data by
+      default). The headers of data are used in any case.
+    accumulate : boolean
+      If True, the projection is added to the output, otherwise the
+      output is overwritten (pixels are reset while they are projected,
+      there is no separate zeroing pass).
+    engine : {None, "c", "numpy"}
+      The implementation of the ray-tracing (see select_engine).
 
     Returns
     -------
     data : 3d InfoArray
        The updated data cube.
     """
-    if mask is None:
-        mask = np.zeros(data.shape)
+    data = _projector_output(out, data)
+    mask = data_mask_array(data, mask)
     check_projector_inputs(data, cube)
+    if select_engine(engine) == "numpy":
+        import numpy_siddon
+        numpy_siddon.conic_projector(data, cube, mask, "pj", obstacle, accumulate=accumulate)
+        return data
     my_siddon_dict = {"ctype":ctypes_inv[data.dtype.name],
                       "obstacle":obstacles_inv[obstacle],
                       "pj":"pj"
                       }
-    proj_str = "conic_full_projector" + suffix_str + "(data, cube, mask, nthread)"
+    proj_str = "conic_full_projector" + suffix_str + "(data, cube, mask, nthread, int(accumulate))"
     exec(proj_str % my_siddon_dict)
     return data
 
-def backprojector(data, cube, mask=None, obstacle=None, nthread=0):
+def backprojector(data, cube, mask=None, obstacle=None, nthread=0, out=None,
+                  accumulate=True, engine=None):
     """
     Backproject a data cube into a cubic map using the Siddon algorithm.
     The map cube is updated in-place, so you should make a copy before
@@ -133,15 +159,29 @@ def backprojector(data, cube, mask=None, obstacle=None, nthread=0):
       Define an optional obstacke. If obstacle="sun", the ray-tracing is
       stopped when the ray reaches a sphere of radius one (the Sun in solar
       tomography).
+    out : 3d ndarray (optional)
+      The map in which the backprojection is written (cube by
+      default). The header of cube is used in any case.
+    accumulate : boolean
+      If True, the backprojection is added to the output, otherwise the
+      output is overwritten.
+    engine : {None, "c", "numpy"}
+      The implementation of the ray-tracing (see select_engine).
 
     Returns
     -------
     cube : 3d InfoArray
        The updated map cube.
     """
-    if mask is None:
-        mask = np.zeros(data.shape)
+    cube = _projector_output(out, cube)
+    if not accumulate:
+        cube.fill(0)
+    mask = data_mask_array(data, mask)
     check_projector_inputs(data, cube)
+    if select_engine(engine) == "numpy":
+        import numpy_siddon
+        numpy_siddon.conic_projector(data, cube, mask, "bpj", obstacle)
+        return cube
     my_siddon_dict = {"ctype":ctypes_inv[data.dtype.name],
                       "obstacle":obstacles_inv[obstacle],
                       "pj":"bpj"
@@ -150,7 +190,8 @@ def backprojector(data, cube, mask=None, obstacle=None, nthread=0):
     exec(proj_str % my_siddon_dict)
     return cube
 
-def projector4d(data, cube, mask=None, obstacle=None, nthread=0):
+def projector4d(data, cube, mask=None, obstacle=None, nthread=0, out=None,
+                accumulate=True, engine=None):
     """
     Project a cubic map into a data cube using the Siddon algorithm.
     The data cube is updated in-place, so you should make a copy before
@@ -167,24 +208,38 @@ def projector4d(data, cube, mask=None, obstacle=None, nthread=0):
       Define an optional obstacke. If obstacle="sun", the ray-tracing is
       stopped when the ray reaches a sphere of radius one (the Sun in solar
       tomography).
+    out : 3d ndarray (optional)
+      The data cube in which the projection is written (data by
+      default). The headers of data are used in any case.
+    accumulate : boolean
+      If True, the projection is added to the output, otherwise the
+      output is overwritten (pixels are reset while they are projected,
+      there is no separate zeroing pass).
+    engine : {None, "c", "numpy"}
+      The implementation of the ray-tracing (see select_engine).
 
     Returns
     -------
     data : 3d InfoArray
        The updated data cube.
     """
-    if mask is None:
-        mask = np.zeros(data.shape)
+    data = _projector_output(out, data)
+    mask = data_mask_array(data, mask)
     check_projector_inputs(data, cube)
+    if select_engine(engine) == "numpy":
+        import numpy_siddon
+        numpy_siddon.conic_projector(data, cube, mask, "pjt", obstacle, accumulate=accumulate)
+        return data
     my_siddon_dict = {"ctype":ctypes_inv[data.dtype.name],
                       "obstacle":obstacles_inv[obstacle],
                       "pj":"pjt"
                       }
-    proj_str = "conic_full_projector" + suffix_str + "(data, cube, mask, nthread)"
+    proj_str = "conic_full_projector" + suffix_str + "(data, cube, mask, nthread, int(accumulate))"
     exec(proj_str % my_siddon_dict)
     return data
 
-def backprojector4d(data, cube, mask=None, obstacle=None, nthread=0):
+def backprojector4d(data, cube, mask=None, obstacle=None, nthread=0, out=None,
+                    accumulate=True, engine=None):
     """
     Backproject a data cube into a cubic map using the Siddon algorithm.
     The map cube is updated in-place, so you should make a copy before
@@ -201,15 +256,29 @@ def backprojector4d(data, cube, mask=None, obstacle=None, nthread=0):
       Define an optional obstacke. If obstacle="sun", the ray-tracing is
       stopped when the ray reaches a sphere of radius one (the Sun in solar
       tomography).
+    out : 4d ndarray (optional)
+      The map in which the backprojection is written (cube by
+      default). The header of cube is used in any case.
+    accumulate : boolean
+      If True, the backprojection is added to the output, otherwise the
+      output is overwritten.
+    engine : {None, "c", "numpy"}
+      The implementation of the ray-tracing (see select_engine).
 
     Returns
     -------
     cube : 3d InfoArray
        The updated map cube.
     """
-    if mask is None:
-        mask = np.zeros(data.shape)
+    cube = _projector_output(out, cube)
+    if not accumulate:
+        cube.fill(0)
+    mask = data_mask_array(data, mask)
     check_projector_inputs(data, cube)
+    if select_engine(engine) == "numpy":
+        import numpy_siddon
+        numpy_siddon.conic_projector(data, cube, mask, "bpjt", obstacle)
+        return cube
     my_siddon_dict = {"ctype":ctypes_inv[data.dtype.name],
                       "obstacle":obstacles_inv[obstacle],
                       "pj":"bpjt"
@@ -218,22 +287,32 @@ def backprojector4d(data, cube, mask=None, obstacle=None, nthread=0):
     exec(proj_str % my_siddon_dict)
     return cube
 
-def conic_image_projector(data, cube, t, mask=None, obstacle=None):
-    if mask is None:
-        mask = np.zeros(data.shape)
+def conic_image_projector(data, cube, t, mask=None, obstacle=None,
+                          accumulate=True, engine=None):
+    mask = data_mask_array(data, mask)
     check_projector_inputs(data, cube)
+    if select_engine(engine) == "numpy":
+        import numpy_siddon
+        numpy_siddon.conic_projector(data, cube, mask, "pj", obstacle,
+                                     images=[t], accumulate=accumulate)
+        return data
     my_siddon_dict = {"ctype":ctypes_inv[data.dtype.name],
                       "obstacle":obstacles_inv[obstacle],
                       "pj":"pj"
                       }
-    proj_str = "conic_image_projector" + suffix_str + "(data, cube, mask, t)"
+    proj_str = "conic_image_projector" + suffix_str + "(data, cube, mask, t, int(accumulate))"
     exec(proj_str % my_siddon_dict)
     return data
 
-def conic_image_backprojector(data, cube, t, mask=None, obstacle=None):
-    if mask is None:
-        mask = np.zeros(data.shape)
+def conic_image_backprojector(data, cube, t, mask=None, obstacle=None,
+                              engine=None):
+    mask = data_mask_array(data, mask)
     check_projector_inputs(data, cube)
+    if select_engine(engine) == "numpy":
+        import numpy_siddon
+        numpy_siddon.conic_projector(data, cube, mask, "bpj", obstacle,
+                                     images=[t])
+        return data
     my_siddon_dict = {"ctype":ctypes_inv[data.dtype.name],
                       "obstacle":obstacles_inv[obstacle],
                       "pj":"bpj"
@@ -242,6 +321,35 @@ def conic_image_backprojector(data, cube, t, mask=None, obstacle=None):
     exec(proj_str % my_siddon_dict)
     return data    
 
+def select_engine(engine=None):
+    """
+    The implementation of the projectors: "c" (the compiled extension,
+    the default when it is available) or "numpy" (see the numpy_siddon
+    module, slower but without compilation).
+    """
+    if engine is None:
+        return "c" if has_c_engine else "numpy"
+    if engine not in engines:
+        raise ValueError("Unknown engine %s (should be one of %s)."
+                         % (engine, ", ".join(engines)))
+    if engine == "c" and not has_c_engine:
+        raise ValueError("The C extension is not compiled.")
+    return engine
+
+def _projector_output(out, like):
+    """
+    The array in which a projector writes: like itself, or a view of
+    out with the header of like.
+    """
+    if out is None:
+        return like
+    if out.shape != like.shape or out.dtype != like.dtype:
+        raise ValueError("out should have shape %s and dtype %s."
+                         % (like.shape, like.dtype))
+    out = out.view(fa.InfoArray)
+    out.header = like.header
+    return out
+
 def check_projector_inputs(data, cube):
     """
     Check that inputs to projectors functions are correct.
@@ -251,15 +359,22 @@ def check_projector_inputs(data, cube):
         cube.header = dict(cube.header)
     if not isinstance(data.header, list):
         raise ValueError("data.header should be a list.")
-    for i in xrange(len(data.header)):
-        # check dict type
-        if not isinstance(data.header[i], dict):
-            data.header[i] = dict(data.header[i])
-        # check rotation matrix
-        try:
-            data.header[i]['R1_1']
-        except (KeyError):
-            header_rotation_matrix(data.header[i])
+    if isinstance(data.header, HeaderTable):
+        # the C functions read the headers as a list of dicts
+        data.header.materialize()
+    else:
+        for i in xrange(len(data.header)):
+            # check dict type
+            if not isinstance(data.header[i], dict):
+                data.header[i] = dict(data.header[i])
+    # check rotation matrix
+    if isinstance(data.header, HeaderTable):
+        if not data.header.has_column('R1_1'):
+            full_rotation_matrix(data)
+    else:
+        for h in data.header:
+            if 'R1_1' not in h:
+                header_rotation_matrix(h)
     # ensure that data and map have the same data type
     if data.dtype != cube.dtype:
         raise ValueError("data and cube map should have the same data-type")
@@ -269,7 +384,19 @@ def check_projector_inputs(data, cube):
     except (KeyError):
         map_borders(cube.header)
 
+def data_mask_array(data, mask=None):
+    """
+    Returns the mask of the data pixels as expected by the C
+    projectors: an array of the data type, with ones where pixels are
+    masked.
+    """
+    if mask is None:
+        return np.zeros(data.shape, dtype=data.dtype)
+    return np.ascontiguousarray(mask, dtype=data.dtype)
+
 def C_full_unit_vector(data):
+    if isinstance(data.header, HeaderTable):
+        data.header.materialize()
     u = np.zeros(data.shape + (3,))
     my_siddon_dict = {"ctype":ctypes_inv[data.dtype.name],
                       "obstacle":"none",
@@ -282,6 +409,8 @@ def C_full_unit_vector(data):
 def C_full_intersection_parameters(data, cube, u):
     if not isinstance(cube.header, dict):
         cube.header = dict(cube.header)
+    if isinstance(data.header, HeaderTable):
+        data.header.materialize()
 
     a1 = np.zeros(data.shape + (3,))
     an = np.zeros(data.shape + (3,))
@@ -296,13 +425,13 @@ def C_full_intersection_parameters(data, cube, u):
 # helpers to build appropriate objects
 def dataarray_from_header(header):
     """
-    Output an InfoArray using a list of headers.
+    Output a DataStack using a list of headers.
     """
     shape = [int(header[0]['NAXIS' + str(i + 1)])
              for i in xrange(int(header[0]['NAXIS']))]
     shape += len(header),
     dtype = fa.bitpix[str(int(header[0]['BITPIX']))]
-    return fa.InfoArray(shape, header=header, dtype=dtype)
+    return DataStack(shape, header=header, dtype=dtype)
 
 def centered_cubic_map_header(pshape, shape, dtype=np.float64):
     """
@@ -453,6 +582,73 @@ def fov(obj, radius):
     return np.arctan2(pdiag, radius)
 
 
+# compressed maps
+def ray_coverage(data, cube, mask=None, obstacle=None):
+    """
+    Backprojection of the ray lengths: the total length of the rays
+    of unmasked data pixels crossing each voxel of the map.
+
+    Arguments
+    ---------
+    data : 3d InfoArray
+      The data cube (only its metadata is used).
+    cube : 3d InfoArray
+      The map cube (only its metadata is used).
+    mask : ndarray of shape data.shape (optional)
+      Masked data pixels do not contribute.
+    obstacle : {None, "sun"}
+      See projector.
+
+    Returns
+    -------
+    coverage : 3d InfoArray of shape cube.shape
+    """
+    ones = fa.InfoArray(data=np.ones(data.shape, dtype=cube.dtype),
+                        header=data.header)
+    coverage = fa.InfoArray(data=np.zeros(cube.shape, dtype=cube.dtype),
+                            header=dict(cube.header))
+    return backprojector(ones, coverage, mask=mask, obstacle=obstacle)
+
+def active_voxels(data, cube, obj_mask=None, mask=None, obstacle=None):
+    """
+    Indexes (in the flattened map) of the voxels which are crossed by
+    at least one ray and which are not masked.
+
+    Arguments
+    ---------
+    obj_mask : boolean ndarray of shape cube.shape (optional)
+      True where voxels are masked.
+    mask, obstacle : see ray_coverage.
+
+    Returns
+    -------
+    index : 1d int ndarray
+      Sorted indexes of the active voxels.
+    """
+    active = np.asarray(ray_coverage(data, cube, mask=mask,
+                                     obstacle=obstacle)) != 0
+    if obj_mask is not None:
+        active &= ~np.asarray(obj_mask, dtype=bool)
+    return np.flatnonzero(active)
+
+def compress_voxels(cube, index):
+    """
+    Returns the values of a map at the active voxels index.
+    """
+    return np.asarray(cube).ravel()[index]
+
+def expand_voxels(x, index, shape, fill=0., dtype=None):
+    """
+    Expand a vector of active voxels values into a map of given shape.
+    Inactive voxels are set to fill.
+    """
+    if dtype is None:
+        dtype = np.asarray(x).dtype
+    out = np.empty(shape, dtype=dtype)
+    out.fill(fill)
+    out.flat[index] = x
+    return out
+
 # duplicate of C functions as python for testing purpose
 def rotation_matrix(lon, lat, rol):
     """
@@ -461,17 +657,18 @@ def rotation_matrix(lon, lat, rol):
     
     Arguments
     ---------
-    lon: float
+    lon: float or ndarray
       Longitude.
-    lat: float
+    lat: float or ndarray
       Latitude.
-    rol: float
+    rol: float or ndarray
       Roll angle.
 
     Returns
     -------
     R: (3, 3) float array
-      The rotation matrix.
+      The rotation matrix. If angles are arrays, R has shape
+      lon.shape + (3, 3).
     """
 
     cosln = np.cos(lon)
@@ -481,17 +678,17 @@ def rotation_matrix(lon, lat, rol):
     cosrl = np.cos(rol)
     sinrl = np.sin(rol)
 
-    R = np.empty((3, 3))
+    R = np.empty(np.shape(cosln) + (3, 3))
 
-    R[0, 0] = - cosln * coslt
-    R[0, 1] = - sinln * cosrl - cosln * sinlt * sinrl
-    R[0, 2] =   sinln * sinrl - cosln * sinlt * cosrl
-    R[1, 0] = - sinln * coslt
-    R[1, 1] =   cosln * cosrl - sinln * sinlt * sinrl
-    R[1, 2] = - cosln * sinrl - sinln * sinlt * cosrl
-    R[2, 0] = - sinlt
-    R[2, 1] =   coslt * sinrl
-    R[2, 2] =   coslt * cosrl
+    R[..., 0, 0] = - cosln * coslt
+    R[..., 0, 1] = - sinln * cosrl - cosln * sinlt * sinrl
+    R[..., 0, 2] =   sinln * sinrl - cosln * sinlt * cosrl
+    R[..., 1, 0] = - sinln * coslt
+    R[..., 1, 1] =   cosln * cosrl - sinln * sinlt * sinrl
+    R[..., 1, 2] = - cosln * sinrl - sinln * sinlt * cosrl
+    R[..., 2, 0] = - sinlt
+    R[..., 2, 1] =   coslt * sinrl
+    R[..., 2, 2] =   coslt * cosrl
 
     return R
 
@@ -507,8 +704,12 @@ def full_rotation_matrix(data):
     -------
     Nothing, the data header is updated inplace with Ri_j keys.
     """
-    for h in data.header:
-        header_rotation_matrix(h)
+    h = data.header
+    R = rotation_matrix(get_column(h, 'LON'), get_column(h, 'LAT'),
+                        get_column(h, 'ROL'))
+    for i in xrange(3):
+        for j in xrange(3):
+            set_column(h, "R%i_%i" % (i + 1, j + 1), R[:, i, j])
 
 def header_rotation_matrix(h):
     """
@@ -522,11 +723,8 @@ def header_rotation_matrix(h):
     -------
     Nothing, the header is updated inplace with Ri_j keys.
     """
-    dtype = np.dtype(fa.bitpix[str(h['BITPIX'])])
-    for i in xrange(3):
-        for j in xrange(3):
-            R = rotation_matrix(h['LON'], h['LAT'], h['ROL'])
-            array_to_dict(h, "R", R)
+    R = rotation_matrix(h['LON'], h['LAT'], h['ROL'])
+    array_to_dict(h, "R", R)
 
 def full_unit_vector(data):
     """
@@ -747,41 +945,26 @@ def dict_to_array(h, name):
     return arr
 
 def get_header_array_shape(h, name):
-    import re
-    l = len(name)
-    imax, jmax = 0, 0
-    imin, jmin = 10, 10
-    is1d = False
-    is2d = False
-    for k in h.keys():
-        if name == k[:l]:
-            s = k[l:]
-            g = re.search('[0-9]_[0-9]', s)
-            if g is not None:
-                is2d = True
-                sl = s.split('_')
-                i, j = [int(a) for a in sl]
-                if i > imax:
-                    imax = i
-                if i < imin:
-                    imin = i
-                if j > jmax:
-                    jmax = j
-                if j < jmin:
-                    jmin = j
-            else:
-                g = re.search('[0-9]', s)
-                if g is not None:
-                    is1d = True
-                    i = int(s)
-                    if i > imax:
-                        imax = i
-                    if i < imin:
-                        imin = i
-    if is2d:
-        arr = np.empty((imax + 1 - imin, jmax + 1 - jmin))
-    elif is1d:
-        arr = np.empty(imax + 1 - imin)
-    else:
-        raise ValueError('header does not contain this array.')
-    return arr, imin, jmin
+    """
+    Find the shape of an array stored as keywords namei or namei_j,
+    as well as the minimal indexes (which can be 0 or 1).
+    """
+    for imin in (0, 1):
+        for jmin in (0, 1):
+            if name + "%i_%i" % (imin, jmin) in h:
+                imax = imin
+                while name + "%i_%i" % (imax + 1, jmin) in h:
+                    imax += 1
+                jmax = jmin
+                while name + "%i_%i" % (imin, jmax + 1) in h:
+                    jmax += 1
+                arr = np.empty((imax + 1 - imin, jmax + 1 - jmin))
+                return arr, imin, jmin
+    for imin in (0, 1):
+        if name + str(imin) in h:
+            imax = imin
+            while name + str(imax + 1) in h:
+                imax += 1
+            arr = np.empty(imax + 1 - imin)
+            return arr, imin, 10
+    raise ValueError('header does not contain this array.')
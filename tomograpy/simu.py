@@ -5,6 +5,7 @@ import copy
 import numpy as np
 import siddon
 import fitsarray as fa
+from stack import as_data_stack
 
 default_image_dict = {'NAXIS':2, 'NAXIS1':1, 'NAXIS2':1,
                       'BITPIX':-64, 'SIMPLE':True,
@@ -129,7 +130,7 @@ def circular_trajectory_data(**kargs):
         images.append(Image(shape, header=dict(header), dtype=dtype))
         images[-1].update('LON', lon)
         images[-1].update('D', radius)
-    data = fa.infoarrays2infoarray(images)
+    data = as_data_stack(fa.infoarrays2infoarray(images))
     # set values to zeros
     data[:] = 0.
     # compute rotation matrices
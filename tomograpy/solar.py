@@ -3,58 +3,144 @@ Generic code for WCS compatible data.
 """
 import os
 import time
-import copy
+import calendar
 import pyfits
 import numpy as np
 import fitsarray as fa
+from stack import as_data_stack, as_header_table, get_column
 
 # constants
 solar_radius = 695000000. # in m
 arcsecond_to_radian = np.pi/648000 #pi/(60*60*180)
 
 # data handling
-def read_data(path, dtype=np.float64, bin_factor=None, **kargs):
+def read_data(path, dtype=np.float64, bin_factor=None, nthread=None,
+              catalog=None, **kargs):
     """
     Read SOHO / STEREO data files and output a Data instance
 
+    Files are read in two phases. First, only the headers are read
+    (in parallel) and filtered. Then the output array is allocated once
+    and the selected images are decoded, binned and written in place in
+    parallel.
+
     Input :
 
       path : path of the data set
 
       dtype : cast of the data array
-      
+
+      bin_factor : optional bin factor of the images
+
+      nthread : number of threads used to read files (default to the
+        number of cores)
+
+      catalog : if True, files are selected using the header catalog of
+        the directory (see catalog.Catalog), which is updated first.
+        Can also be the file name of the catalog.
+
       kargs : arguments of the data filtering
     """
-    if not os.path.isdir(path):
-        raise ValueError('Directory does not exist')
-    # read files
-    fnames = os.listdir(path)
-    files = list()
-    for fname in fnames:
-        try:
-            files.append(pyfits.fitsopen(os.path.join(path, fname))[0])
-        except(IOError):
-            pass
-    files = filter_files(files, **kargs)
+    files = select_files(path, nthread=nthread, catalog=catalog, **kargs)
     if len(files) == 0:
         print("No file matching.")
         return None
-    for i, f in enumerate(files):
-        fits_array = fa.hdu2fitsarray(f)
+    # the first image defines the shape of the output array
+    first = read_image(files[0].filename, bin_factor=bin_factor)
+    data = np.empty(first.shape + (len(files),), dtype=dtype)
+    headers = len(files) * [None,]
+    def read_one(i):
+        if i == 0:
+            fits_array = first
+        else:
+            fits_array = read_image(files[i].filename, bin_factor=bin_factor)
+        data[..., i] = fits_array
+        header = dict(fits_array.header)
+        header['BITPIX'] = fa.bitpix_inv[dtype.__name__]
+        headers[i] = header
+    _thread_map(read_one, range(len(files)), nthread=nthread)
+    return as_data_stack(data, headers)
+
+def select_files(path, nthread=None, catalog=None, **kargs):
+    """
+    Select the files of a data set from their headers only (see
+    read_data for the arguments).
+
+    Returns a list of FileHeader.
+    """
+    if not os.path.isdir(path):
+        raise ValueError('Directory does not exist')
+    if catalog:
+        from catalog import Catalog
+        if catalog is True:
+            catalog = None
+        cat = Catalog(path, filename=catalog)
+        try:
+            cat.update(nthread=nthread)
+            return cat.query(**kargs)
+        finally:
+            cat.close()
+    files = read_headers(path, nthread=nthread)
+    return filter_files(files, **kargs)
+
+def read_image(filename, bin_factor=None):
+    """
+    Read an image from a FITS file, bin it, update its header and
+    transpose it.
+    """
+    hdus = pyfits.open(filename)
+    try:
+        fits_array = fa.hdu2fitsarray(hdus[0])
         if bin_factor is not None:
             fits_array = fits_array.bin(bin_factor)
         update_header(fits_array)
         fits_array = fits_array.T
-        if i == 0:
-            data = fa.InfoArray(fits_array.shape + (len(files),), header=[dict(fits_array.header),])
-        data[..., i] = fits_array
-        if i != 0:
-            data.header.append(dict(fits_array.header))
-    # ensure coherent data type
-    data = data.astype(dtype)
-    for i in xrange(data.shape[-1]):
-        data.header[i]['BITPIX'] = fa.bitpix_inv[dtype.__name__]
-    return data
+    finally:
+        hdus.close()
+    return fits_array
+
+class FileHeader(object):
+    """
+    The header of a FITS file along with its file name.
+    Can be filtered with filter_files as an HDU.
+    """
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = header
+
+def read_headers(path, nthread=None):
+    """
+    Read the primary headers of all FITS files of a directory.
+
+    Returns a list of FileHeader. Files which are not FITS files are
+    ignored.
+    """
+    fnames = [os.path.join(path, fname) for fname in os.listdir(path)]
+    def read_one(fname):
+        try:
+            return FileHeader(fname, pyfits.getheader(fname, 0))
+        except(IOError):
+            return None
+    headers = _thread_map(read_one, fnames, nthread=nthread)
+    return [h for h in headers if h is not None]
+
+def _thread_map(func, items, nthread=None):
+    """
+    Apply a function to a list of items using a pool of threads.
+    """
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    if nthread is None:
+        nthread = cpu_count()
+    if nthread <= 1 or len(items) <= 1:
+        return map(func, items)
+    pool = ThreadPool(min(nthread, len(items)))
+    try:
+        out = pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+    return out
 
 def update_header(array):
     # read useful keywords
@@ -124,6 +210,10 @@ cunit_to_conversion = {'arcsec':arcsec2radians, 'degree':np.radians,
                        None:no_conversion, '':no_conversion}
 
 def convert_time(time_str):
+    """
+    Convert a DATE_OBS string into a number of seconds since the epoch.
+    The time is assumed to be UTC.
+    """
     # optionnaly remove Z
     time_str = time_str.rstrip("Z")
     # rmove white spaces if any
@@ -138,18 +228,31 @@ def convert_time(time_str):
         time_str, sec_float = time_str[:dpos], float(time_str[dpos:])
     format = '%Y-%m-%dT%H:%M:%S'
     current_time = time.strptime(time_str, format)
-    current_time = time.mktime(current_time)
+    current_time = calendar.timegm(current_time)
     current_time += sec_float
     return current_time
 
-def filter_files(files, instrume=None, telescop=None,
-                 time_window=None, time_step=None, tmin=None, tmax=None):
-    out_files = list()
-    # sort list by time
-    files.sort(cmp=time_compare)
-    # if a time_window is given convert it to float
+def convert_times(time_strs):
+    """
+    Convert a sequence of DATE_OBS strings into a float64 array of
+    seconds since the epoch, parsing them all at once.
+    Equivalent to convert_time applied on each string.
+    """
+    time_strs = [t.strip().rstrip("Z").rstrip(" ") for t in time_strs]
+    if len(time_strs) == 0:
+        return np.zeros(0)
+    dates = np.asarray(time_strs, dtype="datetime64[us]")
+    epoch = np.datetime64("1970-01-01T00:00:00", "us")
+    return (dates - epoch) / np.timedelta64(1, "s")
+
+def time_limits(time_window=None, tmin=None, tmax=None):
+    """
+    Convert time selection arguments (see filter_files) into a minimal
+    and a maximal time value (or None).
+    """
     time_min = None
     time_max = None
+    # if a time_window is given convert it to float
     if time_window is not None:
         time_min = convert_time(time_window[0])
         time_max = convert_time(time_window[1])
@@ -161,42 +264,74 @@ def filter_files(files, instrume=None, telescop=None,
         time_min = convert_time(tmin)
     if tmax is not None:
         time_max = convert_time(tmax)
+    return time_min, time_max
+
+def filter_files(files, instrume=None, telescop=None,
+                 time_window=None, time_step=None, tmin=None, tmax=None):
+    """
+    Select files (HDUs or FileHeaders) according to their headers and
+    returns them sorted by observation time.
+
+    The observation times are parsed once and all the selections are
+    performed on the resulting array.
+    """
+    times = convert_times([f.header['DATE_OBS'] for f in files])
+    # sort list by time (stable sort as list.sort)
+    order = np.argsort(times, kind="mergesort")
+    files = [files[i] for i in order]
+    times = times[order]
+    keep = np.ones(len(files), dtype=bool)
+    # check for origin of data
+    if instrume is not None:
+        keep &= [f.header['INSTRUME'] in instrume for f in files]
+    if telescop is not None:
+        keep &= [f.header['TELESCOP'] in telescop for f in files]
+    # check for time window
+    time_min, time_max = time_limits(time_window, tmin, tmax)
+    if time_min is not None:
+        keep &= times >= time_min
+    if time_max is not None:
+        keep &= times <= time_max
+    ind = np.where(keep)[0]
+    # check for time step
     if time_step is not None:
         if isinstance(time_step, str):
             time_step_val = convert_time(time_step)
         else:
             time_step_val = time_step
-    for i, f in enumerate(files):
-        bad = 0
-        # check for origin of data
-        if instrume is not None:
-            if f.header['INSTRUME'] not in instrume:
-                bad = 1
-        if telescop is not None:
-            if f.header['TELESCOP'] not in telescop:
-                bad = 1
-        # check for time window
-        if time_min is not None or time_max is not None:
-            time_str = f.header['DATE_OBS']
-            time_val = convert_time(time_str)
-            if time_min is not None:
-                if (time_val < time_min):
-                    bad = 1
-            if time_max is not None:
-                if (time_val > time_max):
-                    bad = 1
-        # check for time step
-        if time_step is not None:
-            time_str = f.header['DATE_OBS']
-            time_val = convert_time(time_str)
-            if len(out_files) != 0:
-                last_time_str = out_files[-1].header['DATE_OBS']
-                last_time_val = convert_time(last_time_str)
-                if abs(last_time_val - time_val) < time_step_val:
-                    bad = 1
-        if bad == 0:
-            out_files.append(f)
-    return out_files
+        ind = decimate_times(times[ind], time_step_val, ind)
+    return [files[i] for i in ind]
+
+def decimate_times(times, time_step, ind=None):
+    """
+    Select sorted times so that two selected times are separated at
+    least by time_step, starting from the first one.
+
+    The next selected time after each time is found with searchsorted,
+    and the chain of selected times starting from the first one is
+    followed by pointer doubling (log2(n) vectorised steps).
+
+    Returns the selected indexes (or ind values at those indexes).
+    """
+    times = np.asarray(times, dtype=np.float64)
+    n = times.size
+    if ind is None:
+        ind = np.arange(n)
+    ind = np.asarray(ind)
+    if n == 0:
+        return ind[:0]
+    # next selected index after each index (n is past the end)
+    jump = np.searchsorted(times, times + time_step, side="left")
+    jump = np.maximum(jump, np.arange(1, n + 1))
+    jump = np.append(jump, n)
+    # after step k, selected holds the first 2 ** (k + 1) indexes of the
+    # chain
+    selected = np.zeros(n + 1, dtype=bool)
+    selected[0] = True
+    for k in xrange(int(np.ceil(np.log2(n + 1)))):
+        selected[jump[selected]] = True
+        jump = jump[jump]
+    return ind[selected[:n]]
 
 def time_compare(x, y):
     a = convert_time(x.header['DATE_OBS'])
@@ -234,22 +369,91 @@ def define_data_mask(data, data_rmin=None, data_rmax=None, ring=None,
     Output
     ------
     data_mask: ndarray of booleans of shapa data.shape
+
+    Notes
+    -----
+    The part of the mask which depends only on the geometry (data_rmin,
+    data_rmax, ring) is cached, so that building several models from
+    the same data set computes it only once.
     """
-    data_mask = np.zeros(data.shape, dtype=bool)
     # if no radius limits no need to compute R
     if data_rmin is not None or data_rmax is not None or ring is not None:
-        R = distance_to_sun_center(data)
+        data_mask = geometric_data_mask(data, data_rmin=data_rmin,
+                                        data_rmax=data_rmax, ring=ring)
+    else:
+        data_mask = np.zeros(data.shape, dtype=bool)
+    # values dependent masks, one image at a time to avoid temporaries
+    if mask_negative or mask_nan:
+        for i in xrange(data.shape[-1]):
+            im = np.asarray(data[..., i])
+            im_mask = data_mask[..., i]
+            if mask_negative:
+                im_mask |= im < 0.
+            if mask_nan:
+                im_mask |= np.isnan(im)
+    return data_mask
+
+def geometric_data_mask(data, data_rmin=None, data_rmax=None, ring=None):
+    """
+    Mask of the data pixels outside [data_rmin, data_rmax] or inside
+    ring (see define_data_mask).
+
+    Masks are kept as packed bits in the geometry cache (see
+    geometry.GeometryCache), keyed by the shape of the data and the
+    metadata defining the pixel positions (CRPIX, CDELT and D). The
+    returned mask is a new writable array.
+    """
+    import hashlib
+    import geometry
+    if ring is not None:
+        ring = tuple(ring)
+    key = data_geometry_key(data) + (data_rmin, data_rmax, ring)
+    key = "data_mask_" + hashlib.sha1(repr(key)).hexdigest()
+    packed = geometry.cache.get_key(key, _packed_data_mask, data, data_rmin,
+                                    data_rmax, ring)
+    # unpacked bytes are 0 or 1, thus viewed as booleans without copy
+    size = int(np.prod(data.shape))
+    return np.unpackbits(packed)[:size].reshape(data.shape).view(bool)
+
+def _packed_data_mask(data, data_rmin, data_rmax, ring):
+    y, x = sun_center_axes(data)
+    data_mask = np.zeros(data.shape, dtype=bool)
+    for i in xrange(data.shape[-1]):
+        R = np.sqrt(y[:, np.newaxis, i] ** 2 + x[np.newaxis, :, i] ** 2)
+        im_mask = data_mask[..., i]
         if data_rmin is not None:
-            data_mask[(R < data_rmin)] = 1
+            im_mask |= R < data_rmin
         if data_rmax is not None:
-            data_mask[(R > data_rmax)] = 1
+            im_mask |= R > data_rmax
         if ring is not None:
-            data_mask[(ring[0] < R) * (R < ring[1])] = 1
-    if mask_negative:
-        data_mask[data < 0.] = 1
-    if mask_nan:
-        data_mask[np.isnan(data)] = 1
-    return data_mask
+            im_mask |= (ring[0] < R) & (R < ring[1])
+    return np.packbits(data_mask.ravel())
+
+def data_geometry_key(data):
+    """
+    A hashable key identifying the pixel positions of a data set.
+    """
+    key = (tuple(data.shape),)
+    for k in ('CRPIX1', 'CRPIX2', 'CDELT1', 'CDELT2', 'D'):
+        key += (np.asarray(get_column(data.header, k), dtype=np.float64).tostring(),)
+    return key
+
+def sun_center_axes(data):
+    """
+    Coordinates of the pixels relatively to the Sun center in RSUN
+    along the two image axes.
+
+    Output
+    ------
+    y, x: ndarrays of shape (data.shape[0], n) and (data.shape[1], n)
+      n is the number of images.
+    """
+    Rsun1, Rsun2 = compute_rsun(data)
+    crpix1 = get_column(data.header, 'CRPIX1')
+    crpix2 = get_column(data.header, 'CRPIX2')
+    y = (np.arange(data.shape[0])[:, np.newaxis] - crpix1) / Rsun1
+    x = (np.arange(data.shape[1])[:, np.newaxis] - crpix2) / Rsun2
+    return y, x
 
 def distance_to_sun_center(data):
     """
@@ -268,28 +472,14 @@ def distance_to_sun_center(data):
       The distance to the Sun center on the images in % of RSUN.
       RSUN is the radius of the Sun on one image in number of pixels.
     """
-    R = np.zeros(data.shape)
-    Rsun1, Rsun2 = compute_rsun(data)
-    # loop on images
-    for i in xrange(data.shape[-1]):
-        # get axes
-        crpix1 = data.header[i]['CRPIX1']
-        crpix2 = data.header[i]['CRPIX2']
-        y = (np.arange(data.shape[0]) - crpix1) / Rsun1[i]
-        x = (np.arange(data.shape[0]) - crpix2) / Rsun2[i]
-        # generate 2D repeated axes
-        X, Y = np.meshgrid(x, y)
-        # radius computation
-        R[..., i] = np.sqrt(X ** 2 + Y ** 2)
-    return R
+    y, x = sun_center_axes(data)
+    return np.sqrt(y[:, np.newaxis] ** 2 + x[np.newaxis] ** 2)
 
 def compute_rsun(data):
-    rsun1 = np.empty(data.shape[-1])
-    rsun2 = np.empty(data.shape[-1])
-    for i in xrange(data.shape[-1]):
-        d = data.header[i]['D']
-        rsun1[i] = np.arctan(1. / d) / data.header[i]['CDELT1']
-        rsun2[i] = np.arctan(1. / d) / data.header[i]['CDELT2']
+    d = get_column(data.header, 'D')
+    rsun = np.arctan(1. / d)
+    rsun1 = rsun / get_column(data.header, 'CDELT1')
+    rsun2 = rsun / get_column(data.header, 'CDELT2')
     return rsun1, rsun2
 
 def define_map_mask(cube, obj_rmin=None, obj_rmax=None, obj_cylinder=None,
@@ -301,79 +491,116 @@ def define_map_mask(cube, obj_rmin=None, obj_rmax=None, obj_cylinder=None,
         obj_mask = np.isnan(cube)
     else:
         obj_mask = np.zeros(cube.shape, dtype=bool)
-    if obj_rmin is not None or obj_rmax is not None or obj_cylinder is not None:
-        R = map_radius(fa.asfitsarray(cube))
+    if obj_rmin is not None or obj_rmax is not None:
+        R = map_radius(cube)
         if obj_rmin is not None:
-            obj_mask[R < obj_rmin] = 1
+            obj_mask |= R < obj_rmin
         if obj_rmax is not None:
-            obj_mask[R > obj_rmax] = 1
-        if obj_cylinder is not None:
-            map_ = cylinder(fa.asfitsarray(cube, obj_cylinder))
-            obj_mask[map_ == 1] = 1
+            obj_mask |= R > obj_rmax
+    if obj_cylinder is not None:
+        map_ = cylinder(cube, obj_cylinder)
+        obj_mask |= map_ == 1
     return obj_mask
 
 def cylinder(cube, obj_cylinder):
-    map_ = np.zeros(cube.shape)
-    x, y, z = cube.axes()
-    X, Y = np.meshgrid(x,y)
-    A = X**2 + Y**2 > obj_cylinder**2
-    for i, zt in enumerate(z):
-        map_[A==True, i]=1
-    return map_
+    """
+    Outputs a cube of ones outside a cylinder of radius obj_cylinder
+    and zeros inside. The result is cached (see geometry) and read-only.
+    """
+    import geometry
+    return geometry.cylinder(cube.header, obj_cylinder)
 
 def map_radius(cube):
     """
     Outputs a cube containing the distance to the Sun center in a map
-    cube.
+    cube. The result is cached (see geometry) and read-only.
     """
-    R = np.zeros(cube.shape)
-    x, y, z = cube.axes()
-    X, Y = np.meshgrid(x, y)
-    for i, zt in enumerate(z):
-        R[..., i] = np.sqrt(X ** 2 + Y ** 2 + zt ** 2)
-    return R
+    import geometry
+    return geometry.radius(cube.header)
 
 def slice_data(data, s):
     """
     Slices data InfoArray.
     """
     sd = 2 * (slice(None, None, None), ) + (s,)
-    out = data[sd]
-    out.header = copy.copy(data.header[s])
-    return out
+    out = np.asarray(data)[sd]
+    if np.isscalar(s):
+        return fa.InfoArray(data=out, header=dict(data.header[s]))
+    return as_data_stack(out, as_header_table(data.header)[s])
 
 def concatenate(data_list):
     out = np.concatenate(data_list, axis=-1)
     # copy header and key values
     header = []
     for d in data_list:
-        header += d.header
-    out = fa.asinfoarray(out, header)
-    return out
+        header += [dict(h) for h in d.header]
+    return as_data_stack(out, header)
+
+def bin_data(data, factor):
+    """
+    Bin the images of a data stack by factor (as fitsarray.bin on each
+    image). Images are truncated to a multiple of factor and the
+    pixel size and reference pixel of the headers are updated.
+    """
+    factor = int(factor)
+    if factor == 1:
+        return data
+    n1, n2 = data.shape[0] // factor, data.shape[1] // factor
+    if n1 == 0 or n2 == 0:
+        raise ValueError("Bin factor is larger than the images.")
+    arr = np.asarray(data)[:n1 * factor, :n2 * factor]
+    arr = arr.reshape((n1, factor, n2, factor) + data.shape[2:])
+    out = arr.mean(axis=3).mean(axis=1)
+    header = [dict(h) for h in data.header]
+    for h in header:
+        for i, n in (("1", n1), ("2", n2)):
+            h["CDELT" + i] *= factor
+            h["CRPIX" + i] /= float(factor)
+            h["NAXIS" + i] = n
+    return as_data_stack(out, header)
 
 def get_times(data):
-    return [convert_time(h['DATE_OBS']) for h in data.header]
+    """
+    Returns the observation times of a data stack as a float64 array.
+
+    Uses the TIME keywords computed by update_header if available,
+    otherwise DATE_OBS strings are parsed all at once.
+    """
+    try:
+        return get_column(data.header, 'TIME').astype(np.float64)
+    except(KeyError):
+        return convert_times(get_column(data.header, 'DATE_OBS'))
 
 def sort_data_array(data):
     times = get_times(data)
     # sort in time
-    ind = np.argsort(times)
-    data_list = []
-    for i in ind:
-        s = slice(i, i + 1)
-        data_list.append(slice_data(data, s))
-    data = concatenate(data_list)
-    return data
+    ind = np.argsort(times, kind="mergesort")
+    out = np.asarray(data)[..., ind]
+    return as_data_stack(out, as_header_table(data.header)[ind])
 
 def temporal_groups_indexes(data, dt_min):
-    # XXX buggy if no groups !!!
+    """
+    Indexes of the first image of each temporal group of a data stack
+    sorted in time. A new group starts when the time between two
+    consecutive images is larger than dt_min.
+
+    Returns
+    -------
+    An array of indexes starting with 0 (empty if there is no image).
+    """
     times = get_times(data)
-    ind1 = list(np.where(np.diff(times) < dt_min)[0])
-    return ind1
+    if times.size == 0:
+        return np.zeros(0, dtype=int)
+    return np.concatenate(([0], np.flatnonzero(np.diff(times) > dt_min) + 1))
 
-def temporal_groups_index_list(*kargs):
-    t = temporal_groups_indexes(*kargs)
-    return [range(ti, ti2) for ti, ti2 in zip(t[:-1], t[1:])]
+def temporal_groups_index_list(data, dt_min):
+    """
+    The indexes of the images of each temporal group as a list of
+    ranges.
+    """
+    starts = temporal_groups_indexes(data, dt_min)
+    ends = np.append(starts[1:], data.shape[-1])
+    return [range(i, j) for i, j in zip(starts, ends)]
 
 def temporal_groups_index_array(*kargs):
     return np.asarray(temporal_groups_index_list(*kargs))
@@ -381,8 +608,8 @@ def temporal_groups_index_array(*kargs):
 def temporal_groups(data, dt_min):
     """
     Generates a list of data InfoArray regrouped by time.
-    All images closer in time to dt_min will be in the same array.
+    Consecutive images closer in time than dt_min are in the same array.
     """
-    ind1 = temporal_groups_indexes(data, dt_min)
-    ind2 = ind1[1:] + [None,]
-    return [slice_data(data, slice(i, j, None)) for i, j in zip(ind1, ind2)]
+    starts = temporal_groups_indexes(data, dt_min)
+    ends = list(starts[1:]) + [None,]
+    return [slice_data(data, slice(i, j, None)) for i, j in zip(starts, ends)]
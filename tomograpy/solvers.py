@@ -0,0 +1,540 @@
+"""
+Preconditioned solvers for the models of the models module.
+
+The solvers take the same arguments as the lo optimizers (the
+projector P, the data vector b, the list of priors D and the
+hyperparameters) and minimize
+
+  || P x - b ||^2 + sum_i hypers[i] || D_i x ||^2
+
+Hyperparameters are normalized as in lo (multiplied by the ratio of
+the data size to the map size) so that they have the same meaning for
+both. The solvers use a Jacobi preconditioner: the inverse of P^T P 1 (one
+projection of a map of ones, giving the ray lengths, followed by a
+backprojection) plus the diagonal of the prior.
+
+- pcg : Preconditioned conjugate gradient on the normal equations.
+- plsqr : LSQR with the same preconditioner (as a column scaling).
+
+The module also provides an ordered subsets solver working directly on
+a data stack and a map, without the linear operators of the models:
+
+- os_sart : Ordered subsets SART (OS-SIRT with one subset).
+
+Exemple
+-------
+>>> P, D, obj_mask, data_mask = models.srt(data, cube)
+>>> x, info = pcg(P, data.ravel(), D, (.1, .1, .1), full_output=True)
+>>> print(info["iterations"], info["time"])
+"""
+import time
+import numpy as np
+import fitsarray as fa
+import siddon
+from stack import as_data_stack, get_column
+
+def compute_coverage(P):
+    """
+    P^T P 1 as a vector (the sum of the lengths of the rays crossing
+    each voxel, times the lengths of these rays in the map).
+    """
+    ones = np.ones(P.shape[1], dtype=P.dtype)
+    return np.array(P.T * (P * ones), dtype=P.dtype).ravel()
+
+def jacobi_preconditioner(P, D=None, hypers=None, coverage=None):
+    """
+    Inverse of the approximate diagonal P^T P 1 + diag(sum_i hypers[i]
+    * D_i^T D_i) of the normal operator, as a vector.
+
+    The prior diagonal is computed only if D has a diagonal method
+    (see priors.SmoothnessPrior). Voxels with a negligible diagonal
+    (not seen and not regularized) are not preconditioned. P^T P 1 can
+    be given as coverage if it is already known.
+    """
+    if coverage is None:
+        d = compute_coverage(P)
+    else:
+        d = np.array(coverage, dtype=P.dtype).ravel()
+    if D is not None and hypers is not None and hasattr(D, "diagonal"):
+        d += D.diagonal(hypers)
+    negligible = d <= np.finfo(d.dtype).eps * np.abs(d).max()
+    d[negligible] = 1.
+    return 1. / d
+
+def normal_operator(P, D=[], hypers=[]):
+    """
+    Returns a function computing (P^T P + sum_i hypers[i] * D_i^T D_i) x.
+    The function writes its result in its out argument if given.
+
+    If P is a Siddon operator of lo_wrapper, the projection is written
+    in a buffer of P and the backprojection in out, so that no array of
+    the size of the data or of the map is allocated.
+    """
+    if hasattr(D, "normal"):
+        DtD = D.normal(hypers)
+    else:
+        DtD = None
+    def matvec(x, out=None):
+        y = out
+        if y is None:
+            y = np.empty(P.shape[1], dtype=P.dtype)
+        if hasattr(P, "buffers"):
+            Px = P.buffers.get("normal", P.shapeout, P.dtype)
+            P.project(x, out=Px)
+            P.backproject(Px, out=y.reshape(P.shapein))
+        else:
+            y[:] = np.asarray(P.T * (P * x)).ravel()
+        if DtD is not None:
+            y += DtD * x
+        else:
+            for h, Di in zip(hypers, D):
+                if h != 0:
+                    y += h * np.asarray(Di.T * (Di * x)).ravel()
+        return y
+    return matvec
+
+def pcg(P, b, D=[], hypers=[], x0=None, tol=1e-6, maxiter=None,
+        precond=True, verbose=False, full_output=False, checkpoint=None,
+        offset=None, coverage=None, **kwargs):
+    """
+    Preconditioned conjugate gradient on the normal equations.
+
+    Arguments
+    ---------
+    P: LinearOperator
+      The projector.
+    b: ndarray
+      The data vector.
+    D: list of LinearOperators
+      The priors (a priors.SmoothnessPrior is faster).
+    hypers: tuple of floats
+      The hyperparameters of the priors.
+    x0: ndarray (optional)
+      Starting point (zeros by default).
+    tol: float
+      Stops when the residual of the normal equations is lower than tol
+      times its initial value.
+    maxiter: int (optional)
+      Maximal number of iterations (size of x by default).
+    precond: boolean or ndarray
+      If True, use the Jacobi preconditioner (jacobi_preconditioner).
+      If an ndarray, it is the inverse of the diagonal to use.
+    verbose: boolean
+      Print the residual at each iteration.
+    full_output: boolean
+      Also returns a dict with the number of iterations, the residual,
+      the time to solution and whether the solver converged.
+    checkpoint: checkpoint.Checkpoint (optional)
+      Periodically save the state of the solver, and resume from the
+      saved state if there is one.
+    offset: ndarray (optional)
+      A vector added to the right hand side P^T b of the normal
+      equations (used by the coarse problems of multigrid).
+    coverage: ndarray (optional)
+      P^T P 1 if it is already known (see compute_coverage), to
+      compute the Jacobi preconditioner without projection.
+
+    Other keyword arguments are ignored (as with lo optimizers).
+
+    Returns
+    -------
+    x: ndarray
+      The solution.
+    info: dict (if full_output is True)
+    """
+    t0 = time.time()
+    n = P.shape[1]
+    if maxiter is None:
+        maxiter = n
+    hypers = normalize_hypers(hypers, b, n)
+    A = normal_operator(P, D, hypers)
+    Minv = _preconditioner(P, D, hypers, precond, coverage)
+    rhs = np.array(P.T * b, dtype=P.dtype).ravel()
+    if offset is not None:
+        rhs += offset
+    if x0 is None:
+        x = np.zeros(n, dtype=P.dtype)
+        r = rhs.copy()
+    else:
+        x = np.array(x0, dtype=P.dtype).ravel()
+        r = rhs - A(x)
+    norm0 = np.sqrt(np.dot(rhs, rhs))
+    if norm0 == 0:
+        norm0 = 1.
+    z = Minv * r
+    p = z.copy()
+    rz = np.dot(r, z)
+    i = 0
+    state = _load_checkpoint(checkpoint)
+    if state is not None:
+        x, r, p, rz, i = (state["x"], state["r"], state["p"], state["rz"],
+                          state["iteration"])
+    res = np.sqrt(np.dot(r, r)) / norm0
+    # work arrays reused at each iteration
+    Ap = np.empty(n, dtype=P.dtype)
+    work = np.empty(n, dtype=P.dtype)
+    while res > tol and i < maxiter:
+        A(p, out=Ap)
+        alpha = rz / np.dot(p, Ap)
+        x += np.multiply(alpha, p, work)
+        r -= np.multiply(alpha, Ap, work)
+        res = np.sqrt(np.dot(r, r)) / norm0
+        i += 1
+        if verbose:
+            print("Iteration %i, residual %e" % (i, res))
+        if res <= tol:
+            break
+        np.multiply(Minv, r, z)
+        rz, rz_old = np.dot(r, z), rz
+        p *= rz / rz_old
+        p += z
+        if checkpoint is not None:
+            checkpoint.save({"x":x, "r":r, "p":p, "rz":rz}, i)
+    if checkpoint is not None:
+        checkpoint.wait()
+    info = _info(i, res, t0, res <= tol)
+    if verbose:
+        report("pcg", info)
+    if full_output:
+        return x, info
+    return x
+
+def plsqr(P, b, D=[], hypers=[], x0=None, tol=1e-6, maxiter=None,
+          precond=True, verbose=False, full_output=False, coverage=None,
+          **kwargs):
+    """
+    LSQR on the augmented system [P; sqrt(h_i) D_i] x = [b; 0] with
+    the Jacobi preconditioner applied as a column scaling.
+
+    Arguments are the same as for pcg, but tol is the relative
+    tolerance of LSQR (atol and btol) and checkpoints are not
+    supported.
+    """
+    from scipy.sparse.linalg import LinearOperator, lsqr
+    t0 = time.time()
+    n = P.shape[1]
+    b = np.asarray(b, dtype=P.dtype).ravel()
+    hypers = normalize_hypers(hypers, b, n)
+    Ds = [(np.sqrt(h), Di) for h, Di in zip(hypers, D) if h != 0]
+    S = np.sqrt(_preconditioner(P, D, hypers, precond, coverage))
+    sizes = [b.size] + [Di.shape[0] for h, Di in Ds]
+    bounds = np.cumsum([0] + sizes)
+    def matvec(y):
+        x = S * np.asarray(y).ravel()
+        out = [np.asarray(P * x).ravel()]
+        out += [h * np.asarray(Di * x).ravel() for h, Di in Ds]
+        return np.concatenate(out)
+    def rmatvec(y):
+        y = np.asarray(y).ravel()
+        x = np.array(P.T * y[:bounds[1]], dtype=P.dtype).ravel()
+        for k, (h, Di) in enumerate(Ds):
+            x += h * np.asarray(Di.T * y[bounds[k + 1]:bounds[k + 2]]).ravel()
+        return S * x
+    A = LinearOperator((bounds[-1], n), matvec=matvec, rmatvec=rmatvec,
+                       dtype=P.dtype)
+    rhs = np.zeros(bounds[-1], dtype=P.dtype)
+    rhs[:b.size] = b
+    if x0 is not None:
+        x0 = np.asarray(x0, dtype=P.dtype).ravel()
+        rhs -= matvec(x0 / S)
+    out = lsqr(A, rhs, atol=tol, btol=tol, iter_lim=maxiter, show=verbose)
+    x = S * out[0]
+    if x0 is not None:
+        x += x0
+    info = _info(out[2], out[3] / max(np.sqrt(np.dot(rhs, rhs)), 1e-300),
+                 t0, out[1] in (1, 2, 4, 5))
+    if verbose:
+        report("plsqr", info)
+    if full_output:
+        return x, info
+    return x
+
+class OrderedSubsets(object):
+    """
+    Angular subsets of a data stack, with the row sums (P 1, the ray
+    lengths) and column sums (P_s^T 1 for each subset s) of the
+    projector, computed once.
+
+    Images are sorted by longitude and dealt to the subsets in turn so
+    that each subset spans the whole angular range.
+
+    Arguments
+    ---------
+    data: DataStack
+      The data stack (only its shape and header are used).
+    cube: InfoArray
+      The map (only its shape, dtype and header are used).
+    n_subsets: int
+      Number of subsets.
+    mask: boolean ndarray (optional)
+      The data mask (True for masked pixels).
+    obstacle: str (optional)
+      The obstacle of the projector ("sun" or None).
+    nthread: int
+      Number of threads used to project the images of a subset.
+
+    Subsets of one image (or nthread=1) use the single image
+    projectors (siddon.conic_image_projector). Larger subsets are
+    projected with the OpenMP projector on a stack of their images.
+    """
+    def __init__(self, data, cube, n_subsets=10, mask=None, obstacle=None,
+                 nthread=0):
+        data = as_data_stack(data)
+        siddon.check_projector_inputs(data, cube)
+        self.header = data.header
+        self.map_header = dict(cube.header)
+        self.map_shape = cube.shape
+        self.shape = data.shape
+        self.dtype = cube.dtype
+        self.obstacle = obstacle
+        self.nthread = nthread
+        self.mask = siddon.data_mask_array(data, mask)
+        self.subsets = angular_subsets(self.header, n_subsets)
+        # a full size stack for the single image projectors
+        self._work = as_data_stack(np.zeros(self.shape, dtype=self.dtype),
+                                   self.header)
+        self._stacks = []
+        self._masks = []
+        for index in self.subsets:
+            if self._per_image(index):
+                self._stacks.append(None)
+                self._masks.append(None)
+            else:
+                h = self.header.take(index)
+                shape = self.shape[:-1] + (index.size,)
+                self._stacks.append(as_data_stack(np.zeros(shape, self.dtype),
+                                                  h))
+                self._masks.append(np.ascontiguousarray(self.mask[..., index]))
+        # row and column sums
+        ones = self._map(np.ones(cube.shape, dtype=self.dtype))
+        full = as_data_stack(np.zeros(self.shape, dtype=self.dtype),
+                             self.header)
+        siddon.projector(full, ones, mask=self.mask, obstacle=obstacle,
+                         nthread=nthread)
+        self.row_sums = np.asarray(full)
+        self.col_sums = [self.backproject(np.ones(self.shape[:-1] + (i.size,),
+                                                  dtype=self.dtype), s)
+                         for s, i in enumerate(self.subsets)]
+
+    def _per_image(self, index):
+        return index.size == 1 or self.nthread == 1
+
+    def _map(self, x):
+        return fa.InfoArray(data=x, header=dict(self.map_header))
+
+    def project(self, x, s):
+        """
+        Projection of the map x on the images of subset s.
+        """
+        index = self.subsets[s]
+        x = self._map(x)
+        if self._per_image(index):
+            for t in index:
+                siddon.conic_image_projector(self._work, x, t, mask=self.mask,
+                                             obstacle=self.obstacle,
+                                             accumulate=False)
+            return np.asarray(self._work)[..., index]
+        y = self._stacks[s]
+        siddon.projector(y, x, mask=self._masks[s], obstacle=self.obstacle,
+                         nthread=self.nthread, accumulate=False)
+        return np.array(y)
+
+    def backproject(self, y, s):
+        """
+        Backprojection of the images y of subset s.
+        """
+        index = self.subsets[s]
+        x = self._map(np.zeros(self.map_shape, dtype=self.dtype))
+        if self._per_image(index):
+            for k, t in enumerate(index):
+                self._work[..., t] = y[..., k]
+                siddon.conic_image_backprojector(self._work, x, t,
+                                                 mask=self.mask,
+                                                 obstacle=self.obstacle)
+            return np.asarray(x)
+        d = self._stacks[s]
+        d[:] = y
+        siddon.backprojector(d, x, mask=self._masks[s],
+                             obstacle=self.obstacle, nthread=self.nthread)
+        return np.asarray(x)
+
+def angular_subsets(header, n_subsets):
+    """
+    Indexes of the images of each subset. Images sorted by longitude
+    are dealt to the subsets in turn.
+    """
+    n = len(header)
+    n_subsets = max(1, min(int(n_subsets), n))
+    try:
+        order = np.argsort(get_column(header, 'LON') % (2 * np.pi),
+                           kind="mergesort")
+    except(KeyError):
+        order = np.arange(n)
+    return [np.sort(order[s::n_subsets]) for s in xrange(n_subsets)]
+
+def os_sart(data, cube, n_subsets=10, maxiter=10, relaxation=1., decay=0.,
+            positive=True, mask=None, obj_mask=None, obstacle="sun", x0=None,
+            tol=0., nthread=0, subsets=None, verbose=False, full_output=False,
+            checkpoint=None, **kwargs):
+    """
+    Ordered subsets SART. The map is updated after each subset s by
+
+      x += l_k C_s^-1 P_s^T R^-1 (b_s - P_s x)
+
+    where R and C_s are the row sums and column sums of the projector.
+
+    Arguments
+    ---------
+    data: DataStack
+      The data.
+    cube: InfoArray
+      A map defining the reconstruction grid.
+    n_subsets: int
+      Number of angular subsets (1 gives SIRT).
+    maxiter: int
+      Maximal number of passes over the whole data set.
+    relaxation: float or function
+      The relaxation parameter l_k of pass k or a function of k
+      returning it.
+    decay: float
+      If relaxation is a float, l_k = relaxation / (1 + decay * k).
+    positive: boolean
+      If True, negative values are set to zero after each update.
+    mask: boolean ndarray (optional)
+      The data mask (True for masked pixels).
+    obj_mask: boolean ndarray (optional)
+      The map mask (True for voxels kept to zero).
+    obstacle: str
+      The obstacle of the projector ("sun" or None).
+    x0: ndarray (optional)
+      Starting map (zeros by default).
+    tol: float
+      Stops when the relative change of the map during a pass is lower
+      than tol.
+    nthread: int
+      Number of threads used to project each subset.
+    subsets: OrderedSubsets (optional)
+      Precomputed subsets (to reuse the row and column sums).
+    verbose: boolean
+      Print the change of the map after each pass.
+    full_output: boolean
+      Also returns a dict as pcg.
+    checkpoint: checkpoint.Checkpoint (optional)
+      As for pcg.
+
+    Other keyword arguments are ignored (as with lo optimizers).
+
+    Returns
+    -------
+    x: InfoArray
+      The solution with the header of cube.
+    info: dict (if full_output is True)
+    """
+    t0 = time.time()
+    if subsets is None:
+        subsets = OrderedSubsets(data, cube, n_subsets=n_subsets, mask=mask,
+                                 obstacle=obstacle, nthread=nthread)
+    b = np.array(data, dtype=cube.dtype)
+    b[np.isnan(b) | (subsets.mask != 0)] = 0.
+    inv_rows = _safe_inverse(subsets.row_sums)
+    inv_cols = [_safe_inverse(c) for c in subsets.col_sums]
+    if x0 is None:
+        x = np.zeros(cube.shape, dtype=cube.dtype)
+    else:
+        x = np.array(x0, dtype=cube.dtype).reshape(cube.shape)
+    change = np.inf
+    k = 0
+    state = _load_checkpoint(checkpoint)
+    if state is not None:
+        x, k = state["x"], state["iteration"]
+    while k < maxiter:
+        if callable(relaxation):
+            l = relaxation(k)
+        else:
+            l = relaxation / (1. + decay * k)
+        x_old = x.copy()
+        for s, index in enumerate(subsets.subsets):
+            r = b[..., index] - subsets.project(x, s)
+            r *= inv_rows[..., index]
+            u = subsets.backproject(r, s)
+            u *= inv_cols[s]
+            x += l * u
+            if obj_mask is not None:
+                x[obj_mask] = 0.
+            if positive:
+                np.maximum(x, 0., x)
+        k += 1
+        norm = np.sqrt(np.sum(x ** 2))
+        change = np.sqrt(np.sum((x - x_old) ** 2)) / max(norm, 1e-300)
+        if verbose:
+            print("Iteration %i, change %e" % (k, change))
+        if checkpoint is not None:
+            checkpoint.save({"x":x}, k)
+        if change <= tol:
+            break
+    if checkpoint is not None:
+        checkpoint.wait()
+    x = fa.InfoArray(data=x, header=dict(cube.header))
+    info = _info(k, change, t0, change <= tol)
+    if verbose:
+        report("os_sart", info)
+    if full_output:
+        return x, info
+    return x
+
+def _load_checkpoint(checkpoint):
+    if checkpoint is None:
+        return None
+    return checkpoint.load()
+
+def _safe_inverse(a):
+    out = np.zeros(a.shape, dtype=a.dtype)
+    ok = a > np.finfo(a.dtype).eps * np.abs(a).max()
+    out[ok] = 1. / a[ok]
+    return out
+
+def normalize_hypers(hypers, b, n):
+    """
+    Hyperparameters normalized as in lo optimizers, so that they do not
+    depend on the problem size.
+    """
+    return tuple(np.asarray(hypers, dtype=float) * np.size(b) / float(n))
+
+def _preconditioner(P, D, hypers, precond, coverage=None):
+    if precond is True:
+        return jacobi_preconditioner(P, D, hypers, coverage=coverage)
+    if precond is False or precond is None:
+        return np.ones(P.shape[1], dtype=P.dtype)
+    return np.asarray(precond, dtype=P.dtype).ravel()
+
+def _info(iterations, residual, t0, converged):
+    """
+    The info dict of a solver. The number of iterations and convergence
+    can be None if they are unknown (lo optimizers).
+    """
+    if iterations is not None:
+        iterations = int(iterations)
+    if converged is not None:
+        converged = bool(converged)
+    return {"iterations":iterations, "residual":float(residual),
+            "time":time.time() - t0, "converged":converged}
+
+def report(name, info):
+    """
+    Print the number of iterations and time to solution of a solver
+    (unknown values are not printed).
+    """
+    out = name + ":"
+    if info["iterations"] is not None:
+        out += " %i iterations," % info["iterations"]
+    if not np.isnan(info["residual"]):
+        out += " residual %e," % info["residual"]
+    out += " %.2f s" % info["time"]
+    if info["converged"] is False:
+        out += " (not converged)"
+    print(out)
+
+# solvers usable as srt optimizers
+optimizers = {"pcg":pcg, "plsqr":plsqr}
+# solvers usable as srt optimizers which work on the data and map
+subset_optimizers = {"os-sart":os_sart}
@@ -9,12 +9,20 @@ def usage():
     print(__usage__)
 
 __usage__ = """Usage: srt [options] path [output]
+       srt [--config file] [--jobs n] --batch jobs.cfg [path]
 
 Options:
 
   -h --help          Show this help message and exit.
   --config           Config file name (default: srt_default.cfg).
                      Command line options overloads config file options.
+  --batch            Run the inversions of a batch file. Each section
+                     is a job whose options (as in the config file,
+                     plus path and output) override the config file.
+                     Each data selection is read once and shared by
+                     the jobs. Other command line options are ignored.
+  --jobs             Number of parallel batch jobs (default: number of
+                     cores).
 
   Data parameters:
 
@@ -24,6 +32,8 @@ Options:
   -x --tmax          Temporal end of data set
   -i --instrument    Instrument name(s).
   -t --telescop      Telescops name(s).
+  --catalog          Select files using the header catalog of the data
+                     directory (created or updated if needed).
 
   Object parameters:
 
@@ -39,11 +49,29 @@ Options:
   --data_rmin
   --data_rmax
   -n --negative      Mask negative data values.
+  --compress         Reconstruct only the voxels crossed by rays and
+                     not masked.
 
   Optimization options:
 
   --model            Linear model to use for the inversion.
-  --optimizer        Name of optimization routine (from lo).
+  --optimizer        Name of optimization routine (from lo, or pcg and
+                     plsqr for the preconditioned solvers of
+                     tomograpy.solvers, or os-sart for ordered subsets
+                     SART with the srt model).
+  --subsets          Number of angular subsets of os-sart.
+  --checkpoint       Save the state of the solver every given number of
+                     iterations in output.checkpoint.npz.
+  --resume           Resume an interrupted inversion from its checkpoint.
+  --levels           Number of levels of a coarse-to-fine inversion
+                     (maps with 2, 4, ... times less voxels along each
+                     axis and images binned accordingly).
+  --vcycles          Number of multigrid V-cycles after a coarse-to-fine
+                     inversion.
+  --cache            Directory of the stage cache. Loaded data, masks
+                     and preconditioners are reused by later runs, and
+                     the inversion is skipped if the same configuration
+                     has already been inverted.
   --hyperparameters  Hyperparameters of the smoothness prior.
   --maxiter          Maximum iteration number.
   --tol              Tolerance.
@@ -53,26 +81,45 @@ Options:
   Other options
 
   --input            Optional input filename for starting point.
+  --init             Starting point when there is no input: zeros
+                     (default), fast-bpj (approximate backprojection
+                     of the data) or fast-fbp (approximate filtered
+                     backprojection). Fast starting points are scaled
+                     to fit the data.
   --output           Output filename (default: srt.fts).
 
 """
 
 options = "hb:s:m:x:i:o:d:n"
 
-long_options = ["help", "config=", "bin=", "time_step=", "tmin=", "tmax=",
-                "instrument=", "telescop=",
+long_options = ["help", "config=", "batch=", "jobs=", "bin=", "time_step=", "tmin=", "tmax=",
+                "instrument=", "telescop=", "catalog",
                 "naxis=", "crpix=", "cdelt=", "crval=",
                 "obj_rmin=", "obj_rmax=", "data_rmin=", "data_rmax=",
-                "negative",
+                "negative", "compress",
                 "model=", "optimizer=", "hyperparameters=", "maxiter=", "tol=",
+                "subsets=", "checkpoint=", "resume", "levels=", "vcycles=",
+                "cache=",
                 "dt_min=",
-                "input=", "output="]
+                "input=", "init=", "output="]
 
 model_dict = {"srt":srt, "stsrt":stsrt, "thomson":thomson}
 
+# section of each option of the config file
+config_sections = dict(
+    [(k, "data") for k in ("instrument", "telescop", "bin", "time_step",
+                           "tmin", "tmax", "catalog")] +
+    [(k, "object") for k in ("naxis", "crpix", "cdelt", "crval")] +
+    [(k, "masking") for k in ("obj_rmin", "obj_rmax", "data_rmin",
+                              "data_rmax", "negative", "compress")] +
+    [(k, "optimization") for k in ("model", "optimizer", "hyperparameters",
+                                   "maxiter", "tol", "subsets", "checkpoint",
+                                   "levels", "vcycles", "dt_min",
+                                   "cache", "init")])
+
 def main():
     """Handle config file, options and perform computations accordingly."""
-    import os, getopt, sys, ConfigParser
+    import os, getopt, sys
 
     # parse command line arguments
     try:
@@ -85,42 +132,24 @@ def main():
     # defaults
     script_path = sys.path[0]
     config_file = os.path.join(script_path, "srt_default.cfg")
-    obj_params = dict()
-    data_params = dict()
-    mask_params = dict()
-    opt_params = dict()
-    mask_negative = False
     output = "srt.fts"
+    batch_file = None
+    processes = None
     # parse config file
     for o, a in opts:
         if o == "--config":
             config_file = a
-    config = ConfigParser.RawConfigParser()
-    config.read(config_file)
-    data_params["instrume"] = parse_tuple(config.get("data", "instrument"))
-    data_params["telescop"] = parse_tuple(config.get("data", "telescop"))
-    data_params["bin_factor"] = config.getint("data", "bin")
-    data_params["time_step"] = config.getfloat("data", "time_step")
-    data_params["tmin"] = config.get("data", "tmin")
-    data_params["tmax"] = config.get("data", "tmax")
-    obj_params["naxis"] = parse_tuple_int(config.get("object", "naxis"))
-    obj_params["crpix"] = parse_tuple_float(config.get("object", "crpix"))
-    obj_params["cdelt"] = parse_tuple_float(config.get("object", "cdelt"))
-    obj_params["crval"] = parse_tuple_float(config.get("object", "crval"))
-    mask_params["obj_rmin"] = config.getfloat("masking", "obj_rmin")
-    mask_params["obj_rmax"] = config.getfloat("masking", "obj_rmax")
-    mask_params["data_rmin"] = config.getfloat("masking", "data_rmin")
-    mask_params["data_rmax"] = config.getfloat("masking", "data_rmax")
-    mask_params["mask_negative"] = config.getboolean("masking", "negative")
-    opt_params["model"] = model_dict[config.get("optimization", "model")]
-    opt_params["optimizer"] = config.get("optimization", "optimizer")
-    opt_params["hypers"] = parse_tuple_float(config.get("optimization", "hyperparameters"))
-    opt_params["maxiter"] = config.getint("optimization", "maxiter")
-    opt_params["tol"] = config.getfloat("optimization", "tol")
-    try:
-        opt_params["dt_min"] = config.getfloat("optimization", "dt_min")
-    except(ConfigParser.NoOptionError):
-        opt_params["dt_min"] = data_params["time_step"] / 2.
+        elif o == "--batch":
+            batch_file = a
+        elif o == "--jobs":
+            processes = int(a)
+    if batch_file is not None:
+        path = None
+        if len(args) > 0:
+            path = args[0]
+        batch(batch_file, config_file, path=path, processes=processes)
+        return
+    obj_params, data_params, mask_params, opt_params = read_config(config_file)
     # parse arguments
     if len(args) == 0:
         usage()
@@ -146,6 +175,8 @@ def main():
             data_params["instrume"] = parse_tuple(a)
         elif o in ("-t", "--telescop"):
             data_params["telescop"] = parse_tuple(a)
+        elif o == "--catalog":
+            data_params["catalog"] = True
         # object parameters
         elif o == "--naxis":
             obj_params["naxis"] = parse_tuple_int(a)
@@ -166,67 +197,489 @@ def main():
             mask_params["data_rmax"] = float(a)
         elif o in ("-n", "--negtative"):
             mask_params["mask_negative"] = True
+        elif o == "--compress":
+            mask_params["compress"] = True
         # optimization parameters
         elif o == "--model":
             opt_params["model"] = model_dict[a]
         elif o == "--optimizer":
-            opt_params["optimizer"] = optimize_dict[a]
+            opt_params["optimizer"] = a
         elif o == "--hyperparameters":
             opt_params["hypers"] = parse_tuple_float(a)
         elif o == "--maxiter":
             opt_params["maxiter"] = int(a)
         elif o == "--tol":
             opt_params["tol"] = float(a)
+        elif o == "--subsets":
+            opt_params["n_subsets"] = int(a)
+        elif o == "--checkpoint":
+            opt_params["checkpoint"] = int(a)
+        elif o == "--resume":
+            opt_params["resume"] = True
+        elif o == "--levels":
+            opt_params["levels"] = int(a)
+        elif o == "--vcycles":
+            opt_params["vcycles"] = int(a)
+        elif o == "--cache":
+            opt_params["cache"] = a
         elif o in ("--input"):
             opt_params["input"] = a
+        elif o == "--init":
+            opt_params["init"] = a
         elif o in ("--dt_min"):
             opt_params["dt_min"] = a
         # other parameters
         elif o in ("-o", "--output"):
             output = a
-        elif o == "--config":
+        elif o in ("--config", "--batch", "--jobs"):
             pass # handled before
         else:
             assert False, "unhandled option"
+    checkpoint_file = output + ".checkpoint.npz"
+    opt_params["checkpoint_file"] = checkpoint_file
     sol = inversion(path, obj_params, data_params, opt_params, mask_params)
     sol.tofits(output)
+    # the inversion is complete
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
 
-def inversion(path, obj_params, data_params, opt_params, mask_params):
+def read_config(config_file, overrides=None):
     """
-    Perform an inversion using given parameters.
+    Read the parameters of an inversion from a config file.
+
+    Arguments
+    ---------
+    config_file: str
+      The config file name.
+    overrides: dict (optional)
+      Options overriding the options of the config file (as strings,
+      whatever their section).
+
+    Returns
+    -------
+    obj_params, data_params, mask_params, opt_params: dicts
+    """
+    import ConfigParser
+    config = ConfigParser.RawConfigParser()
+    config.read(config_file)
+    for k, v in (overrides or {}).iteritems():
+        if k not in config_sections:
+            raise ValueError("Unknown option " + k)
+        if not config.has_section(config_sections[k]):
+            config.add_section(config_sections[k])
+        config.set(config_sections[k], k, v)
+    obj_params = dict()
+    data_params = dict()
+    mask_params = dict()
+    opt_params = dict()
+    data_params["instrume"] = parse_tuple(config.get("data", "instrument"))
+    data_params["telescop"] = parse_tuple(config.get("data", "telescop"))
+    data_params["bin_factor"] = config.getint("data", "bin")
+    data_params["time_step"] = config.getfloat("data", "time_step")
+    data_params["tmin"] = config.get("data", "tmin")
+    data_params["tmax"] = config.get("data", "tmax")
+    try:
+        data_params["catalog"] = config.getboolean("data", "catalog")
+    except(ConfigParser.NoOptionError):
+        pass
+    obj_params["naxis"] = parse_tuple_int(config.get("object", "naxis"))
+    obj_params["crpix"] = parse_tuple_float(config.get("object", "crpix"))
+    obj_params["cdelt"] = parse_tuple_float(config.get("object", "cdelt"))
+    obj_params["crval"] = parse_tuple_float(config.get("object", "crval"))
+    mask_params["obj_rmin"] = config.getfloat("masking", "obj_rmin")
+    mask_params["obj_rmax"] = config.getfloat("masking", "obj_rmax")
+    mask_params["data_rmin"] = config.getfloat("masking", "data_rmin")
+    mask_params["data_rmax"] = config.getfloat("masking", "data_rmax")
+    mask_params["mask_negative"] = config.getboolean("masking", "negative")
+    try:
+        mask_params["compress"] = config.getboolean("masking", "compress")
+    except(ConfigParser.NoOptionError):
+        pass
+    opt_params["model"] = model_dict[config.get("optimization", "model")]
+    opt_params["optimizer"] = config.get("optimization", "optimizer")
+    opt_params["hypers"] = parse_tuple_float(config.get("optimization", "hyperparameters"))
+    opt_params["maxiter"] = config.getint("optimization", "maxiter")
+    opt_params["tol"] = config.getfloat("optimization", "tol")
+    try:
+        opt_params["n_subsets"] = config.getint("optimization", "subsets")
+    except(ConfigParser.NoOptionError):
+        pass
+    try:
+        opt_params["checkpoint"] = config.getint("optimization", "checkpoint")
+    except(ConfigParser.NoOptionError):
+        pass
+    for k in ("levels", "vcycles"):
+        try:
+            opt_params[k] = config.getint("optimization", k)
+        except(ConfigParser.NoOptionError):
+            pass
+    for k in ("cache", "init"):
+        try:
+            opt_params[k] = config.get("optimization", k)
+        except(ConfigParser.NoOptionError):
+            pass
+    try:
+        opt_params["dt_min"] = config.getfloat("optimization", "dt_min")
+    except(ConfigParser.NoOptionError):
+        opt_params["dt_min"] = data_params["time_step"] / 2.
+    return obj_params, data_params, mask_params, opt_params
+
+def inversion(path, obj_params, data_params, opt_params, mask_params,
+              data=None):
+    """
+    Perform an inversion using given parameters. If data is given, it
+    is used instead of reading the data of path (see load_data).
     """
     import numpy as np
     import lo, siddon
     import fitsarray as fa
-    import solar, models
-    # data
-    data = solar.read_data(path, **data_params)
-    if data is None:
-        return
-    data = solar.sort_data_array(data)
+    import solar, models, solvers, multigrid
+    from stack import as_data_stack
+    from checkpoint import lo_callback
+    from cache import directory_state
+    # stage cache and checkpoints
+    cache = make_cache(opt_params)
+    ckpt = make_checkpoint(path, obj_params, data_params, opt_params,
+                           mask_params)
     # create object
     obj = make_object(obj_params)
     # configuration persistency
     out_header = persistency_header(obj.header, data_params,
                                        mask_params, opt_params)
+    result_key = None
+    if cache is not None:
+        files = directory_state(path)
+        result_key = cache.key(result_sources(path, opt_params), obj_params,
+                               data_params, opt_params, mask_params)
+        entry = cache.load("result", result_key)
+        if entry is not None:
+            print("Cached result: " + cache.entry("result", result_key))
+            return fa.asfitsarray(np.array(entry["x"]),
+                                  header=fa.dict2header(entry["header"]))
+    # data
+    if data is None:
+        data = load_data(path, data_params, cache=cache)
+    if data is None:
+        return
     # pop optimization parameters
     model = opt_params.pop("model")
     optimizer = opt_params.pop("optimizer")
     hypers = opt_params.pop("hypers")
+    init = opt_params.pop("init", "zeros")
+    if init not in initializations:
+        raise ValueError("init should be one of " + ", ".join(initializations))
     if opt_params.has_key("input"):
         opt_params["x0"] = fa.FitsArray(file=opt_params["input"])
-    # model
-    P, D, obj_mask, data_mask = model(data, obj, **mask_params)
-    # apply masking to data
-    data *= (1 - data_mask)
-    data[np.isnan(data)] = 0.
+    levels = opt_params.pop("levels", 1)
+    vcycles = opt_params.pop("vcycles", 0)
+    if init != "zeros" and not opt_params.has_key("x0"):
+        if optimizer in solvers.subset_optimizers or levels > 1 or vcycles > 0:
+            raise ValueError("--init is only available for single level "
+                             "inversions with the linear model")
+    if optimizer in solvers.subset_optimizers:
+        # ordered subsets solvers do not use the linear model
+        if model is not models.srt:
+            raise ValueError(optimizer + " is only available for the srt model")
+        data_mask = solar.define_data_mask(data, **mask_params)
+        obj_mask = solar.define_map_mask(obj, **mask_params)
+        sol, info = solvers.subset_optimizers[optimizer](
+            data, obj, mask=data_mask, obj_mask=obj_mask, full_output=True,
+            checkpoint=ckpt, **opt_params)
+        solvers.report(optimizer, info)
+        sol = fa.asfitsarray(np.asarray(sol), header=out_header)
+        return store_result(cache, result_key, sol)
+    if levels > 1 or vcycles > 0:
+        if ckpt is not None:
+            raise ValueError("Checkpoints are not available with multigrid")
+        if optimizer in solvers.optimizers:
+            solver = solvers.optimizers[optimizer]
+        else:
+            solver = getattr(lo, optimizer)
+        sol = multigrid.multigrid(data, obj, hypers, levels=levels,
+                                  model=model, solver=solver,
+                                  mask_params=mask_params, vcycles=vcycles,
+                                  verbose=True, **opt_params)
+        sol = fa.asfitsarray(np.asarray(sol), header=out_header)
+        return store_result(cache, result_key, sol)
+    # model (with cached masks)
+    model_params = dict(mask_params)
+    if cache is not None:
+        mask_key = cache.key(files, data_params, mask_params, obj_params,
+                             model)
+        masks = cache.load("masks", mask_key)
+        if masks is not None:
+            model_params.update(masks)
+    P, D, obj_mask, data_mask = model(data, obj, **model_params)
+    if cache is not None and masks is None:
+        masks = {"data_mask":data_mask}
+        if mask_params.get("compress", False):
+            masks["index"] = np.flatnonzero(~obj_mask)
+        cache.save("masks", mask_key, masks)
+    if mask_params.get("compress", False) and opt_params.has_key("x0"):
+        opt_params["x0"] = np.asarray(opt_params["x0"])[~obj_mask]
+    # apply masking to data. Shared data are read-only: the projectors
+    # ignore masked pixels, so they are used as they are unless they
+    # contain NaNs (batch replaces them before sharing the data).
+    if not data.flags.writeable and np.isnan(data).any():
+        data = as_data_stack(np.array(data), data.header)
+    if data.flags.writeable:
+        data *= (1 - data_mask)
+        data[np.isnan(data)] = 0.
     # inversion
-    b = data.ravel()
-    exec("sol = lo." + optimizer + "(P, b, D, hypers, **opt_params)")
+    b = np.asarray(data).ravel()
+    if init != "zeros" and not opt_params.has_key("x0"):
+        opt_params["x0"] = initial_guess(init, data, obj, P, b, obj_mask,
+                                         data_mask)
+    if optimizer in solvers.optimizers:
+        if cache is not None and opt_params.get("precond", True) is True:
+            # the coverage only depends on the model and masks, so it is
+            # shared by the inversions with other hyperparameters
+            entry = cache.load("coverage", mask_key)
+            if entry is None:
+                entry = {"coverage":solvers.compute_coverage(P)}
+                cache.save("coverage", mask_key, entry)
+            opt_params["coverage"] = entry["coverage"]
+        sol, info = solvers.optimizers[optimizer](P, b, D, hypers,
+                                                  full_output=True,
+                                                  checkpoint=ckpt,
+                                                  **opt_params)
+        solvers.report(optimizer, info)
+    else:
+        if ckpt is not None:
+            state = ckpt.load()
+            start = 0
+            if state is not None:
+                start = state["iteration"]
+                opt_params["x0"] = state["x"]
+                if opt_params.get("maxiter") is not None:
+                    opt_params["maxiter"] = max(opt_params["maxiter"] - start, 0)
+            opt_params["callback"] = lo_callback(ckpt, start)
+        exec("sol = lo." + optimizer + "(P, b, D, hypers, **opt_params)")
+        if ckpt is not None:
+            ckpt.wait()
     # reshape result
-    sol = fa.asfitsarray(sol.reshape(obj_mask.shape), header=out_header)
+    if obj_mask is None:
+        sol = sol.reshape(obj.shape)
+    else:
+        sol = models.expand_solution(sol, obj_mask)
+    sol = fa.asfitsarray(sol, header=out_header)
+    return store_result(cache, result_key, sol)
+
+# starting points of the inversions (see initial_guess)
+initializations = ("zeros", "fast-bpj", "fast-fbp")
+
+def initial_guess(init, data, obj, P, b, obj_mask=None, data_mask=None):
+    """
+    A starting point of the inversion computed with the voxel-driven
+    backprojector (see voxel_backprojector) and scaled so that its
+    projection best fits the data.
+
+    Returns
+    -------
+    x0: ndarray
+      The starting point as expected by P (compressed if the model is).
+    """
+    import numpy as np
+    from voxel_backprojector import fast_backprojector, scale_to_data
+    x0 = fast_backprojector(data, obj, mask=data_mask, obstacle="sun",
+                            filtered=(init == "fast-fbp"))
+    x0 = np.asarray(x0)
+    if P.shape[1] == x0.size:
+        x0 = x0.ravel()
+    elif obj_mask is not None and P.shape[1] == np.sum(~obj_mask):
+        x0 = x0[~obj_mask]
+    else:
+        raise ValueError("--init is only available for 3d models")
+    return scale_to_data(x0, P, b)
+
+def result_sources(path, opt_params):
+    """
+    The state of the files an inversion result depends on: the files of
+    the data directory and the input file if any (see
+    cache.directory_state).
+    """
+    from cache import directory_state, file_state
+    sources = directory_state(path)
+    if opt_params.has_key("input"):
+        # the initial map can be modified without being renamed
+        sources.append(file_state(opt_params["input"]))
+    return sources
+
+def make_cache(opt_params):
+    """
+    Pop the cache directory from opt_params and returns a
+    cache.StageCache (or None if there is no cache).
+    """
+    from cache import StageCache
+    directory = opt_params.pop("cache", None)
+    if directory is None:
+        return None
+    return StageCache(directory)
+
+def store_result(cache, key, sol):
+    """
+    Store the solution of an inversion and its header in the cache
+    under key. Returns sol.
+    """
+    if cache is not None:
+        cache.save("result", key, {"x":sol}, header=dict(sol.header))
     return sol
 
+def load_data(path, data_params, cache=None):
+    """
+    Read and sort the data of an inversion. If cache is a
+    cache.StageCache, the data are stored in the cache as a prepared
+    stack (see prepared.save_stack) and memory-mapped from it if the
+    files of path did not change.
+    """
+    import solar
+    from cache import directory_state
+    from prepared import save_stack, load_stack
+    if cache is not None:
+        sources = directory_state(path)
+        entry = cache.entry("data", cache.key(sources, data_params))
+        # copy-on-write: the cached stack is never modified
+        data = load_stack(entry, sources=sources, mmap_mode="c")
+        if data is not None:
+            return data
+    data = solar.read_data(path, **data_params)
+    if data is None:
+        return None
+    data = solar.sort_data_array(data)
+    if cache is not None:
+        save_stack(entry, data, sources=sources)
+    return data
+
+def read_jobs(jobs_file, config_file, path=None):
+    """
+    Read the jobs of a batch file. Each section of the batch file is a
+    job whose options override the options of the config file. The
+    path and output options define the data directory (path by
+    default) and the output file name (section name + ".fts" by
+    default).
+
+    Returns
+    -------
+    A list of dicts with name, path, output, obj_params, data_params,
+    mask_params and opt_params items.
+    """
+    import ConfigParser
+    config = ConfigParser.RawConfigParser()
+    if len(config.read(jobs_file)) == 0:
+        raise ValueError("Cannot read batch file " + jobs_file)
+    jobs = []
+    for name in config.sections():
+        overrides = dict(config.items(name))
+        job = dict(name=name)
+        job["path"] = overrides.pop("path", path)
+        job["output"] = overrides.pop("output", name + ".fts")
+        if job["path"] is None:
+            raise ValueError("No data path for job " + name)
+        params = read_config(config_file, overrides)
+        for k, p in zip(("obj_params", "data_params", "mask_params",
+                         "opt_params"), params):
+            job[k] = p
+        job["opt_params"]["checkpoint_file"] = job["output"] + ".checkpoint.npz"
+        jobs.append(job)
+    return jobs
+
+def batch(jobs_file, config_file, path=None, processes=None):
+    """
+    Run the inversions of a batch file (see read_jobs) in a pool of
+    processes.
+
+    Each distinct data selection is read once and saved in a temporary
+    .npy file. Workers map it read-only, so that the data are read
+    from the FITS files once and shared by all the jobs using them.
+
+    Returns
+    -------
+    The list of output file names.
+    """
+    import os, shutil, tempfile
+    import numpy as np
+    from multiprocessing import Pool
+    from checkpoint import config_key
+    jobs = read_jobs(jobs_file, config_file, path=path)
+    tmpdir = tempfile.mkdtemp(prefix="srt_batch")
+    try:
+        loaded = dict()
+        for job in jobs:
+            key = config_key(job["path"], job["data_params"])
+            if key not in loaded:
+                data = load_data(job["path"], job["data_params"])
+                if data is None:
+                    loaded[key] = None, None
+                else:
+                    # NaNs are replaced once so that workers can use the
+                    # shared data without copying them (see inversion)
+                    values = np.asarray(data)
+                    if not values.flags.writeable:
+                        values = values.copy()
+                    values[np.isnan(values)] = 0.
+                    filename = os.path.join(tmpdir, key + ".npy")
+                    np.save(filename, values)
+                    del values
+                    loaded[key] = filename, [dict(h) for h in data.header]
+                del data
+            job["data_file"], job["headers"] = loaded[key]
+        if processes == 1:
+            outputs = map(run_job, jobs)
+        else:
+            pool = Pool(processes)
+            try:
+                outputs = pool.map(run_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        shutil.rmtree(tmpdir)
+    return outputs
+
+def run_job(job):
+    """
+    Run a job of a batch (see batch) and write its output.
+    """
+    import os
+    import numpy as np
+    from stack import as_data_stack
+    if job["data_file"] is None:
+        print("%s: no data" % job["name"])
+        return None
+    data = as_data_stack(np.load(job["data_file"], mmap_mode="r"),
+                         job["headers"])
+    # inversion pops optimization parameters
+    opt_params = dict(job["opt_params"])
+    sol = inversion(job["path"], job["obj_params"], job["data_params"],
+                    opt_params, job["mask_params"], data=data)
+    sol.tofits(job["output"])
+    checkpoint_file = job["opt_params"]["checkpoint_file"]
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    print("%s: %s" % (job["name"], job["output"]))
+    return job["output"]
+
+def make_checkpoint(path, obj_params, data_params, opt_params, mask_params):
+    """
+    Pop checkpoint parameters from opt_params and returns a Checkpoint
+    identified by the other parameters (or None if checkpoints are not
+    required).
+    """
+    from checkpoint import Checkpoint, config_key
+    every = opt_params.pop("checkpoint", 0)
+    filename = opt_params.pop("checkpoint_file", "srt.checkpoint.npz")
+    resume = opt_params.pop("resume", False)
+    if not every and not resume:
+        return None
+    # the number of iterations and tolerance can change when resuming
+    params = dict([(k, v) for k, v in opt_params.iteritems()
+                   if k not in ("maxiter", "tol")])
+    key = config_key(path, obj_params, data_params, params, mask_params)
+    ckpt = Checkpoint(filename, every=every or 10, key=key)
+    if not resume:
+        ckpt.remove()
+    return ckpt
+
 def persistency_header(object_header, data_params, mask_params, opt_params):
     """
     Store srt parameters into output header. This allows to know how a
@@ -0,0 +1,450 @@
+"""
+Columnar headers for data stacks.
+
+The metadata of a data stack is a list of dicts, one per image. A
+HeaderTable is such a list whose items are dicts, so that it can be
+used everywhere a list of headers is expected (including the C
+projectors), but which additionally stores the values of a keyword for
+all images as contiguous numpy columns. Columns are computed once and
+kept up to date when the headers are modified.
+
+Slicing or sorting a HeaderTable returns a new table sharing the same
+headers and columns. A DataStack is an InfoArray whose header is a
+HeaderTable and which slices its header along with the image axis.
+
+Exemple
+-------
+>>> data = as_data_stack(data)
+>>> crpix1 = data.header['CRPIX1'] # a 1d ndarray
+>>> data.header[0]['CRPIX1'] # as with a list of dicts
+>>> data[..., 2:4].header # a HeaderTable of 2 headers
+"""
+import numpy as np
+import fitsarray as fa
+
+class HeaderRow(dict):
+    """
+    The header of one image of a HeaderTable. Updates the columns of the
+    table when modified.
+    """
+    __slots__ = ("_store", "_id")
+    def __init__(self, header, store, row_id):
+        dict.__init__(self, header)
+        self._store = store
+        self._id = row_id
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._store.set_value(self._id, key, value)
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._store.drop(key)
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return self[key]
+    def pop(self, key, *args):
+        self._store.drop(key)
+        return dict.pop(self, key, *args)
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+class _ColumnStore(object):
+    """
+    The headers shared by HeaderTables and their cached columns.
+
+    A store can also be made of the columns of header_columns (source)
+    only, in which case the headers are built on first access.
+    """
+    def __init__(self, headers=(), source=None):
+        self.columns = dict()
+        self.source = source
+        if source is None:
+            self._rows = [HeaderRow(h, self, i) for i, h in enumerate(headers)]
+        else:
+            self._rows = None
+
+    @property
+    def built(self):
+        "True if the headers exist as dicts."
+        return self._rows is not None
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            columns, missing = self.source
+            keys = list(columns)
+            values = [np.asarray(columns[k]).tolist() for k in keys]
+            rows = [HeaderRow(zip(keys, row), self, i)
+                    for i, row in enumerate(zip(*values))]
+            for key, mask in missing.iteritems():
+                for i in np.flatnonzero(mask):
+                    dict.__delitem__(rows[i], key)
+            self._rows = rows
+            self.source = None
+        return self._rows
+
+    def column(self, key):
+        col = self.columns.get(key)
+        if col is None:
+            if self.source is not None and key not in self.source[1]:
+                col = self.source[0].get(key)
+            if col is None:
+                col = [dict.__getitem__(r, key) for r in self.rows]
+            elif col.dtype == object:
+                col = col.tolist()
+            col = np.asarray(col)
+            self.columns[key] = col
+        return col
+
+    def complete(self, key):
+        "True if key is known to be defined in all headers."
+        if key in self.columns:
+            return True
+        return (self.source is not None and key in self.source[0] and
+                key not in self.source[1])
+
+    def set_value(self, i, key, value):
+        col = self.columns.get(key)
+        if col is None:
+            return
+        if col.dtype.kind in "biuf" and np.asarray(value).dtype.kind == col.dtype.kind:
+            col[i] = value
+        else:
+            self.drop(key)
+
+    def set_column(self, key, index, values):
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = values.repeat(len(index))
+        if values.shape != (len(index),):
+            raise ValueError("values should have one element per header")
+        for i, v in zip(index, values.tolist()):
+            dict.__setitem__(self.rows[i], key, v)
+        if len(index) == len(self.rows):
+            col = np.empty(len(self.rows), dtype=values.dtype)
+            col[index] = values
+            self.columns[key] = col
+        else:
+            col = self.columns.get(key)
+            if col is not None and col.dtype.kind == values.dtype.kind:
+                col[index] = values
+            else:
+                self.drop(key)
+
+    def drop(self, key):
+        self.columns.pop(key, None)
+
+def _building(method):
+    "A list method which needs the headers of a table (see materialize)."
+    def wrapper(self, *args):
+        self.materialize()
+        return method(self, *args)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+def _mutating(method):
+    "A list method modifying a table (its columns are not cached anymore)."
+    def wrapper(self, *args, **kwargs):
+        self.materialize()
+        out = method(self, *args, **kwargs)
+        self._index = None
+        return out
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+class HeaderTable(list):
+    """
+    A list of headers (dicts) with columnar access to keyword values.
+
+    - table[i] is the header of image i (a dict).
+    - table[key] is a 1d ndarray of the values of keyword key.
+    - table[key] = values sets the values of key for all headers.
+    - table[slice] or table[indexes] is a HeaderTable sharing the
+      same headers.
+
+    Modifying the list itself (append, insert, ...) is allowed, but the
+    columns of the modified table are not cached anymore.
+
+    A table made from columns (see header_table_from_columns) builds
+    its headers when they are first accessed as dicts.
+    """
+    def __init__(self, headers=(), _store=None, _index=None):
+        if _store is None:
+            _store = _ColumnStore(headers)
+            _index = np.arange(len(_store.rows))
+        self._store = _store
+        self._index = np.asarray(_index, dtype=int)
+        self._lazy = not _store.built
+        if not self._lazy:
+            list.__init__(self, [_store.rows[i] for i in self._index])
+
+    def materialize(self):
+        """
+        Build the headers of a table made from columns. The C projectors
+        read the headers as a list of dicts.
+        """
+        if self._lazy:
+            self._lazy = False
+            rows = self._store.rows
+            list.extend(self, [rows[i] for i in self._index])
+
+    def __len__(self):
+        if self._lazy:
+            return len(self._index)
+        return list.__len__(self)
+
+    __iter__ = _building(list.__iter__)
+    __reversed__ = _building(list.__reversed__)
+    __contains__ = _building(list.__contains__)
+    __repr__ = _building(list.__repr__)
+    __eq__ = _building(list.__eq__)
+    __ne__ = _building(list.__ne__)
+    __add__ = _building(list.__add__)
+    __mul__ = _building(list.__mul__)
+    __rmul__ = _building(list.__rmul__)
+    count = _building(list.count)
+    index = _building(list.index)
+
+    # element access
+    def __getitem__(self, item):
+        if isinstance(item, basestring):
+            return self.column(item)
+        if isinstance(item, slice) or not np.isscalar(item):
+            return self.take(item)
+        self.materialize()
+        return list.__getitem__(self, item)
+
+    def __getslice__(self, i, j):
+        return self.take(slice(i, j))
+
+    def __setitem__(self, item, value):
+        if isinstance(item, basestring):
+            if self._index is None:
+                for h, v in zip(self, np.asarray(value).tolist()):
+                    h[item] = v
+            else:
+                self._store.set_column(item, self._index, value)
+        else:
+            self._set_item(item, value)
+
+    _set_item = _mutating(list.__setitem__)
+
+    def take(self, indexes):
+        """
+        Returns a HeaderTable of some headers, without copying them.
+        """
+        if self._index is None:
+            rows = np.empty(len(self), dtype=object)
+            rows[:] = list(self)
+            return HeaderTable(rows[indexes])
+        return HeaderTable(_store=self._store, _index=self._index[indexes])
+
+    def column(self, key, default=None):
+        """
+        Returns the values of a keyword for all headers as an ndarray.
+        If default is given, it replaces missing values.
+        """
+        if self._index is not None:
+            try:
+                return self._store.column(key)[self._index]
+            except(KeyError):
+                if default is None:
+                    raise
+        if default is None:
+            return np.asarray([h[key] for h in self])
+        return np.asarray([h.get(key, default) for h in self])
+
+    def has_column(self, key):
+        """
+        True if the keyword is defined in all headers.
+        """
+        if self._index is not None and self._store.complete(key):
+            return True
+        return all([key in h for h in self])
+
+    # list modifications
+    __setslice__ = _mutating(list.__setslice__)
+    __delitem__ = _mutating(list.__delitem__)
+    __delslice__ = _mutating(list.__delslice__)
+    __iadd__ = _mutating(list.__iadd__)
+    append = _mutating(list.append)
+    extend = _mutating(list.extend)
+    insert = _mutating(list.insert)
+    pop = _mutating(list.pop)
+    remove = _mutating(list.remove)
+    reverse = _mutating(list.reverse)
+    sort = _mutating(list.sort)
+
+    # copy
+    def __copy__(self):
+        return self.take(slice(None))
+    def __deepcopy__(self, memo):
+        return HeaderTable([dict(h) for h in self])
+    def __reduce__(self):
+        return (HeaderTable, ([dict(h) for h in self],))
+
+def as_header_table(header):
+    """
+    Returns header as a HeaderTable, without copy if it already is one.
+    """
+    if isinstance(header, HeaderTable):
+        return header
+    return HeaderTable(header)
+
+def header_columns(header):
+    """
+    The keywords of a list of headers (or a HeaderTable) as columns.
+
+    Returns
+    -------
+    columns: dict
+      The values of each keyword as a 1d ndarray (an object array if
+      the values are not all integers, all floats or all strings).
+    missing: dict
+      For the keywords missing in some headers, a boolean array which
+      is True where the keyword is missing (the column holds a filler
+      value there).
+    """
+    keys = set()
+    for h in header:
+        keys.update(h.keys())
+    columns = dict()
+    missing = dict()
+    for key in keys:
+        present = np.asarray([key in h for h in header], dtype=bool)
+        values = [h[key] for h in header if key in h]
+        kinds = set([_value_kind(v) for v in values])
+        if len(kinds) == 1 and None not in kinds:
+            filler = values[0]
+            col = np.asarray([h.get(key, filler) for h in header])
+        else:
+            col = np.empty(len(header), dtype=object)
+            col[:] = [h.get(key) for h in header]
+        columns[key] = col
+        if not present.all():
+            missing[key] = ~present
+    return columns, missing
+
+def _value_kind(value):
+    "Values of the same kind can be stored in a numpy column."
+    if isinstance(value, (bool, np.bool_)):
+        return "b"
+    if isinstance(value, (int, long, np.integer)):
+        return "i"
+    if isinstance(value, (float, np.floating)):
+        return "f"
+    if isinstance(value, basestring):
+        return "S"
+    return None
+
+def header_table_from_columns(columns, missing=None):
+    """
+    A HeaderTable from the columns of header_columns. Numeric columns
+    are kept as the cached columns of the table, and the headers are
+    only built when they are accessed as dicts.
+    """
+    missing = missing or dict()
+    columns = dict([(k, np.asarray(c)) for k, c in columns.iteritems()])
+    if len(columns) == 0:
+        return HeaderTable()
+    size = len(columns.values()[0])
+    store = _ColumnStore(source=(columns, missing))
+    for key, col in columns.iteritems():
+        if key not in missing and col.dtype.kind in "biuf":
+            store.columns[key] = col
+    return HeaderTable(_store=store, _index=np.arange(size))
+
+def get_column(header, key, default=None):
+    """
+    Values of a keyword in a list of headers (or a HeaderTable) as an
+    ndarray.
+    """
+    if isinstance(header, HeaderTable):
+        return header.column(key, default=default)
+    if default is None:
+        return np.asarray([h[key] for h in header])
+    return np.asarray([h.get(key, default) for h in header])
+
+def set_column(header, key, values):
+    """
+    Set the values of a keyword in a list of headers (or a HeaderTable).
+    """
+    if isinstance(header, HeaderTable):
+        header[key] = values
+    else:
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = values.repeat(len(header))
+        for h, v in zip(header, values.tolist()):
+            h[key] = v
+
+class DataStack(fa.InfoArray):
+    """
+    An InfoArray of images concatenated along the last axis with a
+    HeaderTable as header. Indexing the image axis also indexes the
+    header.
+    """
+    def __new__(subtype, shape=None, data=None, dtype=float, buffer=None,
+                offset=0, strides=None, order=None, header=None):
+        obj = fa.InfoArray.__new__(subtype, shape=shape, data=data,
+                                   dtype=dtype, buffer=buffer, offset=offset,
+                                   strides=strides, order=order, header=header)
+        if header is not None:
+            obj.header = as_header_table(header)
+        return obj
+
+    def __getitem__(self, item):
+        out = fa.InfoArray.__getitem__(self, item)
+        if not isinstance(out, DataStack):
+            return out
+        index = _image_index(item, self.ndim)
+        if (index is None or self.header is None or
+            len(self.header) != self.shape[-1]):
+            # not indexing images (or reshaped stack)
+            return out
+        if np.isscalar(index):
+            # the image axis has been removed
+            out = out.view(fa.InfoArray)
+            out.header = self.header[index]
+        else:
+            out.header = as_header_table(self.header)[index]
+        return out
+
+    def __reduce__(self):
+        state = list(fa.InfoArray.__reduce__(self))
+        state[2] = (state[2], self.header)
+        return tuple(state)
+
+    def __setstate__(self, state):
+        fa.InfoArray.__setstate__(self, state[0])
+        self.header = state[1]
+
+def _image_index(item, ndim):
+    """
+    The index of the last axis in an indexing expression, or None if it
+    cannot be determined simply.
+    """
+    if not isinstance(item, tuple):
+        if ndim == 1:
+            return item
+        return None
+    if len(item) == 2 and item[0] is Ellipsis:
+        return item[1]
+    if (len(item) == ndim and
+        all([i is not None and i is not Ellipsis for i in item])):
+        return item[-1]
+    return None
+
+def as_data_stack(data, header=None):
+    """
+    Returns a view of an array as a DataStack with a HeaderTable as
+    header (the header of data if header is None).
+    """
+    if header is None:
+        header = data.header
+    out = np.asarray(data).view(DataStack)
+    out.header = as_header_table(header)
+    return out
@@ -0,0 +1,218 @@
+"""
+Streaming projections of data sets larger than memory.
+
+Images are taken from an iterator (for instance read_images on the
+files selected by solar.select_files) and processed in batches: each
+batch is copied in a preallocated stack and backprojected into the
+map. Files are decoded and binned in background threads while the
+current batch is backprojected, with a bounded number of images read
+in advance. Memory is thus bounded by the batch size (and the prefetch
+depth) whatever the number of images.
+
+In the forward direction, the projections are written batch after
+batch in a memory-mapped .npy file (in Fortran order, so that each
+image is contiguous on disk).
+
+Exemple
+-------
+>>> files = solar.select_files(path, instrume="EUVI", tmin=t0, tmax=t1)
+>>> images = read_images(files, bin_factor=4)
+>>> stream_backprojector(images, cube, obstacle="sun",
+...                      mask_params={"data_rmax":1.3})
+>>> data = stream_projector(cube, headers, "projections.npy")
+"""
+from collections import deque
+import numpy as np
+import fitsarray as fa
+from stack import as_data_stack
+
+# default number of images projected at once
+BATCH_SIZE = 16
+
+def prefetch(func, items, nthread=None, depth=None):
+    """
+    Apply func to items in background threads and yield the results in
+    order.
+
+    Arguments
+    ---------
+    func: function
+      The function applied to each item.
+    items: iterable
+      The items (consumed lazily).
+    nthread: int (optional)
+      Number of threads (number of cores by default).
+    depth: int (optional)
+      Maximal number of results computed in advance (twice the number
+      of threads by default). Bounds the memory used when the consumer
+      is slower than the threads.
+    """
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    if nthread is None:
+        nthread = cpu_count()
+    nthread = max(nthread, 1)
+    if depth is None:
+        depth = 2 * nthread
+    pool = ThreadPool(nthread)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= depth:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def read_images(files, bin_factor=None, dtype=np.float64, nthread=None,
+                depth=None):
+    """
+    Read, bin and update the headers of images (as solar.read_data) in
+    background threads.
+
+    Arguments
+    ---------
+    files: iterable
+      File names or solar.FileHeader (see solar.select_files).
+    bin_factor: int (optional)
+      Bin factor of the images.
+    dtype: numpy dtype
+      Data type of the images.
+    nthread, depth:
+      See prefetch.
+
+    Returns
+    -------
+    An iterator of 2d InfoArrays with dict headers.
+    """
+    import solar
+    bitpix = fa.bitpix_inv[np.dtype(dtype).name]
+    def read_one(f):
+        fits_array = solar.read_image(getattr(f, "filename", f),
+                                      bin_factor=bin_factor)
+        header = dict(fits_array.header)
+        header['BITPIX'] = bitpix
+        return fa.InfoArray(data=np.asarray(fits_array, dtype=dtype),
+                            header=header)
+    return prefetch(read_one, files, nthread=nthread, depth=depth)
+
+def batches(images, batch_size=BATCH_SIZE, dtype=None):
+    """
+    Group images in data stacks of at most batch_size images of the
+    same shape.
+
+    The stacks share a buffer: a stack is overwritten by the next one,
+    so it should be used before asking for the next one.
+    """
+    buf = None
+    headers = []
+    for image in images:
+        image_dtype = dtype or image.dtype
+        if buf is not None and (image.shape != buf.shape[:-1] or
+                                image_dtype != buf.dtype):
+            # shape change: flush the current batch
+            if len(headers):
+                yield _batch(buf, headers)
+            buf = None
+            headers = []
+        if buf is None:
+            buf = np.empty(image.shape + (batch_size,), dtype=image_dtype)
+        buf[..., len(headers)] = image
+        headers.append(dict(image.header))
+        if len(headers) == batch_size:
+            yield _batch(buf, headers)
+            headers = []
+    if len(headers):
+        yield _batch(buf, headers)
+
+def _batch(buf, headers):
+    n = len(headers)
+    if n < buf.shape[-1]:
+        # projectors require contiguous stacks
+        buf = np.ascontiguousarray(buf[..., :n])
+    return as_data_stack(buf, [dict(h) for h in headers])
+
+def stream_backprojector(images, cube, batch_size=BATCH_SIZE,
+                         mask_params=None, obstacle=None, **kwargs):
+    """
+    Backproject an iterator of images into a map, batch by batch.
+
+    Arguments
+    ---------
+    images: iterable
+      2d InfoArrays with dict headers (see read_images).
+    cube: 3d InfoArray
+      The map, updated in place.
+    batch_size: int
+      Number of images backprojected at once.
+    mask_params: dict (optional)
+      Arguments of solar.define_data_mask defining the mask of each
+      batch (no mask if None).
+    obstacle: {None, "sun"}
+      See siddon.backprojector.
+
+    Other keyword arguments are passed to siddon.backprojector
+    (nthread, engine).
+
+    Returns
+    -------
+    cube: 3d InfoArray
+      The updated map.
+    """
+    import solar
+    from siddon import backprojector
+    for batch in batches(images, batch_size, dtype=cube.dtype):
+        mask = None
+        if mask_params is not None:
+            mask = solar.define_data_mask(batch, **mask_params)
+        backprojector(batch, cube, mask=mask, obstacle=obstacle, **kwargs)
+    return cube
+
+def stream_projector(cube, headers, filename, batch_size=BATCH_SIZE,
+                     obstacle=None, **kwargs):
+    """
+    Project a map on the images defined by headers, batch by batch,
+    into a memory-mapped .npy file.
+
+    Arguments
+    ---------
+    cube: 3d InfoArray
+      The map.
+    headers: sequence of dicts
+      The headers of the images (all with the same NAXIS1 and NAXIS2).
+    filename: str
+      The output .npy file. The stack is stored in Fortran order.
+    batch_size: int
+      Number of images projected at once.
+    obstacle: {None, "sun"}
+      See siddon.projector.
+
+    Other keyword arguments are passed to siddon.projector (nthread,
+    engine).
+
+    Returns
+    -------
+    data: DataStack
+      The projections, memory-mapped from filename.
+    """
+    from siddon import projector
+    headers = [dict(h) for h in headers]
+    if len(headers) == 0:
+        raise ValueError("No image to project.")
+    shapes = set([(int(h['NAXIS1']), int(h['NAXIS2'])) for h in headers])
+    if len(shapes) > 1:
+        raise ValueError("Images should have the same shape.")
+    shape = shapes.pop() + (len(headers),)
+    out = np.lib.format.open_memmap(filename, mode="w+", dtype=cube.dtype,
+                                    shape=shape, fortran_order=True)
+    buf = np.empty(shape[:2] + (min(batch_size, shape[-1]),), dtype=cube.dtype)
+    for i0 in xrange(0, shape[-1], batch_size):
+        i1 = min(i0 + batch_size, shape[-1])
+        batch = _batch(buf, headers[i0:i1])
+        projector(batch, cube, obstacle=obstacle, accumulate=False, **kwargs)
+        out[..., i0:i1] = batch
+    out.flush()
+    return as_data_stack(out, headers)
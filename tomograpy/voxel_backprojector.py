@@ -0,0 +1,264 @@
+"""
+A fast approximate voxel-driven backprojector.
+
+Instead of tracing the rays of the pixels through the map (as the
+Siddon backprojector does), the center of each voxel is projected into
+each image with the geometry of the image header (R matrix, M, CRPIX,
+CDELT, CRVAL) and the image is interpolated at this position. The cost
+scales with the number of voxels times the number of images, which is
+much cheaper than Siddon for coarse maps and large images. It is meant
+for initial guesses of the inversions, not as the adjoint of a
+projector.
+
+Two modes are available:
+
+- unfiltered: an approximation of P^T b. Each image contributes its
+  interpolated value times the expected length of the rays of one
+  pixel inside the voxel (the voxel volume divided by the pixel
+  footprint at the voxel distance).
+
+- filtered: a filtered backprojection (FBP). Images are filtered with
+  a ramp (Ram-Lak) filter along their first axis, and backprojected
+  with a weight pi / n_images. This is the parallel-beam FBP: it
+  assumes a small field of view and images evenly spread over (half)
+  a rotation around the second image axis.
+
+Voxels are processed in slabs along the first map axis in parallel
+threads (NumPy releases the GIL during array operations).
+
+Exemple
+-------
+>>> x0 = fast_backprojector(data, cube, mask=data_mask, obstacle="sun")
+>>> x0 = fast_backprojector(data, cube, filtered=True)
+"""
+import numpy as np
+from stack import get_column
+
+# maximal number of voxels of a slab
+CHUNK_SIZE = 2 ** 16
+
+def fast_backprojector(data, cube, mask=None, obstacle=None, filtered=False,
+                       nthread=None, chunk_size=None):
+    """
+    Approximate voxel-driven backprojection of a data stack.
+
+    Arguments
+    ---------
+    data: 3d InfoArray
+      The data stack.
+    cube: 3d InfoArray
+      The map defining the voxel grid (its values are not used).
+    mask: 3d ndarray (optional)
+      Pixels where mask is not zero are not backprojected.
+    obstacle: {None, "sun"}
+      If "sun", voxels hidden by the sphere of radius one from the
+      viewpoint of an image do not receive its contribution.
+    filtered: boolean
+      If True, returns a filtered backprojection (see ramp_filter).
+    nthread: int (optional)
+      Number of threads (number of cores by default).
+    chunk_size: int (optional)
+      Maximal number of voxels processed at once by a thread.
+
+    Returns
+    -------
+    x: 3d InfoArray
+      The backprojection with the header of cube.
+    """
+    import fitsarray as fa
+    from solar import _thread_map
+    from priors import _nslabs
+    if obstacle not in (None, "sun"):
+        raise ValueError("obstacle should be None or 'sun'")
+    if cube.ndim != 3:
+        raise ValueError("cube should be a 3d map")
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    images = np.array(data, dtype=cube.dtype)
+    if mask is not None:
+        images[np.asarray(mask) != 0] = 0.
+    images[np.isnan(images)] = 0.
+    geometry = _image_geometry(data)
+    if filtered:
+        images = ramp_filter(images, geometry["ds"])
+        weights = None
+    else:
+        weights = _footprint_weights(geometry, cube.header)
+    centers = voxel_centers(cube.header)
+    out = np.zeros(cube.shape, dtype=cube.dtype)
+    # slabs along the first axis of the map
+    n = cube.shape[0]
+    plane = cube.shape[1] * cube.shape[2]
+    nslabs = max(_nslabs(nthread), int(np.ceil(n * plane / float(chunk_size))))
+    bounds = np.linspace(0, n, min(n, nslabs) + 1).astype(int)
+    def backproject_slab(b):
+        s = slice(b[0], b[1])
+        X = np.empty(out[s].shape + (3,))
+        X[..., 0] = centers[0][s, np.newaxis, np.newaxis]
+        X[..., 1] = centers[1][np.newaxis, :, np.newaxis]
+        X[..., 2] = centers[2][np.newaxis, np.newaxis, :]
+        out[s] = _backproject_points(X, images, geometry, weights, obstacle)
+    _thread_map(backproject_slab, zip(bounds[:-1], bounds[1:]),
+                nthread=nthread)
+    if filtered:
+        out *= np.pi / data.shape[-1]
+    return fa.InfoArray(data=out, header=dict(cube.header))
+
+def voxel_centers(header):
+    """
+    Physical coordinates of the voxel centers along each axis of a map
+    (consistent with siddon.map_borders).
+    """
+    centers = []
+    for i in xrange(3):
+        si = str(i + 1)
+        n = int(header['NAXIS' + si])
+        cdelt = header['CDELT' + si]
+        mmin = - header['CRPIX' + si] * cdelt
+        centers.append(mmin + (np.arange(n) + .5) * cdelt)
+    return centers
+
+def ramp_filter(images, ds):
+    """
+    Filter images with a ramp (Ram-Lak) filter along their first axis.
+
+    Arguments
+    ---------
+    images: 3d ndarray
+      A stack of images (the last axis is the image index).
+    ds: 1d ndarray
+      Pixel size of each image along its first axis, in map units at
+      the distance of the map center.
+
+    Returns
+    -------
+    The filtered images (discrete convolution with the spatial Ram-Lak
+    kernel of Kak and Slaney, with zero padding).
+    """
+    n = images.shape[0]
+    npad = int(2 ** np.ceil(np.log2(2 * n)))
+    # spatial kernel: 1 / 4 at 0, - 1 / (pi k) ** 2 for odd k
+    k = np.fft.fftfreq(npad, 1. / npad)
+    h = np.zeros(npad)
+    h[0] = .25
+    odd = (k % 2) == 1
+    h[odd] = - 1. / (np.pi * k[odd]) ** 2
+    H = np.real(np.fft.fft(h))
+    F = np.fft.fft(images, n=npad, axis=0)
+    F *= H[:, np.newaxis, np.newaxis]
+    out = np.real(np.fft.ifft(F, axis=0))[:n]
+    # the kernel above is for unit pixels
+    out /= np.asarray(ds)[np.newaxis, np.newaxis]
+    return out.astype(images.dtype)
+
+def _image_geometry(data):
+    """
+    Parameters of the images as arrays of one value per image.
+    """
+    import siddon
+    h = data.header
+    get = lambda key, default: np.asarray(get_column(h, key, default),
+                                          dtype=float)
+    try:
+        R = np.asarray([[get_column(h, 'R%i_%i' % (i + 1, j + 1))
+                         for j in xrange(3)] for i in xrange(3)], dtype=float)
+        R = R.transpose((2, 0, 1))
+    except(KeyError):
+        R = siddon.rotation_matrix(get_column(h, 'LON'), get_column(h, 'LAT'),
+                                   get_column(h, 'ROL'))
+    M = np.asarray([get_column(h, 'M' + str(i + 1)) for i in xrange(3)],
+                   dtype=float).T
+    g = dict(R=R, M=M)
+    for k in ("CRPIX1", "CRPIX2", "CRVAL1", "CRVAL2"):
+        g[k] = get(k, 0.)
+    for k in ("CDELT1", "CDELT2"):
+        g[k] = get(k, 1.)
+    # pixel size at the distance of the map center
+    g["ds"] = np.sqrt(np.sum(M ** 2, axis=-1)) * np.abs(g["CDELT1"])
+    return g
+
+def _footprint_weights(geometry, header):
+    """
+    Voxel volume over the pixel solid angle of each image: the expected
+    length of the rays of a pixel in a voxel is this weight divided by
+    the squared distance and the cosine of the latitude in the image.
+    """
+    volume = np.prod([abs(header['CDELT' + str(i + 1)]) for i in xrange(3)])
+    return volume / np.abs(geometry["CDELT1"] * geometry["CDELT2"])
+
+def _backproject_points(X, images, g, weights, obstacle):
+    """
+    Sum over images of the interpolated values of the images at the
+    projections of the points X (an array of shape (..., 3)).
+    """
+    n1, n2, nt = images.shape
+    out = np.zeros(X.shape[:-1])
+    for t in xrange(nt):
+        W = X - g["M"][t]
+        r2 = np.sum(W ** 2, axis=-1)
+        r = np.sqrt(r2)
+        # direction in the image frame (R is a rotation)
+        u2 = np.einsum('ji,...j->...i', g["R"][t], W) / r[..., np.newaxis]
+        gamma = np.arctan2(u2[..., 1], u2[..., 0])
+        lamb = np.arcsin(np.clip(u2[..., 2], -1., 1.))
+        # fractional pixel indices (inverse of pixel2physical)
+        x = (gamma - g["CRVAL1"][t]) / g["CDELT1"][t] + g["CRPIX1"][t] - 1.
+        y = (lamb - g["CRVAL2"][t]) / g["CDELT2"][t] + g["CRPIX2"][t] - 1.
+        v = _bilinear(images[..., t], x, y)
+        if weights is not None:
+            v *= weights[t] / (r2 * np.cos(lamb))
+        if obstacle == "sun":
+            v[_hidden(g["M"][t], W, r)] = 0.
+        out += v
+    return out
+
+def _bilinear(image, x, y):
+    """
+    Bilinear interpolation of an image at fractional indices (pixel
+    centers are at integer indices). Zero outside of the image.
+    """
+    n1, n2 = image.shape
+    x0 = np.floor(x).astype(int)
+    y0 = np.floor(y).astype(int)
+    wx = x - x0
+    wy = y - y0
+    out = np.zeros(x.shape)
+    for dx, fx in ((0, 1. - wx), (1, wx)):
+        for dy, fy in ((0, 1. - wy), (1, wy)):
+            i = x0 + dx
+            j = y0 + dy
+            inside = (i >= 0) & (i < n1) & (j >= 0) & (j < n2)
+            out[inside] += (fx * fy)[inside] * image[i[inside], j[inside]]
+    return out
+
+def _hidden(M, W, r):
+    """
+    True where the segment from the viewpoint M to the points M + W
+    (of length r) goes through the sphere of radius one.
+    """
+    b = np.sum(W * M, axis=-1) / r
+    c = np.sum(M ** 2) - 1.
+    disc = b ** 2 - c
+    entry = - b - np.sqrt(np.maximum(disc, 0.))
+    return (disc > 0) & (entry < r) & (- b + np.sqrt(np.maximum(disc, 0.)) > 0)
+
+def scale_to_data(x, P, b):
+    """
+    Scale a map so that its projection best fits the data in the least
+    squares sense. Requires one projection.
+
+    Arguments
+    ---------
+    x: ndarray
+      The map (as expected by P).
+    P: linear operator
+      The projector of the model.
+    b: ndarray
+      The (masked) data.
+    """
+    Px = np.asarray(P * np.asarray(x).ravel()).ravel()
+    b = np.asarray(b).ravel()
+    norm = np.dot(Px, Px)
+    if norm == 0:
+        return x
+    return x * (np.dot(Px, b) / norm)